@@ -10,6 +10,7 @@ For the full list of settings and their values, see
 https://docs.djangoproject.com/en/4.2/ref/settings/
 """
 import os
+import tempfile
 from pathlib import Path
 
 import django.core.mail.backends.console
@@ -66,6 +67,7 @@ INSTALLED_APPS = [
 
 MIDDLEWARE = [
     'debug_toolbar.middleware.DebugToolbarMiddleware',
+    'flights.middleware.QueryBudgetMiddleware',
     'django.middleware.security.SecurityMiddleware',
     'django.contrib.sessions.middleware.SessionMiddleware',
     'django.middleware.common.CommonMiddleware',
@@ -73,8 +75,14 @@ MIDDLEWARE = [
     'django.contrib.auth.middleware.AuthenticationMiddleware',
     'django.contrib.messages.middleware.MessageMiddleware',
     'django.middleware.clickjacking.XFrameOptionsMiddleware',
+    'flights.middleware.IdentityMapMiddleware',
 ]
 
+# Доля запросов, для которых QueryBudgetMiddleware считает запросы к БД (0 - выключено, 1 - все)
+QUERY_BUDGET_SAMPLE_RATE = float(os.environ.get('QUERY_BUDGET_SAMPLE_RATE', 0))
+# Превышение бюджета - исключение, а не только запись в лог (включается в тестах)
+QUERY_BUDGET_RAISE = False
+
 ROOT_URLCONF = 'aviablog.urls'
 
 TEMPLATES = [
@@ -114,6 +122,19 @@ DATABASES = {
     }
 }
 
+# Cache
+# https://docs.djangoproject.com/en/4.2/topics/cache/
+# Файловый кэш в каталоге CACHE_LOCATION. Воркер очереди задач сбрасывает кэш главной страницы
+# (HomePageCache.bump_generation), поэтому у web и worker каталог должен быть общим:
+# в docker-compose это том cache_volume. Без CACHE_LOCATION кэш виден только процессам одной машины
+
+CACHES = {
+    'default': {
+        'BACKEND': os.environ.get('CACHE_BACKEND', 'django.core.cache.backends.filebased.FileBasedCache'),
+        'LOCATION': os.environ.get('CACHE_LOCATION', os.path.join(tempfile.gettempdir(), 'aviablog_cache')),
+    }
+}
+
 
 # Password validation
 # https://docs.djangoproject.com/en/4.2/ref/settings/#auth-password-validators
@@ -160,7 +181,41 @@ MEDIA_URL = 'media/'
 MEDIA_ROOT = os.path.join(BASE_DIR, 'media')
 # DEFAULT_FILE_STORAGE = 'flights.custom_storage.OverwriteStorage'
 
+# Загрузки хранятся по хешу содержимого (flights/storage.py), файлы до перехода переносит migrate_media_to_cas
+STORAGES = {
+    'default': {
+        'BACKEND': os.environ.get('MEDIA_STORAGE', 'flights.storage.ContentAddressedStorage'),
+    },
+    'staticfiles': {
+        'BACKEND': 'django.contrib.staticfiles.storage.StaticFilesStorage',
+    },
+}
+# Сколько секунд браузер и прокси помнят перенаправление логического имени файла на его содержимое
+# (flights.views.MediaFileView). Имя получает другое содержимое только при повторном использовании после удаления
+MEDIA_REDIRECT_MAX_AGE = int(os.environ.get('MEDIA_REDIRECT_MAX_AGE', 3600))
+
 # Default primary key field type
 # https://docs.djangoproject.com/en/4.2/ref/settings/#default-auto-field
 
 DEFAULT_AUTO_FIELD = 'django.db.models.BigAutoField'
+
+# Logging
+# https://docs.djangoproject.com/en/4.2/topics/logging/
+
+LOGGING = {
+    'version': 1,
+    'disable_existing_loggers': False,
+    'handlers': {
+        'console': {
+            'class': 'logging.StreamHandler',
+        },
+    },
+    'loggers': {
+        # Метрики (число запросов, время транзакций, отчеты бюджета) пишутся на уровне INFO:
+        # включаются FLIGHTS_LOG_LEVEL=INFO, по умолчанию, в том числе в тестах, выводятся только предупреждения
+        'flights': {
+            'handlers': ['console'],
+            'level': os.environ.get('FLIGHTS_LOG_LEVEL', 'WARNING'),
+        },
+    },
+}
@@ -0,0 +1,2 @@
+from .runner import BenchmarkRunner
+from .report import compare_reports, load_report, save_report
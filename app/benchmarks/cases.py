@@ -0,0 +1,178 @@
+from io import BytesIO
+from itertools import count
+
+from django.contrib.auth.models import User
+from django.core.cache import cache
+from django.core.files.uploadedfile import SimpleUploadedFile
+from django.db.models import Count
+from django.test import Client
+from django.urls import reverse
+from PIL import Image
+
+from flights.models import UserTrip
+from flights.services import (FlightDetailService, FlightInformationService, PassengerProfileService,
+                              PassengerService)
+
+PAGE_SIZE = 50
+
+# Номера новых рейсов сквозные для всех масштабов, иначе форма найдет уже созданный рейс
+flight_numbers = count()
+
+
+def get_sample(size, rng):
+    '''Случайные (username, slug) существующих путешествий для параметров сценариев'''
+
+    last_id = UserTrip.objects.order_by('-pk').values_list('pk', flat=True).first() or 0
+    trip_ids = rng.sample(range(1, last_id + 1), min(size, last_id))
+    return list(UserTrip.objects.filter(pk__in=trip_ids).values_list('passenger__username', 'slug'))
+
+
+def get_global_profile_aggregate(username):
+    return User.objects \
+        .values('username', 'first_name', 'last_name') \
+        .annotate(total_airlines=Count('usertrip__flight__airframe__airline', distinct=True),
+                  total_aircraft_types=Count('usertrip__flight__airframe__aircraft_type', distinct=True),
+                  total_airports=Count('usertrip__flight__flightinfo__airport_code', distinct=True),
+                  total_flights=Count('usertrip', distinct=True)) \
+        .get(username=username)
+
+
+def get_service_cases(sample):
+    usernames = [username for username, _ in sample]
+    slugs = [slug for _, slug in sample]
+    # id пассажиров читаются вне замеров: сценарий статистики измеряет только ее запрос
+    passenger_ids = list(User.objects.filter(username__in=usernames).values_list('pk', flat=True))
+
+    return {
+        'service: FlightInformationService.get_latest_cards':
+            lambda rng: FlightInformationService.get_latest_cards(),
+        'service: FlightInformationService.get_top_users':
+            lambda rng: list(FlightInformationService.get_top_users()),
+        'service: FlightInformationService.get_site_information':
+            lambda rng: FlightInformationService.get_site_information(),
+        'service: PassengerService.get_all_passengers_with_statistic':
+            lambda rng: list(PassengerService.get_all_passengers_with_statistic()[:PAGE_SIZE]),
+        'service: PassengerProfileService.get_profile_information':
+            lambda rng: PassengerProfileService.get_profile_information(rng.choice(usernames)),
+        # Статистика профиля без таблицы PassengerStats: агрегат по одному пассажиру и прежний агрегат
+        # по всем пользователям с фильтром - для сравнения с get_profile_information
+        'service: PassengerService.get_passenger_statistic':
+            lambda rng: PassengerService.get_passenger_statistic(rng.choice(passenger_ids)),
+        'baseline: global profile aggregate':
+            lambda rng: get_global_profile_aggregate(rng.choice(usernames)),
+        'service: PassengerProfileService.get_passenger_cards':
+            lambda rng: list(PassengerProfileService.get_passenger_cards(rng.choice(usernames))[:PAGE_SIZE]),
+        'service: FlightDetailService.get_flight_details':
+            lambda rng: FlightDetailService.get_flight_details(rng.choice(slugs)),
+    }
+
+
+def get_image_content():
+    buffer = BytesIO()
+    Image.new('RGB', (64, 64)).save(buffer, 'png')
+    return buffer.getvalue()
+
+
+IMAGE_CONTENT = get_image_content()
+
+
+def get_image(name):
+    return SimpleUploadedFile(name, IMAGE_CONTENT)
+
+
+def get_add_flight_payload(number):
+    return {
+        'registration_number': 'RA-BENCH',
+        'serial_number': 'BENCH-1',
+        'airline_name': 'Bench Airlines',
+
+        'flight_number': f'BENCH{number}',
+        'date': '2024-01-01',
+        'flight_time': '02:00',
+
+        'manufacturer': 'Airbus',
+        'generic_type': 'A320',
+
+        'seat': '1A',
+        'neighbors': 'B1, C1',
+        'comments': 'Benchmark',
+        'ticket_price': 10000,
+
+        'drinks': 'Water',
+        'appertize': 'Nuts',
+        'main_course': 'Chicken',
+        'desert': 'Cake',
+        'meal_price': 500,
+
+        'departure_airport_code': 'SVO',
+        'departure_gate': 'A',
+        'departure_is_boarding_bridge': True,
+        'departure_schedule_time': '10:00',
+        'departure_actual_time': '10:30',
+        'departure_runway': '06',
+        'departure_metar': 'METAR',
+
+        'arrival_airport_code': 'LED',
+        'arrival_gate': 'B',
+        'arrival_is_boarding_bridge': False,
+        'arrival_schedule_time': '12:00',
+        'arrival_actual_time': '12:15',
+        'arrival_runway': '10',
+        'arrival_metar': 'METAR',
+
+        'airframe_photo': get_image('airframe.png'),
+        'meal_photo': get_image('meal.png'),
+        'track_images': [get_image('track.png')],
+    }
+
+
+def get_update_payload(slug):
+    data, _, _ = FlightDetailService.get_flight_details(slug)
+    skip = ('user', 'track_images', 'departure_info', 'arrival_info')
+    return {name: value for name, value in data.items() if name not in skip and value is not None}
+
+
+def get_view_cases(sample, owner):
+    '''Представления через тестовый клиент, т.е. с middleware, шаблонами и сессией.
+    Изменяющие сценарии работают от имени owner и его путешествий'''
+
+    usernames = [username for username, _ in sample]
+    slugs = [slug for _, slug in sample]
+    # Форма редактирования требует питание, у части сгенерированных путешествий его нет
+    owner_slugs = list(UserTrip.objects.filter(passenger=owner, meal__isnull=False)
+                       .distinct().values_list('slug', flat=True))
+    # Данные формы редактирования не меняются между повторами, собираем их вне замеров
+    update_payloads = {slug: get_update_payload(slug) for slug in owner_slugs}
+
+    client = Client()
+    client.force_login(owner)
+
+    def get(url, status=200):
+        response = client.get(url)
+        assert response.status_code == status, (url, response.status_code)
+
+    def post(url, data, status=302):
+        response = client.post(url, data=data)
+        assert response.status_code == status, (url, response.status_code)
+
+    def home(rng):
+        cache.clear()
+        get(reverse('home'))
+
+    def update_flight(rng):
+        slug = rng.choice(owner_slugs)
+        post(reverse('flight_update', kwargs={'usertripslug': slug}), update_payloads[slug])
+
+    return {
+        'view: GET home': home,
+        'view: GET home (cached)': lambda rng: get(reverse('home')),
+        'view: GET passengers': lambda rng: get(reverse('passengers')),
+        'view: GET profile': lambda rng: get(reverse('profile', kwargs={'username': rng.choice(usernames)})),
+        'view: GET flight': lambda rng: get(reverse('flight', kwargs={'usertripslug': rng.choice(slugs)})),
+        'view: GET add_flight': lambda rng: get(reverse('add_flight')),
+        'view: POST add_flight': lambda rng: post(reverse('add_flight'), get_add_flight_payload(next(flight_numbers))),
+        'view: GET flight_update': lambda rng: get(
+            reverse('flight_update', kwargs={'usertripslug': rng.choice(owner_slugs)})
+        ),
+        'view: POST flight_update': update_flight,
+    }
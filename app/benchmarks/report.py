@@ -0,0 +1,59 @@
+import json
+import platform
+
+import django
+from django.db import connection
+from django.utils import timezone
+
+
+def build_report(results, **options):
+    return {
+        'meta': {
+            'created': timezone.now().isoformat(),
+            'python': platform.python_version(),
+            'django': django.get_version(),
+            'database': connection.vendor,
+            **options,
+        },
+        # {масштаб (число пользователей): {сценарий: метрики}}
+        'results': results,
+    }
+
+
+def save_report(report, path):
+    with open(path, 'w') as file:
+        json.dump(report, file, indent=2, sort_keys=True)
+
+
+def load_report(path):
+    with open(path) as file:
+        return json.load(file)
+
+
+def compare_reports(baseline, current, threshold=0.2):
+    '''Список расхождений (масштаб, сценарий, метрика, было, стало, регрессия).
+    Регрессия - рост p50/p95 больше чем на threshold или любой рост числа запросов'''
+
+    rows = []
+    for scale, cases in current['results'].items():
+        baseline_cases = baseline['results'].get(scale, {})
+        for name, metrics in cases.items():
+            if name not in baseline_cases:
+                continue
+
+            old = baseline_cases[name]
+            for metric in ('p50_ms', 'p95_ms', 'queries', 'peak_memory_kb'):
+                before, after = old.get(metric), metrics.get(metric)
+                if before is None or after is None or before == after:
+                    continue
+
+                if metric == 'queries':
+                    regression = after > before
+                elif metric.endswith('_ms'):
+                    regression = after > before * (1 + threshold)
+                else:
+                    regression = False
+
+                rows.append((scale, name, metric, before, after, regression))
+
+    return rows
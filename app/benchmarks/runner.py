@@ -0,0 +1,64 @@
+import gc
+import math
+import random
+import statistics
+import time
+import tracemalloc
+
+from flights.query_budget import QueryRecorder
+
+
+def percentile(values, percent):
+    ordered = sorted(values)
+    index = max(0, math.ceil(len(ordered) * percent / 100) - 1)
+    return ordered[index]
+
+
+class BenchmarkRunner:
+    '''Прогоняет сценарии: warmup вызовов без замеров, repeat замеров времени,
+    затем один отдельный вызов под QueryRecorder и tracemalloc, чтобы инструментирование
+    не искажало время'''
+
+    def __init__(self, repeat=30, warmup=3, seed=42):
+        self.repeat = repeat
+        self.warmup = warmup
+        self.rng = random.Random(seed)
+
+    def run_case(self, case):
+        '''case(rng) выполняет одно обращение; случайные параметры (пассажир, путешествие) он выбирает сам'''
+
+        for _ in range(self.warmup):
+            case(self.rng)
+
+        timings = []
+        for _ in range(self.repeat):
+            started = time.perf_counter()
+            case(self.rng)
+            timings.append((time.perf_counter() - started) * 1000)
+
+        gc.collect()
+        tracemalloc.start()
+        try:
+            with QueryRecorder() as report:
+                case(self.rng)
+            _, peak = tracemalloc.get_traced_memory()
+        finally:
+            tracemalloc.stop()
+
+        return {
+            'p50_ms': round(statistics.median(timings), 3),
+            'p95_ms': round(percentile(timings, 95), 3),
+            'queries': report.queries,
+            'duplicate_queries': len(report.get_duplicates()),
+            'peak_memory_kb': round(peak / 1024, 1),
+        }
+
+    def run(self, cases, log=None):
+        results = {}
+        for name, case in cases.items():
+            results[name] = self.run_case(case)
+            if log:
+                result = results[name]
+                log(f"  {name:<45} p50 {result['p50_ms']:9.2f} ms  p95 {result['p95_ms']:9.2f} ms  "
+                    f"{result['queries']:4} queries  {result['peak_memory_kb']:9.1f} KB")
+        return results
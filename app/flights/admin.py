@@ -1,5 +1,9 @@
 from django.contrib import admin
+from django.http import Http404
+from django.urls import path
+from django.utils import timezone
 
+from .exporters import EXPORT_FORMATS, FlightLogExporter, stream_flight_log
 from .models import *
 
 admin.site.register(AircraftType)
@@ -7,8 +11,41 @@ admin.site.register(Airline)
 admin.site.register(Airframe)
 admin.site.register(FlightInfo)
 admin.site.register(Flight)
-admin.site.register(UserTrip)
 admin.site.register(TrackImage)
 admin.site.register(Meal)
 
 
+@admin.register(UserTrip)
+class UserTripAdmin(admin.ModelAdmin):
+    change_list_template = 'admin/flights/usertrip/change_list.html'
+
+    def get_urls(self):
+        return [
+            path('export.<str:format>',
+                 self.admin_site.admin_view(self.export_view),
+                 name='flights_usertrip_export'),
+            *super().get_urls(),
+        ]
+
+    def export_view(self, request, format):
+        '''Выгрузка путешествий всех пассажиров'''
+
+        if format not in EXPORT_FORMATS or not self.has_view_permission(request):
+            raise Http404()
+
+        return stream_flight_log(FlightLogExporter(include_passenger=True), format, 'flights')
+
+    def changelist_view(self, request, extra_context=None):
+        extra_context = {**(extra_context or {}), 'export_formats': EXPORT_FORMATS}
+        return super().changelist_view(request, extra_context=extra_context)
+
+
+@admin.register(Job)
+class JobAdmin(admin.ModelAdmin):
+    list_display = ('pk', 'kind', 'status', 'attempts', 'run_after', 'created_at')
+    list_filter = ('status', 'kind')
+    actions = ['retry']
+
+    @admin.action(description='Retry selected jobs now')
+    def retry(self, request, queryset):
+        queryset.update(status=Job.QUEUED, attempts=0, run_after=timezone.now())
@@ -8,3 +8,5 @@ class FlightsConfig(AppConfig):
     def ready(self):
         # Implicitly connect signal handlers decorated with @receiver.
         import flights.signals
+        # Register background job handlers.
+        import flights.tasks
@@ -0,0 +1,179 @@
+import hashlib
+import json
+import os
+from collections import Counter
+
+from django.apps import apps
+from django.conf import settings
+from django.contrib.auth.models import User
+from django.contrib.staticfiles import finders
+from django.core import serializers
+from django.core.serializers import python
+from django.core.management.color import no_style
+from django.db import connection, transaction
+from django.db.migrations.executor import MigrationExecutor
+
+from .cache import HomePageCache
+from .models import AppliedFixture, UserTrip
+from .services import PassengerStatsService, SiteCounterService, TripCardService
+
+# Файл рядом с собранной статикой: хеш исходников, из которых она собрана
+STATIC_MANIFEST_NAME = '.bootstrap-manifest'
+# Те же шаблоны, что collectstatic пропускает по умолчанию
+STATIC_IGNORE_PATTERNS = ['CVS', '.*', '*~']
+
+CHUNK_SIZE = 64 * 1024
+
+
+def file_sha256(path):
+    digest = hashlib.sha256()
+    with open(path, 'rb') as file:
+        while chunk := file.read(CHUNK_SIZE):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+def get_pending_migrations():
+    '''План миграций до последних версий всех приложений, пустой список - база актуальна'''
+
+    executor = MigrationExecutor(connection)
+    return executor.migration_plan(executor.loader.graph.leaf_nodes())
+
+
+def get_static_manifest():
+    '''Хеш путей и содержимого всех файлов, которые соберет collectstatic'''
+
+    files = {}
+    for finder in finders.get_finders():
+        for path, storage in finder.list(STATIC_IGNORE_PATTERNS):
+            prefix = getattr(storage, 'prefix', None)
+            # Как и collectstatic, берем первый найденный файл с этим путем
+            files.setdefault(os.path.join(prefix, path) if prefix else path, (storage, path))
+
+    digest = hashlib.sha256()
+    for prefixed_path in sorted(files):
+        storage, path = files[prefixed_path]
+        digest.update(prefixed_path.encode() + b'\0')
+        with storage.open(path) as file:
+            while chunk := file.read(CHUNK_SIZE):
+                digest.update(chunk)
+        digest.update(b'\0')
+    return digest.hexdigest()
+
+
+def get_static_manifest_path():
+    return os.path.join(settings.STATIC_ROOT, STATIC_MANIFEST_NAME)
+
+
+def read_static_manifest():
+    try:
+        with open(get_static_manifest_path(), encoding='utf-8') as file:
+            return file.read().strip()
+    except FileNotFoundError:
+        return None
+
+
+def write_static_manifest(manifest):
+    with open(get_static_manifest_path(), 'w', encoding='utf-8') as file:
+        file.write(manifest)
+
+
+def is_fixture_applied(name, sha256):
+    return AppliedFixture.objects.filter(name=name, sha256=sha256).exists()
+
+
+class FixtureLoader:
+    '''Загрузка фикстуры upsert-ами вместо loaddata.
+    loaddata сохраняет объекты по одному (SELECT + UPDATE или INSERT на каждую строку),
+    здесь строки каждой модели пишутся пачками bulk_create(update_conflicts=True) по первичному ключу.
+    Сигналы при этом не вызываются, поэтому карточки, статистика и счетчики сайта обновляются здесь.
+    Фикстура и отметка о ее загрузке сохраняются в одной транзакции'''
+
+    def __init__(self, path, name=None, batch_size=1000):
+        self.path = path
+        self.name = name or os.path.basename(path)
+        self.batch_size = batch_size
+        self.counts = Counter()
+        # Метка модели -> поля, которые есть в фикстуре
+        self.present_fields = {}
+
+    def read_objects(self):
+        '''Объекты фикстуры, сгруппированные по моделям в порядке зависимостей'''
+
+        with open(self.path, encoding='utf-8') as stream:
+            raw_objects = json.load(stream)
+
+        # Перезаписываются только поля, которые есть в фикстуре: остальные (например, реестр
+        # уменьшенных копий изображений) сохраняют значения из базы
+        for raw in raw_objects:
+            self.present_fields.setdefault(raw['model'].lower(), set()).update(raw.get('fields', {}))
+
+        grouped = {}
+        for deserialized in python.Deserializer(raw_objects, ignorenonexistent=True):
+            grouped.setdefault(type(deserialized.object), []).append(deserialized)
+
+        app_list = {}
+        for model in grouped:
+            app_list.setdefault(apps.get_app_config(model._meta.app_label), []).append(model)
+        ordered = serializers.sort_dependencies(app_list.items(), allow_cycles=True)
+
+        return {model: grouped[model] for model in ordered}
+
+    def upsert(self, model, deserialized_objects):
+        objects = [deserialized.object for deserialized in deserialized_objects]
+        pk_name = model._meta.pk.name
+        present = self.present_fields.get(model._meta.label_lower, set())
+        update_fields = [field.name for field in model._meta.concrete_fields
+                         if not field.primary_key and field.name in present]
+
+        with_pk = [obj for obj in objects if obj.pk is not None]
+        without_pk = [obj for obj in objects if obj.pk is None]
+        if with_pk:
+            model.objects.bulk_create(with_pk,
+                                      update_conflicts=bool(update_fields),
+                                      ignore_conflicts=not update_fields,
+                                      unique_fields=[pk_name] if update_fields else None,
+                                      update_fields=update_fields or None,
+                                      batch_size=self.batch_size)
+        if without_pk:
+            model.objects.bulk_create(without_pk, batch_size=self.batch_size)
+
+        # Связи многие-ко-многим есть только у пользователей (группы и права), в фикстуре они пустые
+        for deserialized in deserialized_objects:
+            for field_name, values in (deserialized.m2m_data or {}).items():
+                if values:
+                    getattr(deserialized.object, field_name).set(values)
+
+        self.counts[model._meta.label] += len(objects)
+        return objects
+
+    def load(self, sha256=None):
+        sha256 = sha256 or file_sha256(self.path)
+        loaded = {}
+
+        with transaction.atomic():
+            for model, objects in self.read_objects().items():
+                loaded[model] = self.upsert(model, objects)
+
+            # Явные первичные ключи не сдвигают последовательности PostgreSQL
+            with connection.cursor() as cursor:
+                for sql in connection.ops.sequence_reset_sql(no_style(), list(loaded)):
+                    cursor.execute(sql)
+
+            self.refresh_read_models(loaded)
+
+            AppliedFixture.objects.update_or_create(name=self.name, defaults={'sha256': sha256})
+
+        return self.counts
+
+    @staticmethod
+    def refresh_read_models(loaded):
+        trip_ids = [trip.pk for trip in loaded.get(UserTrip, [])]
+        passenger_ids = {trip.passenger_id for trip in loaded.get(UserTrip, [])}
+        passenger_ids.update(user.pk for user in loaded.get(User, []))
+
+        if trip_ids:
+            TripCardService.refresh(UserTrip.objects.filter(pk__in=trip_ids))
+        PassengerStatsService.refresh(passenger_ids)
+        SiteCounterService.reconcile()
+        transaction.on_commit(HomePageCache.bump_generation)
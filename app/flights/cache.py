@@ -0,0 +1,81 @@
+import time
+
+from django.core.cache import cache
+
+
+class HomePageCache:
+    '''Версионированный кэш данных главной страницы.
+    Ключи содержат номер поколения, который увеличивается обработчиками из signals.py
+    при любом изменении данных. Старые записи не удаляются, а просто перестают читаться
+    и вытесняются по таймауту. Бэкенд кэша общий для всех воркеров gunicorn (см. CACHES)'''
+
+    GENERATION_KEY = 'home:generation'
+    HITS_KEY = 'home:hits'
+    MISSES_KEY = 'home:misses'
+    TIMEOUT = 60 * 60
+
+    _missing = object()
+
+    @staticmethod
+    def _new_generation():
+        # Если ключ поколения вытеснен, новое значение не должно совпасть со старыми
+        return int(time.time() * 1000)
+
+    @classmethod
+    def get_generation(cls):
+        generation = cache.get(cls.GENERATION_KEY)
+        if generation is None:
+            cache.add(cls.GENERATION_KEY, cls._new_generation(), timeout=None)
+            generation = cache.get(cls.GENERATION_KEY)
+        return generation
+
+    @classmethod
+    def bump_generation(cls):
+        try:
+            return cache.incr(cls.GENERATION_KEY)
+        except ValueError:
+            generation = cls._new_generation()
+            cache.set(cls.GENERATION_KEY, generation, timeout=None)
+            return generation
+
+    @staticmethod
+    def _increment(key):
+        try:
+            cache.incr(key)
+        except ValueError:
+            if not cache.add(key, 1, timeout=None):
+                cache.incr(key)
+
+    @classmethod
+    def get_or_set(cls, name, default):
+        '''Возвращает закэшированное значение name текущего поколения,
+        при промахе вычисляет его вызовом default()'''
+
+        key = f'home:{cls.get_generation()}:{name}'
+        value = cache.get(key, cls._missing)
+
+        if value is cls._missing:
+            cls._increment(cls.MISSES_KEY)
+            value = default()
+            cache.set(key, value, timeout=cls.TIMEOUT)
+        else:
+            cls._increment(cls.HITS_KEY)
+
+        return value
+
+    @classmethod
+    def get_stats(cls):
+        hits = cache.get(cls.HITS_KEY, 0)
+        misses = cache.get(cls.MISSES_KEY, 0)
+        total = hits + misses
+
+        return {
+            'generation': cache.get(cls.GENERATION_KEY),
+            'hits': hits,
+            'misses': misses,
+            'hit_ratio': hits / total if total else 0.0,
+        }
+
+    @classmethod
+    def reset_stats(cls):
+        cache.delete_many([cls.HITS_KEY, cls.MISSES_KEY])
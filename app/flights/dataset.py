@@ -0,0 +1,170 @@
+import random
+import string
+from datetime import date, time, timedelta
+from io import BytesIO
+
+from django.contrib.auth.models import User
+from django.core.files.base import ContentFile
+from django.core.files.storage import default_storage
+from django.db import transaction
+from django.utils.text import slugify
+from PIL import Image
+
+from .models import AircraftType, Airline, Airframe, Flight, FlightInfo, Meal, TrackImage, UserTrip
+from .renditions import PLACEHOLDER_DIR
+
+
+class DatasetGenerator:
+    '''Синтетические данные для нагрузочных тестов и бенчмарков.
+    Все строки создаются bulk_create пачками без сигналов и фабрик, изображения - общие заглушки,
+    поэтому после генерации нужно пересобрать TripCard, PassengerStats и SiteCounter.
+    Одинаковые seed и параметры дают одинаковые данные'''
+
+    FIRST_DAY = date(2015, 1, 1)
+    DAYS = 3650
+
+    def __init__(self, seed=42, batch_size=5000, prefix='gen', log=None):
+        self.rng = random.Random(seed)
+        self.batch_size = batch_size
+        self.prefix = prefix
+        self.log = log or (lambda message: None)
+
+    @staticmethod
+    def get_placeholder(name, color):
+        '''Путь к общей картинке-заглушке, файл создается один раз'''
+
+        path = f'{PLACEHOLDER_DIR}/{name}.jpg'
+        if not default_storage.exists(path):
+            buffer = BytesIO()
+            Image.new('RGB', (64, 64), color).save(buffer, 'jpeg')
+            default_storage.save(path, ContentFile(buffer.getvalue()))
+        return path
+
+    def exists(self):
+        return User.objects.filter(username__startswith=f'{self.prefix}_user_').exists()
+
+    def generate(self, users, trips_per_user=3, passengers_per_flight=5, airlines=50, aircraft_types=40,
+                 airframes=1000, airports=500, meal_ratio=0.5, tracks_per_trip=1):
+        # Пассажиры одного рейса - подряд идущие пользователи, их должно хватить на рейс
+        passengers_per_flight = max(1, min(passengers_per_flight, users))
+        counts = {}
+
+        with transaction.atomic():
+            airframe_list = self.create_references(airlines, aircraft_types, airframes)
+        counts.update(airlines=airlines, aircraft_types=aircraft_types, airframes=len(airframe_list))
+
+        with transaction.atomic():
+            passengers = self.create_users(users)
+        counts['users'] = len(passengers)
+
+        airport_codes = self.get_airport_codes(airports)
+        total_trips = users * trips_per_user
+        total_flights = -(-total_trips // passengers_per_flight)
+        flights_per_batch = max(1, self.batch_size // passengers_per_flight)
+        counts.update(flights=0, flight_infos=0, trips=0, meals=0, track_images=0)
+
+        for start in range(0, total_flights, flights_per_batch):
+            stop = min(start + flights_per_batch, total_flights)
+            with transaction.atomic():
+                batch_counts = self.create_flights(start, stop, passengers, trips_per_user, passengers_per_flight,
+                                                   airframe_list, airport_codes, meal_ratio, tracks_per_trip)
+            for name, value in batch_counts.items():
+                counts[name] += value
+            self.log(f'Flights {stop}/{total_flights}, trips {counts["trips"]}/{total_trips}')
+
+        return counts
+
+    def create_references(self, airlines, aircraft_types, airframes):
+        photo = self.get_placeholder('airframe', (90, 130, 200))
+
+        airline_list = Airline.objects.bulk_create(
+            [Airline(name=f'{self.prefix} Airline {i}') for i in range(airlines)]
+        )
+        aircraft_type_list = AircraftType.objects.bulk_create(
+            [AircraftType(manufacturer=f'{self.prefix} Manufacturer {i % 8}', generic_type=f'Type {i}')
+             for i in range(aircraft_types)]
+        )
+
+        return Airframe.objects.bulk_create([
+            Airframe(serial_number=f'{self.prefix}-SN{i:07}',
+                     registration_number=f'{self.prefix}-RA{i:07}'.upper(),
+                     photo=photo,
+                     airline=self.rng.choice(airline_list),
+                     aircraft_type=self.rng.choice(aircraft_type_list))
+            for i in range(airframes)
+        ], batch_size=self.batch_size)
+
+    def create_users(self, count):
+        # Вход под этими пользователями не нужен: unusable password вместо дорогого хеширования
+        users = User.objects.bulk_create(
+            (User(username=f'{self.prefix}_user_{i}', password='!') for i in range(count)),
+            batch_size=self.batch_size
+        )
+        return [(user.pk, user.username) for user in users]
+
+    def get_airport_codes(self, count):
+        codes = set()
+        while len(codes) < count:
+            codes.add(''.join(self.rng.choices(string.ascii_uppercase, k=3)))
+        return sorted(codes)
+
+    def create_flights(self, start, stop, passengers, trips_per_user, passengers_per_flight,
+                       airframes, airport_codes, meal_ratio, tracks_per_trip):
+        rng = self.rng
+
+        flights = Flight.objects.bulk_create([
+            Flight(flight_number=f'{self.prefix}{number}'.upper(),
+                   date=self.FIRST_DAY + timedelta(days=rng.randrange(self.DAYS)),
+                   flight_time=time(rng.randrange(1, 12), rng.randrange(60)),
+                   airframe=rng.choice(airframes))
+            for number in range(start, stop)
+        ], batch_size=self.batch_size)
+
+        flight_infos = []
+        for flight in flights:
+            departure, arrival = rng.sample(airport_codes, 2)
+            for status, code in ((FlightInfo.DEPARTURE, departure), (FlightInfo.ARRIVAL, arrival)):
+                flight_infos.append(FlightInfo(flight=flight, status=status, airport_code=code,
+                                               gate=str(rng.randrange(1, 40)),
+                                               is_boarding_bridge=rng.random() < 0.5,
+                                               schedule_time=time(rng.randrange(24), rng.randrange(60)),
+                                               runway=f'{rng.randint(1, 36):02}'))
+        FlightInfo.objects.bulk_create(flight_infos, batch_size=self.batch_size)
+
+        # Место i пассажира в общей очереди: поездка j пользователя u занимает место j * users + u,
+        # каждые passengers_per_flight мест - один рейс, поэтому на рейсе нет повторов пассажира
+        users_count = len(passengers)
+        total_slots = users_count * trips_per_user
+        trips = []
+        for index, flight in enumerate(flights):
+            first_slot = (start + index) * passengers_per_flight
+            for slot in range(first_slot, min(first_slot + passengers_per_flight, total_slots)):
+                passenger_id, username = passengers[slot % users_count]
+                trips.append(UserTrip(flight=flight,
+                                      passenger_id=passenger_id,
+                                      seat=f'{rng.randint(1, 40)}{rng.choice("ABCDEF")}',
+                                      price=rng.randint(1000, 50000),
+                                      slug=slugify(f'{flight.flight_number}-{flight.date}-{username}')))
+        trips = UserTrip.objects.bulk_create(trips, batch_size=self.batch_size)
+
+        meal_photo = self.get_placeholder('meal', (200, 160, 90))
+        track_photo = self.get_placeholder('track', (120, 180, 120))
+
+        meals = Meal.objects.bulk_create(
+            (Meal(trip=trip, drinks='Вода', main_course='Курица', meal_price=rng.randint(0, 1500),
+                  meal_photo=meal_photo)
+             for trip in trips if rng.random() < meal_ratio),
+            batch_size=self.batch_size
+        )
+        track_images = TrackImage.objects.bulk_create(
+            (TrackImage(trip=trip, track_img=track_photo) for trip in trips for _ in range(tracks_per_trip)),
+            batch_size=self.batch_size
+        )
+
+        return {
+            'flights': len(flights),
+            'flight_infos': len(flight_infos),
+            'trips': len(trips),
+            'meals': len(meals),
+            'track_images': len(track_images),
+        }
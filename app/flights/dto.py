@@ -0,0 +1,134 @@
+from dataclasses import dataclass
+from datetime import date, time
+from typing import Optional
+
+from django.contrib.auth.models import User
+from django.db.models import QuerySet
+from django.db.models.fields.files import FieldFile
+
+
+@dataclass(frozen=True)
+class FlightInfoDetails:
+    '''Вылет или прилет: поля FlightInfo без самой модели'''
+
+    id: Optional[int]
+    airport_code: Optional[str]
+    metar: Optional[str]
+    gate: Optional[str]
+    is_boarding_bridge: Optional[bool]
+    schedule_time: Optional[time]
+    actual_time: Optional[time]
+    runway: Optional[str]
+
+
+@dataclass(frozen=True)
+class FlightDetails:
+    '''Все данные страницы полета, загруженные FlightDetailService.load_flight_details'''
+
+    usertrip_id: int
+    usertripslug: str
+    user: User
+    seat: Optional[str]
+    neighbors: Optional[str]
+    comments: Optional[str]
+    ticket_price: Optional[int]
+
+    flight_id: int
+    flight_number: str
+    date: date
+    flight_time: Optional[time]
+
+    airframe_id: Optional[int]
+    registration_number: Optional[str]
+    serial_number: Optional[str]
+    airframe_photo: Optional[FieldFile]
+    airframe_renditions: dict
+    airline_id: Optional[int]
+    airline_name: Optional[str]
+    aircraft_type_id: Optional[int]
+    manufacturer: Optional[str]
+    generic_type: Optional[str]
+
+    meal_id: Optional[int]
+    drinks: Optional[str]
+    appertize: Optional[str]
+    main_course: Optional[str]
+    desert: Optional[str]
+    meal_price: Optional[int]
+    meal_photo: Optional[FieldFile]
+    meal_renditions: dict
+
+    departure_info: FlightInfoDetails
+    arrival_info: FlightInfoDetails
+
+    # Уже вычисленный queryset: повторный обход не обращается к БД, а формсет принимает его как есть
+    track_images: QuerySet
+
+    @property
+    def aircraft_type(self):
+        return ' '.join(filter(None, (self.manufacturer, self.generic_type)))
+
+    @property
+    def route(self):
+        return ' — '.join(filter(None, (self.departure_info.airport_code, self.arrival_info.airport_code)))
+
+    def as_dicts(self):
+        '''Данные в прежнем формате (flight_dict, files, id_dict) для форм и шаблонов'''
+
+        id_dict = {
+            'usertrip_id': self.usertrip_id,
+            'flight_id': self.flight_id,
+            'meal_id': self.meal_id,
+            'departure_id': self.departure_info.id,
+            'arrival_id': self.arrival_info.id,
+            'airframe_id': self.airframe_id,
+            'aircraft_type_id': self.aircraft_type_id,
+            'airline_id': self.airline_id,
+            **{f'track_image_{i}': track.id for i, track in enumerate(self.track_images)}
+        }
+
+        flight_dict = {
+            'usertripslug': self.usertripslug,
+
+            'registration_number': self.registration_number,
+            'serial_number': self.serial_number,
+            'airline_name': self.airline_name,
+
+            'flight_number': self.flight_number,
+            'date': self.date.strftime('%Y-%m-%d'),
+            'flight_time': self.flight_time,
+
+            'manufacturer': self.manufacturer,
+            'generic_type': self.generic_type,
+            'aircraft_type': self.aircraft_type,
+
+            'user': self.user,
+            'seat': self.seat,
+            'neighbors': self.neighbors,
+            'comments': self.comments,
+            'ticket_price': self.ticket_price,
+
+            'drinks': self.drinks,
+            'appertize': self.appertize,
+            'main_course': self.main_course,
+            'desert': self.desert,
+            'meal_price': self.meal_price,
+
+            'route': self.route,
+
+            'departure_info': self.departure_info,
+            'arrival_info': self.arrival_info,
+
+            **{f'departure_{name}': value for name, value in vars(self.departure_info).items() if name != 'id'},
+            **{f'arrival_{name}': value for name, value in vars(self.arrival_info).items() if name != 'id'},
+
+            'track_images': self.track_images,
+        }
+
+        files = {
+            'airframe_photo': self.airframe_photo,
+            'meal_photo': self.meal_photo,
+            **{f'track_image_{i}': track.track_img for i, track in enumerate(self.track_images)}
+        }
+
+        return flight_dict, files, id_dict
@@ -0,0 +1,103 @@
+import csv
+import json
+
+from django.core.serializers.json import DjangoJSONEncoder
+from django.db.models import FilteredRelation, Q
+from django.http import StreamingHttpResponse
+
+from .models import FlightInfo, UserTrip
+
+EXPORT_FORMATS = ('csv', 'jsonl', 'geojson')
+
+CONTENT_TYPES = {
+    'csv': 'text/csv; charset=utf-8',
+    'jsonl': 'application/x-ndjson',
+    'geojson': 'application/geo+json',
+}
+
+FLIGHT_INFO_FIELDS = ('airport_code', 'metar', 'gate', 'is_boarding_bridge', 'schedule_time', 'actual_time', 'runway')
+
+
+class Echo:
+    '''Псевдо-файл для csv.writer: write возвращает строку, а не пишет ее в буфер'''
+
+    def write(self, value):
+        return value
+
+
+class FlightLogExporter:
+    '''Потоковая выгрузка журнала полетов в CSV, JSONL или GeoJSON.
+    Вылет и прилет разворачиваются в колонки в SQL (FilteredRelation), строки читаются
+    QuerySet.iterator(chunk_size), поэтому память не зависит от размера журнала.
+    Колонки совпадают с полями FlightImportRowForm: выгрузку можно загрузить обратно import_flights'''
+
+    FIELDS = {
+        'flight_number': 'flight__flight_number',
+        'date': 'flight__date',
+        'flight_time': 'flight__flight_time',
+        'airline_name': 'flight__airframe__airline__name',
+        'manufacturer': 'flight__airframe__aircraft_type__manufacturer',
+        'generic_type': 'flight__airframe__aircraft_type__generic_type',
+        'serial_number': 'flight__airframe__serial_number',
+        'registration_number': 'flight__airframe__registration_number',
+        'seat': 'seat',
+        'neighbors': 'neighbors',
+        'comments': 'comments',
+        'ticket_price': 'price',
+        **{f'departure_{field}': f'departure__{field}' for field in FLIGHT_INFO_FIELDS},
+        **{f'arrival_{field}': f'arrival__{field}' for field in FLIGHT_INFO_FIELDS},
+    }
+
+    def __init__(self, trips=None, include_passenger=False, chunk_size=2000):
+        self.trips = UserTrip.objects.all() if trips is None else trips
+        self.chunk_size = chunk_size
+        self.fields = dict(self.FIELDS)
+        if include_passenger:
+            self.fields = {'passenger': 'passenger__username', **self.fields}
+
+    def get_rows(self):
+        names = list(self.fields)
+        rows = self.trips \
+            .annotate(departure=FilteredRelation('flight__flightinfo',
+                                                 condition=Q(flight__flightinfo__status=FlightInfo.DEPARTURE)),
+                      arrival=FilteredRelation('flight__flightinfo',
+                                               condition=Q(flight__flightinfo__status=FlightInfo.ARRIVAL))) \
+            .order_by('flight__date', 'pk') \
+            .values_list(*self.fields.values()) \
+            .iterator(chunk_size=self.chunk_size)
+
+        for row in rows:
+            yield dict(zip(names, row))
+
+    def stream(self, format):
+        return {
+            'csv': self.iter_csv,
+            'jsonl': self.iter_jsonl,
+            'geojson': self.iter_geojson,
+        }[format]()
+
+    def iter_csv(self):
+        writer = csv.writer(Echo())
+        yield writer.writerow(self.fields)
+        for row in self.get_rows():
+            yield writer.writerow('' if value is None else value for value in row.values())
+
+    def iter_jsonl(self):
+        for row in self.get_rows():
+            yield json.dumps(row, cls=DjangoJSONEncoder, ensure_ascii=False) + '\n'
+
+    def iter_geojson(self):
+        # Координат аэропортов в базе нет, поэтому geometry = null (RFC 7946, 3.2), маршрут - в properties
+        yield '{"type": "FeatureCollection", "features": [\n'
+        separator = ''
+        for row in self.get_rows():
+            feature = {'type': 'Feature', 'geometry': None, 'properties': row}
+            yield separator + json.dumps(feature, cls=DjangoJSONEncoder, ensure_ascii=False)
+            separator = ',\n'
+        yield '\n]}\n'
+
+
+def stream_flight_log(exporter, format, filename):
+    response = StreamingHttpResponse(exporter.stream(format), content_type=CONTENT_TYPES[format])
+    response['Content-Disposition'] = f'attachment; filename="{filename}.{format}"'
+    return response
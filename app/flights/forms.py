@@ -1,3 +1,4 @@
+import codecs
 from pprint import pprint
 from typing import Union
 
@@ -5,8 +6,9 @@ from django import forms
 from django.contrib.auth.models import User
 from django.core.exceptions import ObjectDoesNotExist
 from django.core.files.base import ContentFile
-from django.core.files.uploadedfile import InMemoryUploadedFile
-from django.db import transaction
+from django.core.files.uploadedfile import UploadedFile
+from django.db import models
+from django.db.models.fields.files import FieldFile
 from django.forms import formset_factory
 
 # from users.models import CustomUser
@@ -18,6 +20,8 @@ from .models import (Flight,
                      Meal,
                      FlightInfo,
                      TrackImage)
+from .services import FlightSaveService
+from .uploads import StagedUpload, UploadStager
 
 
 class MyFormMixin:
@@ -27,7 +31,7 @@ class MyFormMixin:
         data_without_photo = data.copy()
 
         for key, value in data.items():
-            if isinstance(value, InMemoryUploadedFile):
+            if isinstance(value, (UploadedFile, StagedUpload)):
                 del data_without_photo[key]
 
         return data_without_photo
@@ -36,30 +40,79 @@ class MyFormMixin:
     def update_create_delete_data(self, model, data: dict, id: Union[int, None]):
 
         if id is None:
-            # Создаем новую запись в бд (либо берем уже существующую, если она присутствует)
-            try:
-                # Попытка получить запись с использованием урезанного словаря data_without_photo
-                instance = model.objects.get(**self.get_data_without_files(data))
-            except Exception:
-                # Создаем новую запись, т.к. в бд нет такой записи
-                instance = model.objects.create(**data)
+            # Создаем новую запись в бд (либо берем уже существующую, если она присутствует).
+            # get_or_create ищет по данным без файлов и при параллельной вставке перечитывает запись
+            lookup = self.get_data_without_files(data)
+            files = {key: value for key, value in data.items() if key not in lookup}
+            instance, created = model.objects.get_or_create(
+                defaults={key: str(value) if isinstance(value, StagedUpload) else value for key, value in files.items()},
+                **lookup
+            )
+            if created:
+                for value in files.values():
+                    if isinstance(value, StagedUpload):
+                        value.bind(instance)
 
         if id is not None:
-            try:
-                instance = model.objects.get(pk=id)
-                if data:
-                    # Обновляем существующую запись. Если словарь data непустой, то это update
-                    instance = model(pk=id, **data)
-                    instance.save()
-                else:
-                    # Удаляем существующую запись. Если словарь data пустой, то это delete
-                    instance.delete()
-            except Exception:
+            instance = model.objects.filter(pk=id).first()
+            if instance is None:
                 # Запись не найдена
-                instance = None
+                return None
+
+            if data:
+                # Обновляем существующую запись. Если словарь data непустой, то это update
+                changed_fields = self.update_changed_fields(instance, data)
+                self.changed_fields[model._meta.label] = changed_fields
+            else:
+                # Удаляем существующую запись. Если словарь data пустой, то это delete
+                instance.delete()
 
         return instance
 
+    @property
+    def changed_fields(self):
+        '''Измененные при сохранении формы поля по моделям: {'flights.Meal': ['drinks'], ...}'''
+
+        if '_changed_fields' not in self.__dict__:
+            self._changed_fields = {}
+        return self._changed_fields
+
+    @staticmethod
+    def is_field_changed(instance, field, value):
+        if isinstance(field, models.FileField):
+            if isinstance(value, FieldFile):
+                return (value.name or '') != (getattr(instance, field.attname).name or '')
+            if value:
+                # Новый загруженный файл записывается всегда, даже под тем же именем
+                return True
+            return bool(getattr(instance, field.attname))
+
+        if field.is_relation:
+            value = value.pk if isinstance(value, models.Model) else value
+        return getattr(instance, field.attname) != value
+
+    def update_changed_fields(self, instance, data: dict):
+        '''Сравнивает data с загруженной записью и записывает одним UPDATE только измененные столбцы.
+        Если ничего не изменилось, запись в БД не выполняется (и сигналы сохранения не вызываются).
+        Возвращает список измененных полей'''
+
+        changed_fields = []
+        for name, value in data.items():
+            field = instance._meta.get_field(name)
+            if isinstance(value, StagedUpload):
+                # Файл подготовлен вне транзакции, в строку пишется только имя (см. flights/uploads.py)
+                value = value.bind(instance)
+            if self.is_field_changed(instance, field, value):
+                changed_fields.append(name)
+                setattr(instance, name, value)
+            elif field.is_relation and isinstance(value, models.Model):
+                # Связанный объект уже загружен: путь загрузки файла не запросит его повторно
+                setattr(instance, name, value)
+
+        if changed_fields:
+            instance.save(update_fields=changed_fields)
+        return changed_fields
+
 
 class AircraftTypeForm(forms.Form, MyFormMixin):
     manufacturer = forms.CharField(widget=forms.TextInput(attrs={'list': 'manufacturer_choices'}))
@@ -291,20 +344,45 @@ class ArrivalFlightInfoForm(forms.Form, MyFormMixin):
         return self.update_create_delete_data(FlightInfo, data_for_flight_info, arrival_id)
 
 
-class TrackImageForm(forms.ModelForm):
-    class Meta:
-        model = TrackImage
-        fields = '__all__'
+class MultipleFileInput(forms.FileInput):
+    allow_multiple_selected = True
+
+    def value_from_datadict(self, data, files, name):
+        return files.getlist(name)
+
+
+class MultipleImageField(forms.ImageField):
+    '''ImageField для нескольких файлов в одном поле. cleaned_data - список загрузок'''
+
+    def __init__(self, *args, **kwargs):
+        kwargs.setdefault('widget', MultipleFileInput())
+        super().__init__(*args, **kwargs)
 
-    def save(self, trip: UserTrip, commit=False):
-        track_image_instance = super().save(commit=False)
+    def clean(self, data, initial=None):
+        single_file_clean = super().clean
+        if isinstance(data, (list, tuple)):
+            return [single_file_clean(file, initial) for file in data if file]
+        return [single_file_clean(data, initial)] if data else []
 
-        track_image_instance.trip = trip
 
-        if commit:
-            track_image_instance.save()
+class TrackImagesForm(forms.Form):
+    '''Изображения трэков путешествия: любое число новых файлов и отметки удаления уже загруженных.
+    Число файлов в запросе ограничено настройкой DATA_UPLOAD_MAX_NUMBER_FILES'''
 
-        return track_image_instance
+    track_images = MultipleImageField(label='Фото трэков', required=False)
+    delete_track_images = forms.TypedMultipleChoiceField(label='Удалить', coerce=int, required=False,
+                                                         widget=forms.CheckboxSelectMultiple)
+
+    def __init__(self, *args, track_images=(), **kwargs):
+        super().__init__(*args, **kwargs)
+        # Уже загруженные изображения (FlightDetails.track_images): удалить можно только их
+        self.fields['delete_track_images'].choices = [(image.pk, image.track_img.name) for image in track_images]
+
+    def stage_files(self, stager: UploadStager, trip: UserTrip):
+        '''Записывает новые файлы в каталог подготовки до начала транзакции.
+        trip может быть несохраненным: нужны только поля для upload_to'''
+
+        return stager.stage_many(self.cleaned_data['track_images'], TrackImage(trip=trip), 'track_img')
 
 
 # class TrackImageForm(forms.Form, MyFormMixin):
@@ -360,34 +438,102 @@ class AddFlightForm(AircraftTypeForm,
                     forms.Form
                     ):
 
+    # Число запросов к БД последнего save() нового путешествия
+    round_trips = None
+
+    def stage_files(self, stager: UploadStager, user: User):
+        '''Записывает новые загрузки формы в каталог подготовки до начала транзакции
+        и заменяет их в cleaned_data на StagedUpload. Имена строятся по данным формы,
+        поэтому совпадают с теми, что дал бы upload_to при сохранении.
+        Возвращает несохраненное путешествие для имен файлов треков'''
+
+        data = self.cleaned_data
+        trip = UserTrip(flight=Flight(flight_number=data['flight_number'], date=data['date']), passenger=user)
+        targets = {
+            'airframe_photo': (Airframe(registration_number=data['registration_number'],
+                                        airline=Airline(name=data['airline_name'])), 'photo'),
+            'meal_photo': (Meal(trip=trip), 'meal_photo'),
+        }
+
+        for form_field, (instance, model_field) in targets.items():
+            if isinstance(data.get(form_field), UploadedFile):
+                data[form_field] = stager.stage(data[form_field], instance, model_field)
+
+        return trip
+
     def save(self, user: User, **kwargs):
-        with transaction.atomic():
-            aircraft_type_id = kwargs.get('aircraft_type_id')
-            airline_id = kwargs.get('airline_id')
-            airframe_id = kwargs.get('airframe_id')
-            flight_id = kwargs.get('flight_id')
-            usertrip_id = kwargs.get('usertrip_id')
-            meal_id = kwargs.get('meal_id')
-            departure_id = kwargs.get('departure_id')
-            arrival_id = kwargs.get('arrival_id')
-
-            # tab1
-            aircraft_type_instance = self.save_aircraft_type(aircraft_type_id)
-            airline_instance = self.save_airline(airline_id)
-            airframe_instance = self.save_airframe(aircraft_type_instance, airline_instance, airframe_id)
-            flight_instance = self.save_flight(airframe_instance, flight_id)
-
-            # tab2
-            user_trip_instance = self.save_user_trip(flight_instance, user, usertrip_id)
-
-            # tab3
-            meal_instance = self.save_meal(user_trip_instance, meal_id)
-
-            # tab4
-            departure_flight_info_instance = self.save_departure_flight_info(flight_instance, departure_id)
-            arrival_flight_info_instance = self.save_arrival_flight_info(flight_instance, arrival_id)
-
-            # tab5
-            # track_image_instances = self.save_track_images(user_trip_instance, track_image_ids)
-
-            return user_trip_instance
+        # Представление обычно уже подготовило файлы в своем UploadStager, тогда здесь готовить нечего
+        with UploadStager() as stager:
+            self.stage_files(stager, user)
+            with stager.atomic():
+                return self.save_rows(user, **kwargs)
+
+    def save_rows(self, user: User, **kwargs):
+        if not any(kwargs.values()):
+            # Новое путешествие: записи ищутся и создаются по уникальным ключам без гонок (см. FlightSaveService)
+            trip, self.round_trips = FlightSaveService.create(user, self.cleaned_data)
+            return trip
+
+        aircraft_type_id = kwargs.get('aircraft_type_id')
+        airline_id = kwargs.get('airline_id')
+        airframe_id = kwargs.get('airframe_id')
+        flight_id = kwargs.get('flight_id')
+        usertrip_id = kwargs.get('usertrip_id')
+        meal_id = kwargs.get('meal_id')
+        departure_id = kwargs.get('departure_id')
+        arrival_id = kwargs.get('arrival_id')
+
+        # tab1
+        aircraft_type_instance = self.save_aircraft_type(aircraft_type_id)
+        airline_instance = self.save_airline(airline_id)
+        airframe_instance = self.save_airframe(aircraft_type_instance, airline_instance, airframe_id)
+        flight_instance = self.save_flight(airframe_instance, flight_id)
+
+        # tab2
+        user_trip_instance = self.save_user_trip(flight_instance, user, usertrip_id)
+
+        # tab3
+        meal_instance = self.save_meal(user_trip_instance, meal_id)
+
+        # tab4
+        departure_flight_info_instance = self.save_departure_flight_info(flight_instance, departure_id)
+        arrival_flight_info_instance = self.save_arrival_flight_info(flight_instance, arrival_id)
+
+        # tab5
+        # track_image_instances = self.save_track_images(user_trip_instance, track_image_ids)
+
+        return user_trip_instance
+
+
+class FlightImportRowForm(AircraftTypeForm,
+                          AirlineForm,
+                          FlightForm,
+                          UserTripForm,
+                          DepartureFlightInfoForm,
+                          ArrivalFlightInfoForm,
+                          forms.Form
+                          ):
+    '''Проверка одной строки журнала полетов при импорте (поля как в AddFlightForm, без файлов и питания)'''
+
+    serial_number = forms.CharField(max_length=50)
+    registration_number = forms.CharField(max_length=50)
+
+
+class FlightImportForm(forms.Form):
+    file = forms.FileField(label='Flight log (.csv or .jsonl)')
+
+    def clean_file(self):
+        file = self.cleaned_data['file']
+        if not file.name.lower().endswith(('.csv', '.jsonl')):
+            raise forms.ValidationError('Only .csv and .jsonl files are supported')
+
+        # Кодировка проверяется до импорта: ошибка декодирования посреди файла оставила бы часть пачек в базе
+        decoder = codecs.getincrementaldecoder('utf-8-sig')()
+        try:
+            for chunk in file.chunks():
+                decoder.decode(chunk)
+            decoder.decode(b'', final=True)
+        except UnicodeDecodeError as error:
+            raise forms.ValidationError(f'The file is not valid UTF-8: {error.reason}')
+        file.seek(0)
+        return file
@@ -0,0 +1,58 @@
+from contextlib import contextmanager
+from contextvars import ContextVar
+
+_identity_map = ContextVar('identity_map', default=None)
+
+
+class RequestIdentityMap:
+    '''Карта загруженных объектов в пределах одного запроса.
+    Область действия открывает IdentityMapMiddleware, вне запроса (тесты, команды)
+    загрузка выполняется каждый раз заново'''
+
+    @staticmethod
+    @contextmanager
+    def scope():
+        token = _identity_map.set({})
+        try:
+            yield
+        finally:
+            _identity_map.reset(token)
+
+    @staticmethod
+    def get_or_load(key, loader):
+        identity_map = _identity_map.get()
+        if identity_map is None:
+            return loader()
+
+        if key not in identity_map:
+            identity_map[key] = loader()
+
+        return identity_map[key]
+
+    @staticmethod
+    def get_or_load_many(keys, loader):
+        '''get_or_load для пачки ключей: loader получает список еще не загруженных ключей
+        и возвращает словарь ключ -> объект для каждого из них'''
+
+        identity_map = _identity_map.get()
+        if identity_map is None:
+            return loader(list(keys))
+
+        missing = [key for key in keys if key not in identity_map]
+        if missing:
+            identity_map.update(loader(missing))
+
+        return {key: identity_map[key] for key in keys}
+
+    @staticmethod
+    def discard(keys):
+        identity_map = _identity_map.get()
+        if identity_map is not None:
+            for key in keys:
+                identity_map.pop(key, None)
+
+    @staticmethod
+    def clear():
+        identity_map = _identity_map.get()
+        if identity_map is not None:
+            identity_map.clear()
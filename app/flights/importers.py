@@ -0,0 +1,254 @@
+import csv
+import json
+from collections import Counter
+from itertools import islice
+
+from django.db import DatabaseError, transaction
+from django.utils.text import slugify
+
+from .cache import HomePageCache
+from .forms import FlightImportRowForm
+from .models import AircraftType, Airline, Airframe, Flight, FlightInfo, SiteCounter, UserTrip
+from .services import FlightSaveService, PassengerStatsService, SiteCounterService, TripCardService
+from .upsert import insert_new
+
+FORMATS = ('csv', 'jsonl')
+
+
+def get_format(filename):
+    extension = filename.rsplit('.', 1)[-1].lower()
+    if extension not in FORMATS:
+        raise ValueError(f'Unsupported format: {extension}')
+    return extension
+
+
+def parse_csv(lines):
+    reader = csv.DictReader(lines)
+    for row in reader:
+        # Номер строки файла с учетом заголовка
+        yield reader.line_num, row
+
+
+def parse_jsonl(lines):
+    for line_number, line in enumerate(lines, start=1):
+        if not line.strip():
+            continue
+        try:
+            row = json.loads(line)
+        except ValueError as error:
+            yield line_number, error
+            continue
+        yield line_number, row if isinstance(row, dict) else ValueError('Expected a JSON object')
+
+
+def batched(iterable, size):
+    iterator = iter(iterable)
+    while batch := list(islice(iterator, size)):
+        yield batch
+
+
+class FlightLogImporter:
+    '''Потоковый импорт журнала полетов одного пассажира из CSV или JSONL.
+    Строки читаются генератором и проверяются FlightImportRowForm, затем пачками по batch_size
+    вставляются bulk_create(ignore_conflicts=True) и insert_new в отдельных транзакциях. Авиакомпании, типы ВС,
+    борта и рейсы ищутся через словари-кэши, поэтому каждая пачка обходится фиксированным числом
+    запросов. Ошибочная строка попадает в errors и не останавливает импорт остальных.
+    bulk_create не вызывает сигналы, поэтому карточки, статистика и счетчики сайта обновляются здесь'''
+
+    def __init__(self, user, batch_size=500):
+        self.user = user
+        self.batch_size = batch_size
+
+        self.airlines = {}
+        self.aircraft_types = {}
+        self.airframes = {}
+        self.flights = {}
+        # Рейсы, на которые путешествие пассажира уже есть (в базе или выше в файле)
+        self.trip_flights = set()
+
+        self.errors = []
+        self.stats = Counter(rows=0, imported=0, skipped=0, errors=0)
+
+    def run(self, lines, format):
+        parse = parse_csv if format == 'csv' else parse_jsonl
+
+        for batch in batched(self.validate(parse(lines)), self.batch_size):
+            self.import_rows(batch)
+
+        return self.stats
+
+    def add_error(self, line_number, message):
+        self.errors.append((line_number, message))
+        self.stats['errors'] += 1
+
+    def validate(self, rows):
+        for line_number, row in rows:
+            self.stats['rows'] += 1
+
+            if isinstance(row, Exception):
+                self.add_error(line_number, str(row))
+                continue
+
+            form = FlightImportRowForm(data=row)
+            if not form.is_valid():
+                self.add_error(line_number, '; '.join(
+                    f'{field}: {" ".join(errors)}' for field, errors in form.errors.items()
+                ))
+                continue
+
+            yield line_number, form.cleaned_data
+
+    def get_state(self):
+        return [self.airlines, self.aircraft_types, self.airframes, self.flights, self.trip_flights, self.stats]
+
+    def import_rows(self, rows):
+        # После отката в кэшах не должно остаться id строк, которых нет в базе
+        saved_state = [state.copy() for state in self.get_state()]
+        try:
+            with transaction.atomic():
+                self.import_batch(rows)
+        except DatabaseError as error:
+            (self.airlines, self.aircraft_types, self.airframes,
+             self.flights, self.trip_flights, self.stats) = saved_state
+
+            if len(rows) == 1:
+                self.add_error(rows[0][0], str(error))
+                return
+
+            # Находим строку, из-за которой упала пачка, остальные импортируем по одной
+            for row in rows:
+                self.import_rows([row])
+
+    @staticmethod
+    def resolve(model, cache, fields, objects):
+        '''Возвращает id объектов model по ключу fields, недостающие создает одним bulk_create.
+        objects - словарь {ключ: функция, строящая новый объект}.
+        Возвращает множество ключей, для которых создавались объекты'''
+
+        missing = [key for key in objects if key not in cache]
+        if not missing:
+            return set()
+
+        def load():
+            rows = model.objects \
+                .filter(**{f'{fields[0]}__in': {key[0] for key in missing}}) \
+                .values_list('pk', *fields)
+            wanted = set(missing)
+            for pk, *key in rows:
+                if tuple(key) in wanted:
+                    cache[tuple(key)] = pk
+
+        load()
+        created = [key for key in missing if key not in cache]
+        if created:
+            # ignore_conflicts не возвращает первичные ключи, поэтому перечитываем
+            model.objects.bulk_create([objects[key]() for key in created], ignore_conflicts=True)
+            load()
+
+        return set(created)
+
+    def import_batch(self, rows):
+        rows = [data for _, data in rows]
+
+        self.resolve(Airline, self.airlines, ('name',), {
+            (data['airline_name'],): (lambda data=data: Airline(name=data['airline_name']))
+            for data in rows
+        })
+        self.resolve(AircraftType, self.aircraft_types, ('manufacturer', 'generic_type'), {
+            (data['manufacturer'], data['generic_type']): (
+                lambda data=data: AircraftType(manufacturer=data['manufacturer'],
+                                               generic_type=data['generic_type'])
+            )
+            for data in rows
+        })
+        self.resolve(Airframe, self.airframes, ('serial_number', 'registration_number'), {
+            (data['serial_number'], data['registration_number']): (
+                lambda data=data: Airframe(
+                    serial_number=data['serial_number'],
+                    registration_number=data['registration_number'],
+                    airline_id=self.airlines[(data['airline_name'],)],
+                    aircraft_type_id=self.aircraft_types[(data['manufacturer'], data['generic_type'])],
+                )
+            )
+            for data in rows
+        })
+        new_flights = self.resolve(Flight, self.flights, ('flight_number', 'date'), {
+            (data['flight_number'], data['date']): (
+                lambda data=data: Flight(
+                    flight_number=data['flight_number'],
+                    date=data['date'],
+                    flight_time=data['flight_time'],
+                    airframe_id=self.airframes[(data['serial_number'], data['registration_number'])],
+                )
+            )
+            for data in rows
+        })
+
+        # Вылет и прилет нового рейса берем из первой строки с этим рейсом
+        first_rows = {}
+        for data in rows:
+            first_rows.setdefault((data['flight_number'], data['date']), data)
+
+        flight_infos = []
+        for key in new_flights:
+            flight_infos.extend(FlightSaveService.build_flight_infos(self.flights[key], first_rows[key]))
+        # Рейс мог одновременно добавить другой импорт: в счетчики попадают только вставленные здесь записи
+        flight_infos = insert_new(FlightInfo, flight_infos, ('flight_id', 'status'))
+
+        self.trip_flights.update(
+            UserTrip.objects
+            .filter(passenger=self.user, flight_id__in=[self.flights[key] for key in first_rows])
+            .values_list('flight_id', flat=True)
+        )
+
+        trips = []
+        for data in rows:
+            flight_id = self.flights[(data['flight_number'], data['date'])]
+            if flight_id in self.trip_flights:
+                self.stats['skipped'] += 1
+                continue
+
+            self.trip_flights.add(flight_id)
+            trips.append(UserTrip(
+                flight_id=flight_id,
+                passenger=self.user,
+                seat=data['seat'],
+                neighbors=data['neighbors'],
+                comments=data['comments'],
+                price=data['ticket_price'],
+                slug=slugify(f"{data['flight_number']}-{data['date']}-{self.user.username}"),
+            ))
+        inserted = insert_new(UserTrip, trips, ('flight_id', 'passenger_id'))
+        self.stats['imported'] += len(inserted)
+        self.stats['skipped'] += len(trips) - len(inserted)
+        trips = inserted
+
+        self.refresh_read_models([trip.flight_id for trip in trips], flight_infos)
+
+    def refresh_read_models(self, flight_ids, flight_infos):
+        if flight_ids:
+            TripCardService.refresh(UserTrip.objects.filter(passenger=self.user, flight_id__in=flight_ids))
+            PassengerStatsService.refresh([self.user.pk])
+
+        if flight_infos:
+            airframes = dict(
+                Flight.objects
+                .filter(pk__in={info.flight_id for info in flight_infos})
+                .values_list('pk', 'airframe_id')
+            )
+            airframe_references = {
+                row['pk']: SiteCounterService.get_airframe_references(row['pk'], row['airline_id'],
+                                                                      row['aircraft_type_id'])
+                for row in Airframe.objects.filter(pk__in=set(airframes.values())).values(
+                    'pk', 'airline_id', 'aircraft_type_id'
+                )
+            }
+
+            references = Counter()
+            for info in flight_infos:
+                references[(SiteCounter.AIRPORT, info.airport_code)] += 1
+                references.update(airframe_references.get(airframes[info.flight_id], {}))
+            SiteCounterService.adjust(added=references)
+
+        if flight_ids or flight_infos:
+            transaction.on_commit(HomePageCache.bump_generation)
@@ -0,0 +1,132 @@
+import logging
+import random
+import time
+from datetime import timedelta
+
+from django.db import transaction
+from django.utils import timezone
+
+from .models import Job
+
+logger = logging.getLogger('flights.jobs')
+
+# Имя задачи -> функция, принимающая аргументы из Job.payload
+TASKS = {}
+
+
+def task(name):
+    '''Регистрирует функцию как фоновую задачу с именем name'''
+
+    def decorator(func):
+        TASKS[name] = func
+        return func
+
+    return decorator
+
+
+def enqueue(kind, **payload):
+    '''Ставит задачу в очередь после коммита текущей транзакции.
+    При откате задача не создается: воркер не увидит ссылок на несохраненные данные
+    и не удалит файлы, которые после отката снова нужны'''
+
+    if kind not in TASKS:
+        raise KeyError(f'Unknown job {kind!r}')
+
+    transaction.on_commit(lambda: Job.objects.create(kind=kind, payload=payload))
+
+
+def enqueue_many(kind, payloads):
+    '''Как enqueue, но задачи создаются после коммита одним bulk_create'''
+
+    if kind not in TASKS:
+        raise KeyError(f'Unknown job {kind!r}')
+
+    payloads = list(payloads)
+    if payloads:
+        transaction.on_commit(lambda: Job.objects.bulk_create([Job(kind=kind, payload=payload) for payload in payloads]))
+
+
+class JobWorker:
+    '''Воркер очереди в таблице Job без брокера сообщений.
+    Задачи выбираются SELECT ... FOR UPDATE SKIP LOCKED, поэтому несколько воркеров не получат
+    одну задачу и не ждут друг друга. Блокировка держится до конца транзакции, в которой задачи выполняются:
+    если воркер упадет, строки освободятся и задачи достанутся другому.
+    Каждая задача выполняется в точке сохранения; при ошибке ее изменения откатываются,
+    а задача откладывается с экспоненциальной задержкой'''
+
+    BACKOFF_BASE = 10
+    BACKOFF_MAX = 60 * 60
+
+    def __init__(self, batch_size=10):
+        self.batch_size = batch_size
+
+    @classmethod
+    def get_backoff(cls, attempts):
+        delay = min(cls.BACKOFF_BASE * 2 ** (attempts - 1), cls.BACKOFF_MAX)
+        # Разброс, чтобы упавшие вместе задачи не повторялись одновременно
+        return timedelta(seconds=delay * random.uniform(0.9, 1.1))
+
+    def claim(self):
+        return list(
+            Job.objects
+            .select_for_update(skip_locked=True)
+            .filter(status=Job.QUEUED, run_after__lte=timezone.now())
+            .order_by('run_after', 'pk')[:self.batch_size]
+        )
+
+    def run_batch(self):
+        '''Выполняет одну пачку задач. Возвращает число выбранных задач'''
+
+        with transaction.atomic():
+            jobs = self.claim()
+
+            done = []
+            for job in jobs:
+                if self.run_job(job):
+                    done.append(job.pk)
+
+            Job.objects.filter(pk__in=done).delete()
+
+        return len(jobs)
+
+    def run_job(self, job):
+        func = TASKS.get(job.kind)
+        if func is None:
+            self.fail(job, KeyError(f'Unknown job {job.kind!r}'), permanent=True)
+            return False
+
+        started = time.perf_counter()
+        try:
+            with transaction.atomic():
+                func(**job.payload)
+        except Exception as error:
+            self.fail(job, error)
+            return False
+
+        logger.info('Job %s #%s done in %.1f ms', job.kind, job.pk, (time.perf_counter() - started) * 1000)
+        return True
+
+    def fail(self, job, error, permanent=False):
+        job.attempts += 1
+        job.last_error = f'{type(error).__name__}: {error}'
+
+        if permanent or job.attempts >= job.max_attempts:
+            job.status = Job.FAILED
+            logger.error('Job %s #%s failed after %s attempts: %s', job.kind, job.pk, job.attempts, job.last_error)
+        else:
+            job.run_after = timezone.now() + self.get_backoff(job.attempts)
+            logger.warning('Job %s #%s failed (attempt %s), retry at %s: %s',
+                           job.kind, job.pk, job.attempts, job.run_after, job.last_error)
+
+        job.save(update_fields=['attempts', 'last_error', 'status', 'run_after'])
+
+    def run_pending(self, max_jobs=None):
+        '''Выполняет задачи, пока очередь не опустеет. Возвращает число обработанных задач'''
+
+        total = 0
+        while max_jobs is None or total < max_jobs:
+            count = self.run_batch()
+            if not count:
+                break
+            total += count
+        return total
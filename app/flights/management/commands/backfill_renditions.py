@@ -0,0 +1,109 @@
+import os
+import time
+from collections import defaultdict
+from concurrent.futures import ProcessPoolExecutor
+
+from django.core.management.base import BaseCommand
+from django.db import connections, transaction
+
+from flights.cache import HomePageCache
+from flights.models import Airframe, Meal, TrackImage, UserTrip
+from flights.renditions import is_current, render_renditions_safe, save_renditions
+from flights.services import TripCardService
+
+MODELS = {
+    'airframe': Airframe,
+    'meal': Meal,
+    'track': TrackImage,
+}
+
+
+class Command(BaseCommand):
+    help = 'Generates missing image renditions for existing airframe, meal and track photos in a process pool'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--model', action='append', choices=list(MODELS),
+                            help='Process only these models (default: all)')
+        parser.add_argument('--workers', type=int, default=os.cpu_count(),
+                            help='Number of worker processes, 1 renders in this process')
+        parser.add_argument('--batch-size', type=int, default=500)
+        parser.add_argument('--force', action='store_true', help='Regenerate renditions that are up to date')
+
+    def handle(self, *args, **options):
+        started = time.perf_counter()
+        models = [MODELS[name] for name in options['model'] or MODELS]
+
+        # Один файл может быть у многих записей (заглушки синтетических данных), он обрабатывается один раз
+        pending = {model: self.get_pending(model, options['force']) for model in models}
+        names = sorted({name for rows in pending.values() for name in rows})
+        self.stdout.write(f'Images to render: {len(names)}')
+
+        registries = {}
+        errors = 0
+        for name, rendered, error in self.render(names, options['workers']):
+            if error:
+                errors += 1
+                self.stderr.write(f'{name}: {error}')
+                continue
+            # Процессы пула только создают копии в памяти, в хранилище их записывает этот процесс
+            registries[name] = save_renditions(*rendered)
+
+            if len(registries) % 100 == 0:
+                self.stdout.write(f'Rendered {len(registries)}/{len(names)}')
+
+        updated = 0
+        for model, rows in pending.items():
+            updated += self.save(model, rows, registries, options['batch_size'])
+
+        if updated:
+            HomePageCache.bump_generation()
+
+        self.stdout.write(self.style.SUCCESS(
+            f'Rendered {len(registries)} images for {updated} rows in {time.perf_counter() - started:.1f} s, '
+            f'errors: {errors}'
+        ))
+
+    @staticmethod
+    def get_pending(model, force):
+        field = model.IMAGE_FIELD
+        rows = model.objects \
+            .exclude(**{f'{field}__isnull': True}) \
+            .exclude(**{field: ''}) \
+            .order_by('pk') \
+            .values_list('pk', field, 'renditions') \
+            .iterator(chunk_size=2000)
+
+        pending = defaultdict(list)
+        for pk, name, renditions in rows:
+            if force or not is_current(renditions or {}, name):
+                pending[name].append(pk)
+        return pending
+
+    @staticmethod
+    def render(names, workers):
+        if workers <= 1 or len(names) <= 1:
+            yield from map(render_renditions_safe, names)
+            return
+
+        # Дочерние процессы не должны унаследовать открытые соединения с БД
+        for connection in connections.all():
+            if not connection.in_atomic_block:
+                connection.close()
+        with ProcessPoolExecutor(max_workers=workers) as executor:
+            yield from executor.map(render_renditions_safe, names, chunksize=max(1, len(names) // (workers * 4)))
+
+    @staticmethod
+    def save(model, rows, registries, batch_size):
+        objects = [model(pk=pk, renditions=registries[name])
+                   for name, pks in rows.items() if name in registries
+                   for pk in pks]
+
+        for start in range(0, len(objects), batch_size):
+            batch = objects[start:start + batch_size]
+            with transaction.atomic():
+                # bulk_update не вызывает сигналы, поэтому карточки с фото борта обновляются здесь
+                model.objects.bulk_update(batch, ['renditions'])
+                if model is Airframe:
+                    TripCardService.refresh(UserTrip.objects.filter(flight__airframe__in=[obj.pk for obj in batch]))
+
+        return len(objects)
@@ -0,0 +1,32 @@
+from django.core.management.base import BaseCommand
+from django.db import transaction
+
+from flights.models import UserTrip, TripCard
+from flights.services import TripCardService
+
+
+class Command(BaseCommand):
+    help = 'Fills the TripCard read model from existing user trips'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--batch-size', type=int, default=1000)
+
+    def handle(self, *args, **options):
+        batch_size = options['batch_size']
+        trip_ids = UserTrip.objects.order_by('pk').values_list('pk', flat=True)
+
+        total = 0
+        last_id = 0
+        while True:
+            batch = list(trip_ids.filter(pk__gt=last_id)[:batch_size])
+            if not batch:
+                break
+
+            with transaction.atomic():
+                total += TripCardService.refresh(UserTrip.objects.filter(pk__in=batch))
+
+            last_id = batch[-1]
+
+        self.stdout.write(self.style.SUCCESS(
+            f'Trip cards refreshed: {total}, stored: {TripCard.objects.count()}'
+        ))
@@ -0,0 +1,94 @@
+import shutil
+import tempfile
+from io import StringIO
+
+from django.core.management import call_command
+from django.core.management.base import BaseCommand
+from django.db import connection
+from django.test.utils import override_settings, setup_test_environment, teardown_test_environment
+
+from benchmarks import BenchmarkRunner, save_report
+from benchmarks.cases import get_sample, get_service_cases, get_view_cases
+from benchmarks.report import build_report
+from django.contrib.auth.models import User
+from flights.dataset import DatasetGenerator
+from flights.services import SiteCounterService
+
+
+class Command(BaseCommand):
+    help = 'Benchmarks services and views at several dataset sizes on a throwaway test database'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--scales', type=int, nargs='+', default=[1000, 10000, 100000],
+                            help='Dataset sizes in users, each with --trips-per-user trips')
+        parser.add_argument('--repeat', type=int, default=30)
+        parser.add_argument('--warmup', type=int, default=3)
+        parser.add_argument('--seed', type=int, default=42)
+        parser.add_argument('--trips-per-user', type=int, default=3)
+        parser.add_argument('--only', choices=['services', 'views'], help='Run only one group of cases')
+        parser.add_argument('--output', default='benchmark.json', help='Path of the JSON report')
+        parser.add_argument('--baseline', help='JSON report of a previous run to compare with')
+
+    def handle(self, *args, **options):
+        old_name = connection.settings_dict['NAME']
+        media_root = tempfile.mkdtemp(prefix='aviablog_benchmark_')
+        isolated = override_settings(
+            MEDIA_ROOT=media_root,
+            CACHES={'default': {'BACKEND': 'django.core.cache.backends.locmem.LocMemCache'}},
+        )
+
+        setup_test_environment()
+        isolated.enable()
+        connection.creation.create_test_db(verbosity=0, autoclobber=True, serialize=False)
+        try:
+            results = self.run_scales(options)
+        finally:
+            connection.creation.destroy_test_db(old_name, verbosity=0)
+            isolated.disable()
+            teardown_test_environment()
+            shutil.rmtree(media_root, ignore_errors=True)
+
+        report = build_report(results, seed=options['seed'], repeat=options['repeat'],
+                              warmup=options['warmup'], trips_per_user=options['trips_per_user'])
+        save_report(report, options['output'])
+        self.stdout.write(self.style.SUCCESS(f"Report written to {options['output']}"))
+
+        if options['baseline']:
+            call_command('benchmark_diff', options['baseline'], options['output'], stdout=self.stdout)
+
+    def run_scales(self, options):
+        runner = BenchmarkRunner(repeat=options['repeat'], warmup=options['warmup'], seed=options['seed'])
+        results = {}
+        users = 0
+
+        for scale in sorted(options['scales']):
+            self.seed(scale - users, options, prefix=f's{scale}')
+            users = scale
+
+            sample = get_sample(200, runner.rng)
+            owner = User.objects.filter(usertrip__meal__isnull=False).order_by('pk').first()
+
+            cases = {}
+            if options['only'] != 'views':
+                cases.update(get_service_cases(sample))
+            if options['only'] != 'services':
+                cases.update(get_view_cases(sample, owner))
+
+            trips = scale * options['trips_per_user']
+            self.stdout.write(self.style.MIGRATE_HEADING(f'Users: {scale}, trips: {trips}'))
+            results[str(scale)] = runner.run(cases, log=self.stdout.write)
+
+        return results
+
+    def seed(self, users, options, prefix):
+        if users <= 0:
+            return
+
+        generator = DatasetGenerator(seed=options['seed'], prefix=prefix)
+        generator.generate(users=users, trips_per_user=options['trips_per_user'])
+
+        # Данные вставлены bulk_create без сигналов
+        quiet = StringIO()
+        call_command('backfill_trip_cards', batch_size=5000, stdout=quiet)
+        call_command('rebuild_passenger_stats', batch_size=5000, stdout=quiet)
+        SiteCounterService.reconcile()
@@ -0,0 +1,31 @@
+from django.core.management.base import BaseCommand, CommandError
+
+from benchmarks import compare_reports, load_report
+
+
+class Command(BaseCommand):
+    help = 'Compares two benchmark JSON reports and fails on latency or query count regressions'
+
+    def add_arguments(self, parser):
+        parser.add_argument('baseline')
+        parser.add_argument('current')
+        parser.add_argument('--threshold', type=float, default=0.2,
+                            help='Allowed relative latency growth, 0.2 = 20%%')
+
+    def handle(self, *args, **options):
+        rows = compare_reports(load_report(options['baseline']), load_report(options['current']),
+                               threshold=options['threshold'])
+
+        regressions = 0
+        for scale, name, metric, before, after, regression in rows:
+            line = f'{scale:>8} {name:<55} {metric:<15} {before:>10} -> {after:<10}'
+            if regression:
+                regressions += 1
+                self.stdout.write(self.style.ERROR(f'{line} REGRESSION'))
+            else:
+                self.stdout.write(line)
+
+        if regressions:
+            raise CommandError(f'Regressions: {regressions}')
+
+        self.stdout.write(self.style.SUCCESS('No regressions'))
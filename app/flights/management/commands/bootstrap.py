@@ -0,0 +1,78 @@
+import logging
+import os
+import time
+
+from django.conf import settings
+from django.core.management import call_command
+from django.core.management.base import BaseCommand, CommandError
+
+from flights.bootstrap import (FixtureLoader, file_sha256, get_pending_migrations, get_static_manifest,
+                               is_fixture_applied, read_static_manifest, write_static_manifest)
+
+logger = logging.getLogger('flights.bootstrap')
+
+
+class Command(BaseCommand):
+    help = ('Idempotent container start: applies pending migrations, loads changed fixtures with bulk upserts '
+            'and collects static files only when they changed. Every step is skipped when there is nothing to do')
+
+    def add_arguments(self, parser):
+        parser.add_argument('fixtures', nargs='*', default=['fixture.json'],
+                            help='Fixture files to load (default: fixture.json)')
+        parser.add_argument('--batch-size', type=int, default=1000)
+        parser.add_argument('--force', action='store_true',
+                            help='Run every step even if nothing changed')
+        parser.add_argument('--skip-static', action='store_true', help='Do not collect static files')
+
+    def handle(self, *args, **options):
+        self.force = options['force']
+        started = time.perf_counter()
+        timings = []
+
+        steps = [('migrate', self.migrate)]
+        steps += [(f'fixture {path}', lambda path=path: self.load_fixture(path, options['batch_size']))
+                  for path in options['fixtures']]
+        if not options['skip_static']:
+            steps.append(('collectstatic', self.collect_static))
+
+        for name, step in steps:
+            step_started = time.perf_counter()
+            result = step()
+            elapsed = time.perf_counter() - step_started
+            timings.append(f'{name}: {result} {elapsed:.2f} s')
+            self.stdout.write(f'{name}: {result} ({elapsed:.2f} s)')
+
+        total = time.perf_counter() - started
+        logger.info('Bootstrap finished in %.2f s (%s)', total, ', '.join(timings))
+        self.stdout.write(self.style.SUCCESS(f'Bootstrap finished in {total:.2f} s'))
+
+    def migrate(self):
+        plan = get_pending_migrations()
+        if not plan and not self.force:
+            return 'skipped'
+
+        call_command('migrate', interactive=False, verbosity=0)
+        return f'applied {len(plan)}'
+
+    def load_fixture(self, path, batch_size):
+        if not os.path.isabs(path) and not os.path.exists(path):
+            path = os.path.join(settings.BASE_DIR, path)
+        if not os.path.exists(path):
+            raise CommandError(f'Fixture {path} not found')
+
+        loader = FixtureLoader(path, batch_size=batch_size)
+        sha256 = file_sha256(path)
+        if not self.force and is_fixture_applied(loader.name, sha256):
+            return 'skipped'
+
+        counts = loader.load(sha256)
+        return f'loaded {sum(counts.values())} objects'
+
+    def collect_static(self):
+        manifest = get_static_manifest()
+        if not self.force and manifest == read_static_manifest():
+            return 'skipped'
+
+        call_command('collectstatic', interactive=False, verbosity=0)
+        write_static_manifest(manifest)
+        return 'collected'
@@ -0,0 +1,66 @@
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connection, transaction
+from django.test.utils import CaptureQueriesContext
+
+from flights.models import UserTrip
+from flights.services import (FlightDetailService, FlightInformationService, PassengerProfileService,
+                              PassengerService, TripCardService)
+
+
+class Command(BaseCommand):
+    help = 'Prints query plans of the queries issued by the service methods on hot paths'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--slug', help='UserTrip slug to use for per-trip lookups (default: latest trip)')
+
+    def handle(self, *args, **options):
+        trip = UserTrip.objects.select_related('passenger').order_by('-pk')
+        trip = trip.filter(slug=options['slug']).first() if options['slug'] else trip.first()
+        if trip is None:
+            raise CommandError('No trips found: load data first')
+
+        username = trip.passenger.username
+
+        for name, func in self.get_hot_paths(trip, username).items():
+            self.stdout.write(self.style.MIGRATE_HEADING(name))
+            for sql in self.capture_queries(func):
+                self.stdout.write(f'  {sql}')
+                for line in self.explain(sql):
+                    self.stdout.write(f'    {line}')
+
+    @staticmethod
+    def get_hot_paths(trip, username):
+        trips = UserTrip.objects.filter(pk=trip.pk)
+
+        return {
+            'FlightInformationService.get_latest_cards': FlightInformationService.get_latest_cards,
+            'FlightInformationService.get_top_users': lambda: list(FlightInformationService.get_top_users()),
+            'FlightInformationService.get_site_information': FlightInformationService.get_site_information,
+            'PassengerService.get_all_passengers_with_statistic':
+                lambda: list(PassengerService.get_all_passengers_with_statistic()[:50]),
+            'PassengerService.get_passenger_statistic':
+                lambda: PassengerService.get_passenger_statistic(trip.passenger_id),
+            'PassengerProfileService.get_profile_information':
+                lambda: PassengerProfileService.get_profile_information(username),
+            'PassengerProfileService.get_passenger_cards':
+                lambda: list(PassengerProfileService.get_passenger_cards(username)[:50]),
+            'FlightDetailService.load_flight_details': lambda: FlightDetailService.load_flight_details(trip.slug),
+            'TripCardService.build_cards': lambda: TripCardService.build_cards(trips),
+        }
+
+    @staticmethod
+    def capture_queries(func):
+        # Методы только читают, но откат гарантирует, что команда ничего не изменит
+        with transaction.atomic():
+            with CaptureQueriesContext(connection) as context:
+                func()
+            transaction.set_rollback(True)
+
+        return [query['sql'] for query in context.captured_queries
+                if query['sql'].lstrip().upper().startswith('SELECT')]
+
+    @staticmethod
+    def explain(sql):
+        with connection.cursor() as cursor:
+            cursor.execute(f'{connection.ops.explain_query_prefix()} {sql}')
+            return [' '.join(str(column) for column in row) for row in cursor.fetchall()]
@@ -0,0 +1,34 @@
+from django.contrib.auth.models import User
+from django.core.management.base import BaseCommand, CommandError
+
+from flights.exporters import EXPORT_FORMATS, FlightLogExporter
+from flights.models import UserTrip
+
+
+class Command(BaseCommand):
+    help = 'Streams the flight log of one passenger or of the whole site to a CSV, JSONL or GeoJSON file'
+
+    def add_arguments(self, parser):
+        parser.add_argument('path')
+        parser.add_argument('--user', help='Username of the passenger, all passengers if omitted')
+        parser.add_argument('--format', choices=EXPORT_FORMATS, help='Defaults to the file extension')
+        parser.add_argument('--chunk-size', type=int, default=2000)
+
+    def handle(self, *args, **options):
+        format = options['format'] or options['path'].rsplit('.', 1)[-1].lower()
+        if format not in EXPORT_FORMATS:
+            raise CommandError(f'Unsupported format: {format}')
+
+        if options['user']:
+            user = User.objects.filter(username=options['user']).first()
+            if user is None:
+                raise CommandError(f"User {options['user']!r} does not exist")
+            exporter = FlightLogExporter(UserTrip.objects.filter(passenger=user), chunk_size=options['chunk_size'])
+        else:
+            exporter = FlightLogExporter(include_passenger=True, chunk_size=options['chunk_size'])
+
+        with open(options['path'], 'w', encoding='utf-8', newline='') as file:
+            for chunk in exporter.stream(format):
+                file.write(chunk)
+
+        self.stdout.write(self.style.SUCCESS(f"Flight log written to {options['path']}"))
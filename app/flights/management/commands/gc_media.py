@@ -0,0 +1,35 @@
+import time
+from datetime import timedelta
+
+from django.core.management.base import BaseCommand
+
+from flights.media_gc import MediaGarbageCollector
+
+
+class Command(BaseCommand):
+    help = ('Deletes media files that no airframe, meal or track image references. '
+            'Files left by rolled back transactions and bulk deletes are removed in batches')
+
+    def add_arguments(self, parser):
+        parser.add_argument('--dry-run', action='store_true', help='Only report what would be deleted')
+        parser.add_argument('--min-age', type=int, default=60,
+                            help='Skip files and names younger than this many minutes (default: 60)')
+        parser.add_argument('--batch-size', type=int, default=500)
+        parser.add_argument('--quarantine', metavar='DIR',
+                            help='Move unreferenced files into DIR instead of deleting them')
+
+    def handle(self, *args, **options):
+        started = time.perf_counter()
+        stats = MediaGarbageCollector(
+            min_age=timedelta(minutes=options['min_age']),
+            batch_size=options['batch_size'],
+            dry_run=options['dry_run'],
+            quarantine=options['quarantine'],
+        ).collect()
+
+        action = 'Would reclaim' if options['dry_run'] else 'Reclaimed'
+        self.stdout.write(self.style.SUCCESS(
+            f"{action} {stats['bytes']} bytes: {stats['files']} unreferenced files, "
+            f"{stats['names']} names, {stats['blobs']} blobs; "
+            f"skipped {stats['recent']} recent files in {time.perf_counter() - started:.1f} s"
+        ))
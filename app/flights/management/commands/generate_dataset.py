@@ -0,0 +1,59 @@
+import time
+
+from django.core.management import call_command
+from django.core.management.base import BaseCommand, CommandError
+
+from flights.dataset import DatasetGenerator
+from flights.services import SiteCounterService
+
+
+class Command(BaseCommand):
+    help = 'Generates a reproducible synthetic dataset with bulk inserts for load and benchmark work'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--users', type=int, default=1000)
+        parser.add_argument('--trips-per-user', type=int, default=3)
+        parser.add_argument('--passengers-per-flight', type=int, default=5)
+        parser.add_argument('--airlines', type=int, default=50)
+        parser.add_argument('--aircraft-types', type=int, default=40)
+        parser.add_argument('--airframes', type=int, default=1000)
+        parser.add_argument('--airports', type=int, default=500)
+        parser.add_argument('--meal-ratio', type=float, default=0.5)
+        parser.add_argument('--tracks-per-trip', type=int, default=1)
+        parser.add_argument('--seed', type=int, default=42)
+        parser.add_argument('--batch-size', type=int, default=5000)
+        parser.add_argument('--prefix', default='gen', help='Prefix of generated names, must be unused')
+        parser.add_argument('--skip-read-models', action='store_true',
+                            help='Do not rebuild trip cards, passenger stats and site counters')
+
+    def handle(self, *args, **options):
+        generator = DatasetGenerator(seed=options['seed'],
+                                     batch_size=options['batch_size'],
+                                     prefix=options['prefix'],
+                                     log=self.stdout.write)
+        if generator.exists():
+            raise CommandError(f"Dataset with prefix {options['prefix']!r} already exists")
+
+        started = time.perf_counter()
+        counts = generator.generate(users=options['users'],
+                                    trips_per_user=options['trips_per_user'],
+                                    passengers_per_flight=options['passengers_per_flight'],
+                                    airlines=options['airlines'],
+                                    aircraft_types=options['aircraft_types'],
+                                    airframes=options['airframes'],
+                                    airports=options['airports'],
+                                    meal_ratio=options['meal_ratio'],
+                                    tracks_per_trip=options['tracks_per_trip'])
+
+        for name, value in counts.items():
+            self.stdout.write(f'{name}: {value}')
+        self.stdout.write(f'Generated in {time.perf_counter() - started:.1f} s')
+
+        if not options['skip_read_models']:
+            # bulk_create не вызывает сигналы, поэтому читаемые модели пересобираются целиком
+            call_command('backfill_trip_cards', batch_size=options['batch_size'], stdout=self.stdout)
+            call_command('rebuild_passenger_stats', batch_size=options['batch_size'], stdout=self.stdout)
+            repaired = SiteCounterService.reconcile()
+            self.stdout.write(f'Site counters repaired: {len(repaired)}')
+
+        self.stdout.write(self.style.SUCCESS(f'Dataset ready in {time.perf_counter() - started:.1f} s'))
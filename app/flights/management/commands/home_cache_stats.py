@@ -0,0 +1,22 @@
+from django.core.management.base import BaseCommand
+
+from flights.cache import HomePageCache
+
+
+class Command(BaseCommand):
+    help = 'Prints hit/miss counters of the home page cache'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--reset', action='store_true', help='Reset counters after printing')
+
+    def handle(self, *args, **options):
+        stats = HomePageCache.get_stats()
+
+        self.stdout.write(f"Generation: {stats['generation']}")
+        self.stdout.write(f"Hits: {stats['hits']}")
+        self.stdout.write(f"Misses: {stats['misses']}")
+        self.stdout.write(f"Hit ratio: {stats['hit_ratio']:.2%}")
+
+        if options['reset']:
+            HomePageCache.reset_stats()
+            self.stdout.write(self.style.SUCCESS('Counters reset'))
@@ -0,0 +1,40 @@
+import time
+
+from django.contrib.auth.models import User
+from django.core.management.base import BaseCommand, CommandError
+
+from flights.importers import FORMATS, FlightLogImporter, get_format
+
+
+class Command(BaseCommand):
+    help = 'Imports a CSV or JSONL flight log of one passenger with batched bulk inserts'
+
+    def add_arguments(self, parser):
+        parser.add_argument('path')
+        parser.add_argument('--user', required=True, help='Username of the passenger')
+        parser.add_argument('--format', choices=FORMATS, help='Defaults to the file extension')
+        parser.add_argument('--batch-size', type=int, default=500)
+
+    def handle(self, *args, **options):
+        try:
+            user = User.objects.get(username=options['user'])
+        except User.DoesNotExist:
+            raise CommandError(f"User {options['user']!r} does not exist")
+
+        try:
+            format = options['format'] or get_format(options['path'])
+        except ValueError as error:
+            raise CommandError(error)
+
+        importer = FlightLogImporter(user, batch_size=options['batch_size'])
+        started = time.perf_counter()
+        with open(options['path'], encoding='utf-8-sig', newline='') as lines:
+            stats = importer.run(lines, format)
+
+        for line_number, message in importer.errors:
+            self.stderr.write(f'Line {line_number}: {message}')
+
+        self.stdout.write(self.style.SUCCESS(
+            f"Rows: {stats['rows']}, imported: {stats['imported']}, skipped: {stats['skipped']}, "
+            f"errors: {stats['errors']} in {time.perf_counter() - started:.1f} s"
+        ))
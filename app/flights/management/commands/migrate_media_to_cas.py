@@ -0,0 +1,169 @@
+import os
+import shutil
+import time
+from collections import Counter
+
+from django.core.files.storage import storages
+from django.core.management.base import BaseCommand, CommandError
+from django.db import transaction
+
+from flights.bootstrap import file_sha256
+from flights.cache import HomePageCache
+from flights.media_gc import MODELS, iter_referenced_names
+from flights.models import Airframe, MediaBlob, MediaFile, UserTrip
+from flights.renditions import attach_blobs, get_rendition_paths
+from flights.services import TripCardService
+from flights.storage import ContentAddressedStorage, is_blob_name, make_blob_name
+from flights.tasks import prune_directories
+
+
+class Command(BaseCommand):
+    help = ('Moves media files uploaded before content-addressed storage into blobs/ and records their names. '
+            'Identical files are stored once. Safe to rerun: migrated names are skipped')
+
+    def add_arguments(self, parser):
+        parser.add_argument('--batch-size', type=int, default=500)
+        parser.add_argument('--dry-run', action='store_true', help='Only report what would be migrated')
+        parser.add_argument('--keep-originals', action='store_true',
+                            help='Do not delete files at the old paths after migration')
+
+    def handle(self, *args, **options):
+        self.storage = storages['default']
+        if not isinstance(self.storage, ContentAddressedStorage):
+            raise CommandError('Default storage is not flights.storage.ContentAddressedStorage')
+
+        self.options = options
+        self.stats = Counter()
+        # Содержимое, уже учтенное в этом запуске
+        self.known_blobs = set()
+        started = time.perf_counter()
+
+        batch = []
+        for name in self.get_legacy_names():
+            batch.append(name)
+            if len(batch) >= options['batch_size']:
+                self.migrate(batch)
+                batch = []
+        if batch:
+            self.migrate(batch)
+
+        if not options['dry_run']:
+            self.stats['registries'] = self.update_registries()
+
+        self.stdout.write(self.style.SUCCESS(
+            f"{'Would migrate' if options['dry_run'] else 'Migrated'} {self.stats['files']} files "
+            f"({self.stats['bytes']} bytes) into {self.stats['blobs']} blobs, "
+            f"deduplicated {self.stats['deduplicated_bytes']} bytes, missing {self.stats['missing']}, "
+            f"updated {self.stats['registries']} rendition registries "
+            f"in {time.perf_counter() - started:.1f} s"
+        ))
+
+    def get_legacy_names(self):
+        '''Логические имена из полей моделей и реестров копий, для которых еще нет MediaFile'''
+
+        seen = set()
+        batch = []
+        for name in iter_referenced_names():
+            if name in seen or is_blob_name(name):
+                continue
+            seen.add(name)
+            batch.append(name)
+            if len(batch) >= 1000:
+                yield from self.exclude_migrated(batch)
+                batch = []
+        yield from self.exclude_migrated(batch)
+
+    @staticmethod
+    def exclude_migrated(names):
+        migrated = set(MediaFile.objects.filter(name__in=names).values_list('name', flat=True))
+        return [name for name in names if name not in migrated]
+
+    def migrate(self, names):
+        blobs = {}
+        links = {}
+        for name in names:
+            path = self.storage.raw_path(name)
+            if not os.path.isfile(path):
+                self.stats['missing'] += 1
+                self.stderr.write(f'{name}: file not found')
+                continue
+
+            sha256 = file_sha256(path)
+            size = os.path.getsize(path)
+            blobs.setdefault(sha256, MediaBlob(sha256=sha256, name=make_blob_name(sha256, name), size=size))
+            links[name] = sha256
+
+            self.stats['files'] += 1
+            self.stats['bytes'] += size
+
+        self.known_blobs.update(MediaBlob.objects.filter(pk__in=list(blobs)).values_list('pk', flat=True))
+        for sha256 in links.values():
+            if sha256 in self.known_blobs:
+                self.stats['deduplicated_bytes'] += blobs[sha256].size
+            else:
+                self.known_blobs.add(sha256)
+                self.stats['blobs'] += 1
+
+        if self.options['dry_run'] or not links:
+            return
+
+        with transaction.atomic():
+            MediaBlob.objects.bulk_create(list(blobs.values()), ignore_conflicts=True)
+            existing = MediaBlob.objects.select_for_update().in_bulk(list(blobs))
+
+            # Файл сначала появляется под новым именем (жесткая ссылка без копирования),
+            # старый путь удаляется только после коммита: при сбое ничего не теряется
+            for name, sha256 in links.items():
+                blob_path = self.storage.raw_path(existing[sha256].name)
+                if not os.path.exists(blob_path):
+                    os.makedirs(os.path.dirname(blob_path), exist_ok=True)
+                    self.link_file(self.storage.raw_path(name), blob_path)
+
+            for sha256, count in Counter(links.values()).items():
+                existing[sha256].refcount += count
+            MediaBlob.objects.bulk_update(list(existing.values()), ['refcount'])
+            MediaFile.objects.bulk_create([MediaFile(name=name, blob_id=sha256) for name, sha256 in links.items()])
+
+            if not self.options['keep_originals']:
+                transaction.on_commit(lambda: self.remove_originals(list(links)))
+
+    @staticmethod
+    def link_file(source, destination):
+        try:
+            os.link(source, destination)
+        except OSError:
+            # Другой раздел диска или файловая система без жестких ссылок
+            shutil.copy2(source, destination)
+
+    def remove_originals(self, names):
+        for name in names:
+            try:
+                os.remove(self.storage.raw_path(name))
+            except FileNotFoundError:
+                pass
+        prune_directories(sorted({os.path.dirname(name) for name in names if os.path.dirname(name)}))
+
+    def update_registries(self):
+        '''Добавляет имена содержимого в реестры копий, чтобы шаблоны выводили неизменяемые URL'''
+
+        updated = 0
+        for model in MODELS:
+            rows = model.objects.exclude(renditions={}).values_list('pk', 'renditions').iterator(chunk_size=2000)
+            pending = [(pk, renditions) for pk, renditions in rows
+                       if any(isinstance(entry, dict) and 'blobs' not in entry for entry in renditions.values())]
+
+            for start in range(0, len(pending), self.options['batch_size']):
+                batch = pending[start:start + self.options['batch_size']]
+                paths = {path for _, renditions in batch for path in get_rendition_paths(renditions)}
+                blob_names = dict(MediaFile.objects.filter(name__in=paths).values_list('name', 'blob__name'))
+                objects = [model(pk=pk, renditions=attach_blobs(renditions, blob_names)) for pk, renditions in batch]
+
+                with transaction.atomic():
+                    model.objects.bulk_update(objects, ['renditions'])
+                    if model is Airframe:
+                        TripCardService.refresh(UserTrip.objects.filter(flight__airframe__in=[obj.pk for obj in objects]))
+                updated += len(objects)
+
+        if updated:
+            HomePageCache.bump_generation()
+        return updated
@@ -0,0 +1,33 @@
+from django.core.management.base import BaseCommand, CommandError
+from django.db import transaction
+
+from flights.services import PassengerStatsService
+
+
+class Command(BaseCommand):
+    help = 'Recomputes the PassengerStats table or checks it for consistency'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--batch-size', type=int, default=1000)
+        parser.add_argument('--check', action='store_true',
+                            help='Only compare stored statistics with actual data, do not write anything')
+
+    def handle(self, *args, **options):
+        batch_size = options['batch_size']
+
+        if options['check']:
+            inconsistencies = PassengerStatsService.find_inconsistencies(batch_size)
+
+            for passenger_id, stored, actual in inconsistencies:
+                self.stdout.write(f'Passenger {passenger_id}: stored {stored}, actual {actual}')
+
+            if inconsistencies:
+                raise CommandError(f'Inconsistent passenger statistics: {len(inconsistencies)}')
+
+            self.stdout.write(self.style.SUCCESS('Passenger statistics are consistent'))
+            return
+
+        with transaction.atomic():
+            total = PassengerStatsService.rebuild(batch_size)
+
+        self.stdout.write(self.style.SUCCESS(f'Passenger statistics rebuilt: {total}'))
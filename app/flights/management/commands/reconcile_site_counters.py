@@ -0,0 +1,23 @@
+from django.core.management.base import BaseCommand
+
+from flights.services import SiteCounterService
+
+
+class Command(BaseCommand):
+    help = 'Compares site counters with actual data and repairs the drift. Intended to run periodically (cron)'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--dry-run', action='store_true', help='Only report the drift, do not repair it')
+
+    def handle(self, *args, **options):
+        drift = SiteCounterService.reconcile(dry_run=options['dry_run'])
+
+        for kind, key, stored, actual in drift:
+            self.stdout.write(f'{kind} {key}: stored {stored}, actual {actual}')
+
+        if not drift:
+            self.stdout.write(self.style.SUCCESS('Site counters are consistent'))
+        elif options['dry_run']:
+            self.stdout.write(self.style.WARNING(f'Drifted counters: {len(drift)}'))
+        else:
+            self.stdout.write(self.style.SUCCESS(f'Repaired counters: {len(drift)}'))
@@ -0,0 +1,45 @@
+import signal
+import time
+
+from django.core.management.base import BaseCommand
+
+from flights.jobs import JobWorker
+
+
+class Command(BaseCommand):
+    help = 'Runs background jobs (image renditions, media cleanup) from the database queue'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--batch-size', type=int, default=10, help='Jobs claimed per transaction')
+        parser.add_argument('--poll-interval', type=float, default=1.0,
+                            help='Seconds to sleep when the queue is empty')
+        parser.add_argument('--once', action='store_true', help='Run queued jobs and exit')
+        parser.add_argument('--max-jobs', type=int, help='Exit after this many jobs')
+
+    def handle(self, *args, **options):
+        worker = JobWorker(batch_size=options['batch_size'])
+
+        if options['once']:
+            total = worker.run_pending(max_jobs=options['max_jobs'])
+            self.stdout.write(self.style.SUCCESS(f'Jobs processed: {total}'))
+            return
+
+        self.stopping = False
+
+        def stop(signum, frame):
+            # Текущая пачка дорабатывается, новая не берется
+            self.stopping = True
+
+        signal.signal(signal.SIGTERM, stop)
+        signal.signal(signal.SIGINT, stop)
+
+        total = 0
+        while not self.stopping:
+            count = worker.run_batch()
+            total += count
+            if options['max_jobs'] is not None and total >= options['max_jobs']:
+                break
+            if not count:
+                time.sleep(options['poll_interval'])
+
+        self.stdout.write(self.style.SUCCESS(f'Worker stopped, jobs processed: {total}'))
@@ -0,0 +1,188 @@
+import logging
+import os
+import shutil
+from collections import Counter
+from datetime import timedelta
+
+from django.conf import settings
+from django.core.files.storage import default_storage
+from django.db import transaction
+from django.utils import timezone
+
+from .models import Airframe, MediaBlob, MediaFile, Meal, TrackImage
+from .renditions import get_rendition_paths, is_placeholder
+from .storage import BLOB_DIR
+from .tasks import prune_directories
+
+logger = logging.getLogger('flights.media_gc')
+
+MODELS = (Airframe, Meal, TrackImage)
+
+
+def iter_referenced_names(chunk_size=2000):
+    '''Логические имена изображений и их копий из всех моделей, потоково и с повторами'''
+
+    for model in MODELS:
+        rows = model.objects \
+            .exclude(**{model.IMAGE_FIELD: ''}) \
+            .values_list(model.IMAGE_FIELD, 'renditions') \
+            .iterator(chunk_size=chunk_size)
+        for name, renditions in rows:
+            if name:
+                yield name
+            yield from get_rendition_paths(renditions or {})
+
+
+def scan_files(root, exclude=()):
+    '''Все файлы под root. os.scandir отдает тип записи без отдельного stat на каждый файл,
+    обход итеративный, поэтому глубина каталогов не ограничена стеком вызовов'''
+
+    stack = [root]
+    while stack:
+        try:
+            entries = os.scandir(stack.pop())
+        except FileNotFoundError:
+            continue
+        with entries:
+            for entry in entries:
+                if entry.is_dir(follow_symlinks=False):
+                    if entry.path not in exclude:
+                        stack.append(entry.path)
+                elif entry.is_file(follow_symlinks=False):
+                    yield entry
+
+
+class MediaGarbageCollector:
+    '''Удаление файлов, на которые не ссылается ни одна модель.
+    Такие файлы остаются после откатившихся транзакций (файл записан, строка - нет) и bulk-удалений,
+    при которых сигналы не вызываются. Сборка идет в три шага:
+    1. логические имена MediaFile без ссылок из моделей освобождаются пачками, содержимое без ссылок удаляется;
+    2. множество нужных путей: имена, которые хранятся по старым путям, и все оставшееся содержимое blobs/;
+    3. MEDIA_ROOT обходится os.scandir, ненужные файлы удаляются или переносятся в карантин пачками.
+    Файлы и имена моложе min_age не трогаются: их может сохранять еще не закоммиченная транзакция.
+    Заглушки синтетических данных (is_placeholder) не удаляются, даже если на них никто не ссылается'''
+
+    def __init__(self, min_age=timedelta(hours=1), batch_size=500, dry_run=False, quarantine=None):
+        self.storage = default_storage
+        self.root = os.path.abspath(settings.MEDIA_ROOT)
+        self.cutoff = timezone.now() - min_age
+        self.batch_size = batch_size
+        self.dry_run = dry_run
+        self.quarantine = os.path.abspath(quarantine) if quarantine else None
+        self.stats = Counter()
+        self.directories = set()
+
+    def collect(self):
+        referenced = set(iter_referenced_names())
+        self.stats['referenced'] = len(referenced)
+
+        keep = referenced
+        if hasattr(self.storage, 'get_blob_name'):
+            keep = self.release_names(referenced)
+            self.delete_unreferenced_blobs()
+            keep.update(MediaBlob.objects.values_list('name', flat=True).iterator(chunk_size=5000))
+
+        self.sweep_files(keep)
+
+        logger.info('%s %s bytes: %s files, %s names, %s blobs',
+                    'Would reclaim' if self.dry_run else 'Reclaimed', self.stats['bytes'],
+                    self.stats['files'], self.stats['names'], self.stats['blobs'])
+        return self.stats
+
+    def release_names(self, referenced):
+        '''Освобождает имена MediaFile без ссылок. Возвращает имена, которые хранятся по старым путям'''
+
+        legacy = set(referenced)
+        batch = []
+        rows = MediaFile.objects.values_list('name', 'blob_id', 'created_at').iterator(chunk_size=5000)
+        for name, sha256, created_at in rows:
+            if name in referenced or is_placeholder(name):
+                # Имя хранится в blobs/: файл по старому пути (например, после --keep-originals) не нужен
+                legacy.discard(name)
+            elif created_at < self.cutoff:
+                batch.append((name, sha256))
+                if len(batch) >= self.batch_size:
+                    self.release_batch(batch)
+                    batch = []
+        if batch:
+            self.release_batch(batch)
+
+        return legacy
+
+    def release_batch(self, batch):
+        self.stats['names'] += len(batch)
+
+        if self.dry_run:
+            counts = Counter(sha256 for _, sha256 in batch)
+            for sha256, refcount, size in MediaBlob.objects.filter(pk__in=list(counts)) \
+                    .values_list('pk', 'refcount', 'size'):
+                if refcount <= counts[sha256]:
+                    self.stats['blobs'] += 1
+                    self.stats['bytes'] += size
+            return
+
+        for sha256 in self.storage.delete_many([name for name, _ in batch]):
+            self.delete_blob(sha256)
+
+    def delete_unreferenced_blobs(self):
+        '''Содержимое с нулевым счетчиком, которое фоновая задача еще не удалила'''
+
+        rows = MediaBlob.objects.filter(refcount=0).values_list('pk', 'size')
+        for sha256, size in rows.iterator(chunk_size=5000):
+            if self.dry_run:
+                self.stats['blobs'] += 1
+                self.stats['bytes'] += size
+            else:
+                self.delete_blob(sha256)
+
+    def delete_blob(self, sha256):
+        with transaction.atomic():
+            size = self.storage.delete_blob(sha256)
+        if size:
+            self.stats['blobs'] += 1
+            self.stats['bytes'] += size
+
+    def sweep_files(self, keep):
+        exclude = {self.quarantine} if self.quarantine else set()
+        cutoff = self.cutoff.timestamp()
+
+        batch = []
+        for entry in scan_files(self.root, exclude):
+            name = os.path.relpath(entry.path, self.root).replace(os.sep, '/')
+            if name in keep or is_placeholder(name):
+                continue
+
+            stat = entry.stat(follow_symlinks=False)
+            if stat.st_mtime > cutoff:
+                self.stats['recent'] += 1
+                continue
+
+            batch.append((name, entry.path, stat.st_size))
+            if len(batch) >= self.batch_size:
+                self.remove_files(batch)
+                batch = []
+        if batch:
+            self.remove_files(batch)
+
+        if self.directories and not self.dry_run:
+            # Каталоги-разветвители blobs/ не удаляются: _save создает их без блокировок
+            prune_directories(sorted(directory for directory in self.directories
+                                     if directory and directory.split('/')[0] != BLOB_DIR))
+
+    def remove_files(self, batch):
+        for name, path, size in batch:
+            self.stats['files'] += 1
+            self.stats['bytes'] += size
+            if self.dry_run:
+                continue
+
+            if self.quarantine:
+                destination = os.path.join(self.quarantine, name)
+                os.makedirs(os.path.dirname(destination), exist_ok=True)
+                shutil.move(path, destination)
+            else:
+                try:
+                    os.remove(path)
+                except FileNotFoundError:
+                    continue
+            self.directories.add(os.path.dirname(name))
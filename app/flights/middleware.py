@@ -0,0 +1,66 @@
+import random
+
+from django.conf import settings
+
+from .identity_map import RequestIdentityMap
+from .query_budget import QueryBudgetExceeded, QueryRecorder, logger
+
+
+class IdentityMapMiddleware:
+    '''Открывает RequestIdentityMap на время обработки запроса'''
+
+    def __init__(self, get_response):
+        self.get_response = get_response
+
+    def __call__(self, request):
+        with RequestIdentityMap.scope():
+            return self.get_response(request)
+
+
+class QueryBudgetMiddleware:
+    '''Считает запросы и время в БД для доли запросов QUERY_BUDGET_SAMPLE_RATE и пишет их в лог.
+    Превышение query_budget представления или повторный SELECT логируется как warning,
+    а при QUERY_BUDGET_RAISE (тесты) приводит к исключению QueryBudgetExceeded'''
+
+    def __init__(self, get_response):
+        self.get_response = get_response
+
+    def __call__(self, request):
+        sample_rate = getattr(settings, 'QUERY_BUDGET_SAMPLE_RATE', 0)
+        if not sample_rate or random.random() >= sample_rate:
+            return self.get_response(request)
+
+        request.query_budget = None
+        with QueryRecorder(view=request.path) as report:
+            response = self.get_response(request)
+
+        request.query_report = report
+        self.check_budget(request, report)
+
+        return response
+
+    def process_view(self, request, view_func, view_args, view_kwargs):
+        if not hasattr(request, 'query_budget'):
+            return None
+
+        view_class = getattr(view_func, 'view_class', view_func)
+        budget = getattr(view_class, 'query_budget', None)
+        # Бюджет можно задать отдельно для каждого HTTP-метода
+        request.query_budget = budget.get(request.method) if isinstance(budget, dict) else budget
+
+    @staticmethod
+    def check_budget(request, report):
+        match = request.resolver_match
+        if match is not None:
+            report.view = match.view_name or match._func_path
+
+        violations = report.get_violations(request.query_budget)
+        if not violations:
+            logger.info('query budget ok', extra={'query_report': report.as_dict()})
+            return
+
+        logger.warning('query budget exceeded by %s %s: %s', request.method, report.view, '; '.join(violations),
+                       extra={'query_report': report.as_dict()})
+
+        if getattr(settings, 'QUERY_BUDGET_RAISE', False):
+            raise QueryBudgetExceeded(f'{request.method} {report.view}: ' + '; '.join(violations))
@@ -0,0 +1,33 @@
+# Generated by Django 4.2 on 2026-10-18 07:09
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('flights', '0011_alter_flightinfo_is_boarding_bridge'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='TripCard',
+            fields=[
+                ('trip', models.OneToOneField(on_delete=django.db.models.deletion.CASCADE, primary_key=True, related_name='card', serialize=False, to='flights.usertrip', verbose_name='Путешествие')),
+                ('photo_url', models.CharField(blank=True, max_length=255, verbose_name='Фото ВС')),
+                ('flight_number', models.CharField(max_length=50, verbose_name='Номер рейса')),
+                ('date', models.DateField(verbose_name='Дата полета')),
+                ('passenger', models.CharField(max_length=150, verbose_name='Пассажир')),
+                ('airline', models.CharField(blank=True, max_length=100, verbose_name='Авиакомпания')),
+                ('aircraft_type', models.CharField(blank=True, max_length=101, verbose_name='Тип ВС')),
+                ('departure', models.CharField(blank=True, max_length=4, verbose_name='Аэропорт вылета')),
+                ('destination', models.CharField(blank=True, max_length=4, verbose_name='Аэропорт прилета')),
+                ('slug', models.SlugField(db_index=False, verbose_name='Слаг путешествия')),
+            ],
+            options={
+                'verbose_name': 'Карточка путешествия',
+                'verbose_name_plural': 'Карточки путешествий',
+            },
+        ),
+    ]
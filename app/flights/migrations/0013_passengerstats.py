@@ -0,0 +1,30 @@
+# Generated by Django 4.2 on 2026-10-18 07:11
+
+from django.conf import settings
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('auth', '0012_alter_user_first_name_max_length'),
+        ('flights', '0012_tripcard'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='PassengerStats',
+            fields=[
+                ('passenger', models.OneToOneField(on_delete=django.db.models.deletion.CASCADE, primary_key=True, related_name='stats', serialize=False, to=settings.AUTH_USER_MODEL, verbose_name='Пассажир')),
+                ('total_flights', models.PositiveIntegerField(default=0, verbose_name='Количество полетов')),
+                ('total_airlines', models.PositiveIntegerField(default=0, verbose_name='Количество авиакомпаний')),
+                ('total_aircraft_types', models.PositiveIntegerField(default=0, verbose_name='Количество типов ВС')),
+                ('total_airports', models.PositiveIntegerField(default=0, verbose_name='Количество аэропортов')),
+            ],
+            options={
+                'verbose_name': 'Статистика пассажира',
+                'verbose_name_plural': 'Статистика пассажиров',
+            },
+        ),
+    ]
@@ -0,0 +1,38 @@
+# Generated by Django 4.2 on 2026-10-18 07:14
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('flights', '0013_passengerstats'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='SiteTotal',
+            fields=[
+                ('kind', models.CharField(choices=[('airline', 'Airline'), ('aircraft_type', 'Aircraft type'), ('airframe', 'Airframe'), ('airport', 'Airport')], max_length=20, primary_key=True, serialize=False, verbose_name='Вид')),
+                ('value', models.PositiveIntegerField(default=0, verbose_name='Значение')),
+            ],
+            options={
+                'verbose_name': 'Итог по сайту',
+                'verbose_name_plural': 'Итоги по сайту',
+            },
+        ),
+        migrations.CreateModel(
+            name='SiteCounter',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('kind', models.CharField(choices=[('airline', 'Airline'), ('aircraft_type', 'Aircraft type'), ('airframe', 'Airframe'), ('airport', 'Airport')], max_length=20, verbose_name='Вид')),
+                ('key', models.CharField(max_length=100, verbose_name='Ключ')),
+                ('refcount', models.PositiveIntegerField(default=0, verbose_name='Количество ссылок')),
+            ],
+            options={
+                'verbose_name': 'Счетчик ссылок',
+                'verbose_name_plural': 'Счетчики ссылок',
+                'unique_together': {('kind', 'key')},
+            },
+        ),
+    ]
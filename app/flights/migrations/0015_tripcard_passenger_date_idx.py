@@ -0,0 +1,17 @@
+# Generated by Django 4.2 on 2026-10-18 07:18
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('flights', '0014_sitecounter_sitetotal'),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name='tripcard',
+            index=models.Index(fields=['passenger', '-date', 'trip'], name='tripcard_passenger_date_idx'),
+        ),
+    ]
@@ -0,0 +1,37 @@
+# Generated by Django 4.2 on 2026-10-18 07:19
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('flights', '0015_tripcard_passenger_date_idx'),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name='flight',
+            index=models.Index(fields=['airframe', 'date'], name='flight_airframe_date_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='flightinfo',
+            index=models.Index(fields=['airport_code'], name='flightinfo_airport_code_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='flightinfo',
+            index=models.Index(condition=models.Q(('status', 'Departure')), fields=['flight', 'airport_code'], name='flightinfo_departure_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='flightinfo',
+            index=models.Index(condition=models.Q(('status', 'Arrival')), fields=['flight', 'airport_code'], name='flightinfo_arrival_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='usertrip',
+            index=models.Index(fields=['passenger', 'flight'], name='usertrip_passenger_flight_idx'),
+        ),
+        migrations.AddConstraint(
+            model_name='flightinfo',
+            constraint=models.UniqueConstraint(fields=('flight', 'status'), name='flightinfo_flight_status_uniq'),
+        ),
+    ]
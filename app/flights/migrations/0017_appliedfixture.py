@@ -0,0 +1,26 @@
+# Generated by Django 4.2 on 2026-10-18 07:36
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('flights', '0016_hot_path_indexes'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='AppliedFixture',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('name', models.CharField(max_length=255, unique=True, verbose_name='Файл фикстуры')),
+                ('sha256', models.CharField(max_length=64, verbose_name='SHA-256 содержимого')),
+                ('applied_at', models.DateTimeField(auto_now=True, verbose_name='Загружена')),
+            ],
+            options={
+                'verbose_name': 'Загруженная фикстура',
+                'verbose_name_plural': 'Загруженные фикстуры',
+            },
+        ),
+    ]
@@ -0,0 +1,33 @@
+# Generated by Django 4.2 on 2026-10-18 07:41
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('flights', '0017_appliedfixture'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='airframe',
+            name='renditions',
+            field=models.JSONField(blank=True, default=dict, editable=False, verbose_name='Уменьшенные копии'),
+        ),
+        migrations.AddField(
+            model_name='meal',
+            name='renditions',
+            field=models.JSONField(blank=True, default=dict, editable=False, verbose_name='Уменьшенные копии'),
+        ),
+        migrations.AddField(
+            model_name='trackimage',
+            name='renditions',
+            field=models.JSONField(blank=True, default=dict, editable=False, verbose_name='Уменьшенные копии'),
+        ),
+        migrations.AddField(
+            model_name='tripcard',
+            name='photo_renditions',
+            field=models.JSONField(blank=True, default=dict, verbose_name='Уменьшенные копии фото ВС'),
+        ),
+    ]
@@ -0,0 +1,21 @@
+# Generated by Django 4.2 on 2026-10-18 09:15
+
+from django.conf import settings
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+        ('flights', '0021_mediafile_created_at'),
+    ]
+
+    operations = [
+        migrations.AlterField(
+            model_name='usertrip',
+            name='passenger',
+            field=models.ForeignKey(on_delete=django.db.models.deletion.DO_NOTHING, to=settings.AUTH_USER_MODEL, verbose_name='Пассажир'),
+        ),
+    ]
@@ -1,8 +1,129 @@
+import copy
+
 from django.contrib.auth.models import User
 from django.db import models
+from django.db.models.fields.files import FieldFile
+from django.utils import timezone
 from django.utils.text import slugify
 
 
+class DirtyFieldsMixin(models.Model):
+    '''Снимок значений полей на момент загрузки из БД (from_db) или последнего save().
+    По нему обработчики сигналов узнают старые значения, а формы - измененные поля, без повторного SELECT.
+    У экземпляра, собранного заново (Model(pk=..., ...)), снимка нет: has_snapshot == False'''
+
+    class Meta:
+        abstract = True
+
+    @classmethod
+    def from_db(cls, db, field_names, values):
+        instance = super().from_db(db, field_names, values)
+        instance.take_snapshot()
+        return instance
+
+    @staticmethod
+    def get_snapshot_value(instance, field):
+        value = field.value_from_object(instance)
+        if isinstance(value, FieldFile):
+            # Файл без изображения хранится как '' или NULL, оба значения равнозначны
+            return value.name or ''
+        if isinstance(value, (dict, list)):
+            # Изменения JSON на месте не должны попадать в снимок
+            return copy.deepcopy(value)
+        return value
+
+    def take_snapshot(self, fields=None):
+        '''Запоминает текущие значения полей (attname); fields ограничивает снимок этими полями'''
+
+        deferred = self.get_deferred_fields()
+        snapshot = self.__dict__.setdefault('_snapshot', {})
+        for field in self._meta.concrete_fields:
+            if field.attname not in deferred and (fields is None or field.attname in fields):
+                snapshot[field.attname] = self.get_snapshot_value(self, field)
+
+    @property
+    def has_snapshot(self):
+        return '_snapshot' in self.__dict__
+
+    def get_previous_values(self, *names):
+        '''Значения полей из снимка или None, если снимка нет или поле не загружалось'''
+
+        if not self.has_snapshot:
+            return None
+        try:
+            return tuple(self._snapshot[self._meta.get_field(name).attname] for name in names)
+        except KeyError:
+            return None
+
+    @property
+    def changed_fields(self):
+        '''Имена полей, изменившихся после загрузки, или None, если снимка нет'''
+
+        if not self.has_snapshot:
+            return None
+        return [field.name for field in self._meta.concrete_fields
+                if field.attname in self._snapshot
+                and self.get_snapshot_value(self, field) != self._snapshot[field.attname]]
+
+    def save(self, *args, update_fields=None, **kwargs):
+        super().save(*args, update_fields=update_fields, **kwargs)
+
+        if update_fields is None:
+            self.take_snapshot()
+        elif self.has_snapshot:
+            # Частичный снимок без полной загрузки дал бы неверные старые значения остальных полей
+            self.take_snapshot({self._meta.get_field(name).attname for name in update_fields})
+
+    def refresh_from_db(self, using=None, fields=None, **kwargs):
+        super().refresh_from_db(using=using, fields=fields, **kwargs)
+        if fields is None or self.has_snapshot:
+            self.take_snapshot({self._meta.get_field(name).attname for name in fields} if fields else None)
+
+
+class TripDeletionQuerySet(models.QuerySet):
+    '''delete() путешествий и полетов выполняется TripDeletionService (flights/services.py):
+    сироты-полеты и борта удаляются вместе с ними, обработчики сигналов для каждой строки не выполняются'''
+
+    def delete(self):
+        # services импортирует модели, поэтому импорт здесь
+        from .services import TripDeletionService
+
+        deleted = TripDeletionService.delete(**{'trips' if self.model is UserTrip else 'flights': self})
+        return sum(deleted.values()), dict(deleted)
+
+    def delete_rows(self):
+        '''Обычное удаление через Collector, без поиска сирот (для самого TripDeletionService)'''
+
+        return super().delete()
+
+
+class ImageRenditionsMixin(DirtyFieldsMixin):
+    '''Реестр уменьшенных копий изображения (см. flights/renditions.py).
+    В renditions хранится имя исходного файла и для каждого размера - ширина, высота
+    и пути к WebP и JPEG, поэтому шаблоны строят srcset без обращения к файловой системе'''
+
+    IMAGE_FIELD = None
+
+    renditions = models.JSONField(
+        default=dict,
+        blank=True,
+        editable=False,
+        verbose_name='Уменьшенные копии'
+    )
+
+    class Meta:
+        abstract = True
+
+    def get_image(self):
+        return getattr(self, self.IMAGE_FIELD)
+
+    def save(self, *args, update_fields=None, **kwargs):
+        # pre_save сбрасывает реестр при замене изображения: новое значение должно попасть в ту же запись
+        if update_fields is not None and self.IMAGE_FIELD in update_fields:
+            update_fields = {*update_fields, 'renditions'}
+        super().save(*args, update_fields=update_fields, **kwargs)
+
+
 class AircraftType(models.Model):
     manufacturer = models.CharField(
         max_length=50,
@@ -37,7 +158,9 @@ class Airline(models.Model):
         return self.name
 
 
-class Airframe(models.Model):
+class Airframe(ImageRenditionsMixin):
+    IMAGE_FIELD = 'photo'
+
     serial_number = models.CharField(
         max_length=50,
         verbose_name='Серийный номер'
@@ -80,7 +203,7 @@ class Airframe(models.Model):
         return f'Борт {self.registration_number}'
 
 
-class FlightInfo(models.Model):
+class FlightInfo(DirtyFieldsMixin):
     DEPARTURE = 'Departure'
     ARRIVAL = 'Arrival'
     STATUS_CHOICES = [
@@ -137,13 +260,27 @@ class FlightInfo(models.Model):
         verbose_name = 'Дополнительная информация о полете'
         verbose_name_plural = 'Дополнительная информация о полете'
         unique_together = ('flight', 'airport_code')
+        constraints = [
+            # У полета ровно один вылет и один прилет; индекс покрывает поиск flightinfo по (flight, status)
+            models.UniqueConstraint(fields=['flight', 'status'], name='flightinfo_flight_status_uniq'),
+        ]
+        indexes = [
+            models.Index(fields=['airport_code'], name='flightinfo_airport_code_idx'),
+            # Частичные индексы для подзапросов "код аэропорта вылета/прилета полета"
+            models.Index(fields=['flight', 'airport_code'], condition=models.Q(status='Departure'),
+                         name='flightinfo_departure_idx'),
+            models.Index(fields=['flight', 'airport_code'], condition=models.Q(status='Arrival'),
+                         name='flightinfo_arrival_idx'),
+        ]
 
     def __str__(self):
         tail = self.status + ': ' + self.airport_code
         return f'{self.flight.__str__()}/{tail}'
 
 
-class Flight(models.Model):
+class Flight(DirtyFieldsMixin):
+    objects = TripDeletionQuerySet.as_manager()
+
     flight_number = models.CharField(
         max_length=50,
         verbose_name='Номер рейса'
@@ -169,27 +306,32 @@ class Flight(models.Model):
         verbose_name = 'Совершенный полет'
         verbose_name_plural = 'Совершенные полеты'
         unique_together = ('flight_number', 'date')
+        indexes = [
+            # Поиск полетов борта (удаление борта без полетов) вместе с сортировкой по дате
+            models.Index(fields=['airframe', 'date'], name='flight_airframe_date_idx'),
+        ]
 
     def __str__(self):
         return f'Совершенный полет {self.flight_number}/{self.date}'
 
     def delete(self, using=None, keep_parents=False):
-        airframe = self.airframe
-        other_flight_count = Flight.objects.filter(airframe=airframe).exclude(pk=self.pk).count()
-        if other_flight_count == 0:
-            airframe.delete(using=using, keep_parents=keep_parents)
-        super(Flight, self).delete(using=using, keep_parents=keep_parents)
+        # Вместе с путешествиями и бортом, если у него не остается полетов
+        return Flight.objects.filter(pk=self.pk).delete()
 
 
 class UserTrip(models.Model):
+    objects = TripDeletionQuerySet.as_manager()
+
     flight = models.ForeignKey(
         to='Flight',
         on_delete=models.CASCADE,
         verbose_name='Полет'
     )
+    # Путешествия пользователя удаляет обработчик pre_delete (signals.delete_passenger_trips) одним
+    # набором запросов: каскад Collector собрал бы их и вызвал обработчики удаления для каждой строки
     passenger = models.ForeignKey(
         to=User,
-        on_delete=models.CASCADE,
+        on_delete=models.DO_NOTHING,
         verbose_name='Пассажир'
     )
     seat = models.CharField(
@@ -222,6 +364,10 @@ class UserTrip(models.Model):
         verbose_name = 'Путешествие пользователя'
         verbose_name_plural = 'Путешествия пользователей'
         unique_together = ('flight', 'passenger')
+        indexes = [
+            # unique_together начинается с flight, для выборок по пассажиру нужен свой порядок колонок
+            models.Index(fields=['passenger', 'flight'], name='usertrip_passenger_flight_idx'),
+        ]
 
     def save(self, *args, **kwargs):
         if not self.slug:
@@ -233,14 +379,13 @@ class UserTrip(models.Model):
         return f"Путешествие {self.flight.flight_number}-{self.flight.date}-{self.passenger.username}"
 
     def delete(self, using=None, keep_parents=False):
-        flight = self.flight
-        other_usertrip_count = UserTrip.objects.filter(flight=flight).exclude(pk=self.pk).count()
-        if other_usertrip_count == 0:
-            flight.delete(using=using, keep_parents=keep_parents)
-        super(UserTrip, self).delete(using=using, keep_parents=keep_parents)
+        # Вместе с полетом и бортом, если на них больше никто не ссылается
+        return UserTrip.objects.filter(pk=self.pk).delete()
 
 
-class TrackImage(models.Model):
+class TrackImage(ImageRenditionsMixin):
+    IMAGE_FIELD = 'track_img'
+
     trip = models.ForeignKey(
         to='UserTrip',
         on_delete=models.CASCADE,
@@ -268,7 +413,9 @@ class TrackImage(models.Model):
         return f'Трэк {str(self.track_img.url)}'
 
 
-class Meal(models.Model):
+class Meal(ImageRenditionsMixin):
+    IMAGE_FIELD = 'meal_photo'
+
     trip = models.ForeignKey(
         to='UserTrip',
         on_delete=models.CASCADE,
@@ -303,3 +450,310 @@ class Meal(models.Model):
 
     def __str__(self):
         return f'Питание на рейсе {self.trip.flight.flight_number}/{self.trip.flight.date}'
+
+
+class TripCard(models.Model):
+    '''Денормализованная карточка путешествия для главной страницы.
+    Заполняется обработчиками из signals.py, поэтому главная страница читает одну таблицу'''
+
+    trip = models.OneToOneField(
+        to='UserTrip',
+        on_delete=models.CASCADE,
+        primary_key=True,
+        related_name='card',
+        verbose_name='Путешествие'
+    )
+    photo_url = models.CharField(
+        max_length=255,
+        blank=True,
+        verbose_name='Фото ВС'
+    )
+    photo_renditions = models.JSONField(
+        default=dict,
+        blank=True,
+        verbose_name='Уменьшенные копии фото ВС'
+    )
+    flight_number = models.CharField(
+        max_length=50,
+        verbose_name='Номер рейса'
+    )
+    date = models.DateField(
+        verbose_name='Дата полета'
+    )
+    passenger = models.CharField(
+        max_length=150,
+        verbose_name='Пассажир'
+    )
+    airline = models.CharField(
+        max_length=100,
+        blank=True,
+        verbose_name='Авиакомпания'
+    )
+    aircraft_type = models.CharField(
+        max_length=101,
+        blank=True,
+        verbose_name='Тип ВС'
+    )
+    departure = models.CharField(
+        max_length=4,
+        blank=True,
+        verbose_name='Аэропорт вылета'
+    )
+    destination = models.CharField(
+        max_length=4,
+        blank=True,
+        verbose_name='Аэропорт прилета'
+    )
+    slug = models.SlugField(
+        db_index=False,
+        verbose_name='Слаг путешествия'
+    )
+
+    class Meta:
+        verbose_name = 'Карточка путешествия'
+        verbose_name_plural = 'Карточки путешествий'
+        indexes = [
+            # Keyset-пагинация полетов в профиле: WHERE passenger = ... ORDER BY date DESC, trip_id
+            models.Index(fields=['passenger', '-date', 'trip'], name='tripcard_passenger_date_idx'),
+        ]
+
+    def __str__(self):
+        return f'Карточка {self.slug}'
+
+
+class PassengerStats(models.Model):
+    '''Статистика пассажира, которая показывается в списке пассажиров и в профиле.
+    Пересчитывается обработчиками из signals.py только для затронутых пассажиров'''
+
+    passenger = models.OneToOneField(
+        to=User,
+        on_delete=models.CASCADE,
+        primary_key=True,
+        related_name='stats',
+        verbose_name='Пассажир'
+    )
+    total_flights = models.PositiveIntegerField(
+        default=0,
+        verbose_name='Количество полетов'
+    )
+    total_airlines = models.PositiveIntegerField(
+        default=0,
+        verbose_name='Количество авиакомпаний'
+    )
+    total_aircraft_types = models.PositiveIntegerField(
+        default=0,
+        verbose_name='Количество типов ВС'
+    )
+    total_airports = models.PositiveIntegerField(
+        default=0,
+        verbose_name='Количество аэропортов'
+    )
+
+    class Meta:
+        verbose_name = 'Статистика пассажира'
+        verbose_name_plural = 'Статистика пассажиров'
+
+    def __str__(self):
+        return f'Статистика {self.passenger_id}'
+
+
+class SiteCounter(models.Model):
+    '''Счетчик ссылок на авиакомпанию, тип ВС, борт или аэропорт.
+    Единица ссылки - одна запись FlightInfo, как в исходном запросе статистики сайта'''
+
+    AIRLINE = 'airline'
+    AIRCRAFT_TYPE = 'aircraft_type'
+    AIRFRAME = 'airframe'
+    AIRPORT = 'airport'
+    KIND_CHOICES = [
+        (AIRLINE, 'Airline'),
+        (AIRCRAFT_TYPE, 'Aircraft type'),
+        (AIRFRAME, 'Airframe'),
+        (AIRPORT, 'Airport'),
+    ]
+
+    kind = models.CharField(
+        max_length=20,
+        choices=KIND_CHOICES,
+        verbose_name='Вид'
+    )
+    key = models.CharField(
+        max_length=100,
+        verbose_name='Ключ'
+    )
+    refcount = models.PositiveIntegerField(
+        default=0,
+        verbose_name='Количество ссылок'
+    )
+
+    class Meta:
+        verbose_name = 'Счетчик ссылок'
+        verbose_name_plural = 'Счетчики ссылок'
+        unique_together = ('kind', 'key')
+
+    def __str__(self):
+        return f'{self.kind}:{self.key}={self.refcount}'
+
+
+class SiteTotal(models.Model):
+    '''Количество уникальных значений каждого вида (строк SiteCounter с refcount > 0)'''
+
+    kind = models.CharField(
+        max_length=20,
+        choices=SiteCounter.KIND_CHOICES,
+        primary_key=True,
+        verbose_name='Вид'
+    )
+    value = models.PositiveIntegerField(
+        default=0,
+        verbose_name='Значение'
+    )
+
+    class Meta:
+        verbose_name = 'Итог по сайту'
+        verbose_name_plural = 'Итоги по сайту'
+
+    def __str__(self):
+        return f'{self.kind}={self.value}'
+
+
+class AppliedFixture(models.Model):
+    '''Хеш содержимого фикстуры, загруженной командой bootstrap.
+    Если хеш файла не изменился, повторная загрузка при старте контейнера пропускается'''
+
+    name = models.CharField(
+        max_length=255,
+        unique=True,
+        verbose_name='Файл фикстуры'
+    )
+    sha256 = models.CharField(
+        max_length=64,
+        verbose_name='SHA-256 содержимого'
+    )
+    applied_at = models.DateTimeField(
+        auto_now=True,
+        verbose_name='Загружена'
+    )
+
+    class Meta:
+        verbose_name = 'Загруженная фикстура'
+        verbose_name_plural = 'Загруженные фикстуры'
+
+    def __str__(self):
+        return f'{self.name}:{self.sha256[:12]}'
+
+
+class Job(models.Model):
+    '''Фоновая задача (см. flights/jobs.py). Выполненные задачи удаляются,
+    исчерпавшие попытки остаются со статусом failed для разбора'''
+
+    QUEUED = 'queued'
+    FAILED = 'failed'
+    STATUS_CHOICES = [
+        (QUEUED, 'Queued'),
+        (FAILED, 'Failed'),
+    ]
+
+    kind = models.CharField(
+        max_length=100,
+        verbose_name='Задача'
+    )
+    payload = models.JSONField(
+        default=dict,
+        blank=True,
+        verbose_name='Аргументы'
+    )
+    status = models.CharField(
+        max_length=10,
+        choices=STATUS_CHOICES,
+        default=QUEUED,
+        verbose_name='Статус'
+    )
+    attempts = models.PositiveSmallIntegerField(
+        default=0,
+        verbose_name='Попытки'
+    )
+    max_attempts = models.PositiveSmallIntegerField(
+        default=5,
+        verbose_name='Максимум попыток'
+    )
+    run_after = models.DateTimeField(
+        default=timezone.now,
+        verbose_name='Выполнить после'
+    )
+    last_error = models.TextField(
+        blank=True,
+        verbose_name='Последняя ошибка'
+    )
+    created_at = models.DateTimeField(
+        auto_now_add=True,
+        verbose_name='Создана'
+    )
+
+    class Meta:
+        verbose_name = 'Фоновая задача'
+        verbose_name_plural = 'Фоновые задачи'
+        indexes = [
+            # Выборка воркера: WHERE status = 'queued' AND run_after <= now ORDER BY run_after
+            models.Index(fields=['run_after'], condition=models.Q(status='queued'), name='job_queued_idx'),
+        ]
+
+    def __str__(self):
+        return f'{self.kind} #{self.pk} ({self.status})'
+
+
+class MediaBlob(models.Model):
+    '''Содержимое загруженного файла, хранится один раз под именем из SHA-256 (см. flights/storage.py).
+    refcount - число логических имен MediaFile, ссылающихся на содержимое'''
+
+    sha256 = models.CharField(
+        max_length=64,
+        primary_key=True,
+        verbose_name='SHA-256'
+    )
+    name = models.CharField(
+        max_length=255,
+        verbose_name='Путь в хранилище'
+    )
+    size = models.PositiveBigIntegerField(
+        verbose_name='Размер, байт'
+    )
+    refcount = models.PositiveIntegerField(
+        default=0,
+        verbose_name='Количество ссылок'
+    )
+
+    class Meta:
+        verbose_name = 'Содержимое файла'
+        verbose_name_plural = 'Содержимое файлов'
+
+    def __str__(self):
+        return f'{self.name} ({self.refcount})'
+
+
+class MediaFile(models.Model):
+    '''Логическое имя файла, которое хранится в полях моделей, и его содержимое'''
+
+    name = models.CharField(
+        max_length=255,
+        unique=True,
+        verbose_name='Имя файла'
+    )
+    blob = models.ForeignKey(
+        to='MediaBlob',
+        on_delete=models.PROTECT,
+        related_name='files',
+        verbose_name='Содержимое'
+    )
+    # gc_media не трогает свежие имена: модель, сохраняющая файл, может быть еще не закоммичена
+    created_at = models.DateTimeField(
+        auto_now_add=True,
+        verbose_name='Создан'
+    )
+
+    class Meta:
+        verbose_name = 'Файл'
+        verbose_name_plural = 'Файлы'
+
+    def __str__(self):
+        return self.name
@@ -0,0 +1,114 @@
+import base64
+import json
+
+from django.core.exceptions import BadRequest, ValidationError
+from django.core.serializers.json import DjangoJSONEncoder
+from django.db.models import Q
+from django.http import JsonResponse
+
+
+class KeysetPage:
+    def __init__(self, object_list, next_cursor):
+        self.object_list = object_list
+        self.next_cursor = next_cursor
+
+    def has_next(self):
+        return self.next_cursor is not None
+
+    def __iter__(self):
+        return iter(self.object_list)
+
+    def __len__(self):
+        return len(self.object_list)
+
+
+class KeysetPaginator:
+    '''Постраничный вывод по ключу сортировки (keyset / seek).
+    Следующая страница выбирается условием "после последней строки", а не OFFSET,
+    поэтому стоимость не растет с номером страницы, а курсор не сдвигается при вставках.
+    Последнее поле ordering должно быть уникальным'''
+
+    def __init__(self, queryset, ordering, per_page):
+        self.queryset = queryset
+        self.ordering = tuple(ordering)
+        self.per_page = per_page
+
+    @staticmethod
+    def get_value(item, field):
+        return item[field] if isinstance(item, dict) else getattr(item, field)
+
+    def encode_cursor(self, item):
+        values = [self.get_value(item, field.lstrip('-')) for field in self.ordering]
+        raw = json.dumps(values, cls=DjangoJSONEncoder).encode()
+        return base64.urlsafe_b64encode(raw).decode().rstrip('=')
+
+    def decode_cursor(self, cursor):
+        try:
+            raw = base64.urlsafe_b64decode(cursor + '=' * (-len(cursor) % 4))
+            values = json.loads(raw)
+        except ValueError:
+            raise BadRequest('Invalid cursor')
+
+        if not isinstance(values, list) or len(values) != len(self.ordering):
+            raise BadRequest('Invalid cursor')
+
+        opts = self.queryset.model._meta
+        try:
+            return [opts.get_field(field.lstrip('-')).to_python(value)
+                    for field, value in zip(self.ordering, values)]
+        except ValidationError:
+            raise BadRequest('Invalid cursor')
+
+    def get_seek_filter(self, values):
+        # (a, b) после (x, y): a > x ИЛИ (a = x И b > y); для убывающих полей знак меняется
+        seek_filter = Q()
+        equal = {}
+
+        for field, value in zip(self.ordering, values):
+            name = field.lstrip('-')
+            lookup = 'lt' if field.startswith('-') else 'gt'
+            seek_filter |= Q(**equal, **{f'{name}__{lookup}': value})
+            equal[name] = value
+
+        return seek_filter
+
+    def get_page(self, cursor=None):
+        queryset = self.queryset.order_by(*self.ordering)
+        if cursor:
+            queryset = queryset.filter(self.get_seek_filter(self.decode_cursor(cursor)))
+
+        items = list(queryset[:self.per_page + 1])
+        next_cursor = None
+        if len(items) > self.per_page:
+            items = items[:self.per_page]
+            next_cursor = self.encode_cursor(items[-1])
+
+        return KeysetPage(items, next_cursor)
+
+
+class KeysetPaginationMixin:
+    '''Keyset-пагинация для ListView и других представлений.
+    Курсор передается параметром ?cursor=, ?format=json возвращает страницу в JSON'''
+
+    keyset_ordering = None
+    paginate_by = 50
+    cursor_kwarg = 'cursor'
+
+    def get_cursor(self):
+        return self.request.GET.get(self.cursor_kwarg)
+
+    def paginate_keyset(self, queryset, ordering=None, per_page=None):
+        paginator = KeysetPaginator(queryset, ordering or self.keyset_ordering, per_page or self.paginate_by)
+        return paginator, paginator.get_page(self.get_cursor())
+
+    def paginate_queryset(self, queryset, page_size):
+        # Точка расширения MultipleObjectMixin.get_context_data
+        paginator, page = self.paginate_keyset(queryset, per_page=page_size)
+        return paginator, page, page.object_list, page.has_next()
+
+    def wants_json(self):
+        return self.request.GET.get('format') == 'json'
+
+    @staticmethod
+    def render_json_page(page, **extra):
+        return JsonResponse({**extra, 'results': list(page.object_list), 'next_cursor': page.next_cursor})
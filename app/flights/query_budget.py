@@ -0,0 +1,93 @@
+import logging
+import re
+import time
+from collections import Counter
+from dataclasses import dataclass, field
+from typing import Optional
+
+from django.db import connections
+
+logger = logging.getLogger('flights.query_budget')
+
+
+class QueryBudgetExceeded(Exception):
+    pass
+
+
+@dataclass(frozen=True)
+class QueryBudget:
+    '''Допустимое число запросов и время в БД на один HTTP-запрос к представлению.
+    Объявляется атрибутом query_budget класса представления (или словарем {метод: бюджет})'''
+
+    queries: int
+    db_time_ms: Optional[float] = None
+    # Сколько раз допустимо выполнить один и тот же SELECT (1 - повторы запрещены)
+    max_repeats: int = 1
+
+
+@dataclass
+class QueryReport:
+    view: str
+    queries: int = 0
+    db_time_ms: float = 0.0
+    # Текст SELECT без параметров -> число выполнений
+    statements: Counter = field(default_factory=Counter)
+
+    def get_duplicates(self, max_repeats=1):
+        return {sql: count for sql, count in self.statements.items() if count > max_repeats}
+
+    def get_violations(self, budget):
+        if budget is None:
+            return []
+
+        violations = []
+        if self.queries > budget.queries:
+            violations.append(f'{self.queries} queries, budget {budget.queries}')
+        if budget.db_time_ms is not None and self.db_time_ms > budget.db_time_ms:
+            violations.append(f'{self.db_time_ms:.1f} ms in DB, budget {budget.db_time_ms} ms')
+        for sql, count in self.get_duplicates(budget.max_repeats).items():
+            violations.append(f'{count} executions of {sql}')
+
+        return violations
+
+    def as_dict(self):
+        return {
+            'view': self.view,
+            'queries': self.queries,
+            'db_time_ms': round(self.db_time_ms, 2),
+            'duplicates': len(self.get_duplicates()),
+        }
+
+
+class QueryRecorder:
+    '''Считает запросы всех подключений через execute_wrapper, поэтому работает и без DEBUG'''
+
+    WHITESPACE = re.compile(r'\s+')
+
+    def __init__(self, view=''):
+        self.report = QueryReport(view=view)
+        self._wrappers = []
+
+    def __call__(self, execute, sql, params, many, context):
+        started = time.perf_counter()
+        try:
+            return execute(sql, params, many, context)
+        finally:
+            self.report.queries += 1
+            self.report.db_time_ms += (time.perf_counter() - started) * 1000
+
+            # N+1 - это один и тот же SELECT с разными параметрами, поэтому сравниваем текст без них
+            statement = self.WHITESPACE.sub(' ', sql).strip()
+            if statement.upper().startswith('SELECT'):
+                self.report.statements[statement] += 1
+
+    def __enter__(self):
+        for connection in connections.all():
+            wrapper = connection.execute_wrapper(self)
+            wrapper.__enter__()
+            self._wrappers.append(wrapper)
+        return self.report
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        while self._wrappers:
+            self._wrappers.pop().__exit__(exc_type, exc_value, traceback)
@@ -0,0 +1,195 @@
+import logging
+import os
+from io import BytesIO
+
+from django.core.files.base import ContentFile
+from django.core.files.storage import default_storage
+from PIL import Image, ImageOps, UnidentifiedImageError
+
+logger = logging.getLogger('flights.renditions')
+
+# Размер -> наибольшие ширина и высота. Порядок от большего к меньшему:
+# каждая копия уменьшается из предыдущей, а не из оригинала
+RENDITIONS = {
+    'detail': (1024, 768),
+    'card': (480, 360),
+    'thumb': (160, 160),
+}
+
+# Формат -> (формат Pillow, параметры сохранения)
+FORMATS = {
+    'webp': ('WEBP', {'quality': 80, 'method': 4}),
+    'jpeg': ('JPEG', {'quality': 82, 'optimize': True, 'progressive': True}),
+}
+
+CONTENT_TYPES = {
+    'webp': 'image/webp',
+    'jpeg': 'image/jpeg',
+}
+
+# Общие файлы-заглушки синтетических данных (DatasetGenerator): обработчики удаления изображений
+# и сборщик мусора их не трогают
+PLACEHOLDER_DIR = 'placeholders'
+
+
+def is_placeholder(image):
+    '''image - FieldFile или имя файла'''
+
+    name = getattr(image, 'name', image)
+    return bool(name) and name.startswith(f'{PLACEHOLDER_DIR}/')
+
+
+def get_rendition_name(name, rendition, format):
+    '''Копия лежит рядом с оригиналом: airframes/x/ra-123.jpg -> airframes/x/ra-123.card.webp'''
+
+    root, _ = os.path.splitext(name)
+    return f'{root}.{rendition}.{format}'
+
+
+def is_current(renditions, name):
+    return bool(name) and renditions.get('source') == name
+
+
+def open_image(file):
+    image = Image.open(file)
+    # JPEG декодируется сразу в уменьшенном масштабе (DCT scaling), если оригинал намного больше копий
+    image.draft('RGB', RENDITIONS['detail'])
+    image = ImageOps.exif_transpose(image)
+
+    if image.mode not in ('RGB', 'L'):
+        # У JPEG нет прозрачности: подкладываем белый фон
+        background = Image.new('RGB', image.size, (255, 255, 255))
+        image = image.convert('RGBA')
+        background.paste(image, mask=image.getchannel('A'))
+        image = background
+
+    return image
+
+
+def render_rendition_files(name, storage=None):
+    '''Создает все размеры и форматы изображения name в памяти, ничего не записывая.
+    Возвращает реестр, где вместо сохраненных имен - имена рядом с оригиналом, и содержимое по этим именам'''
+
+    storage = storage or default_storage
+
+    with storage.open(name) as file:
+        image = open_image(file)
+        image.load()
+
+    registry = {'source': name}
+    files = {}
+    entry = None
+    for rendition, box in RENDITIONS.items():
+        size = image.size
+        image.thumbnail(box, Image.LANCZOS)
+        # Небольшой оригинал не уменьшается: меньшие размеры ссылаются на те же файлы
+        if entry is not None and image.size == size:
+            registry[rendition] = entry
+            continue
+
+        entry = {'width': image.width, 'height': image.height}
+        for format, (pil_format, options) in FORMATS.items():
+            buffer = BytesIO()
+            image.save(buffer, pil_format, **options)
+
+            entry[format] = get_rendition_name(name, rendition, format)
+            files[entry[format]] = buffer.getvalue()
+
+        registry[rendition] = entry
+
+    return registry, files
+
+
+def save_renditions(registry, files, storage=None):
+    '''Записывает копии из render_rendition_files в хранилище и возвращает реестр с сохраненными именами'''
+
+    storage = storage or default_storage
+
+    if hasattr(storage, 'get_blob_names'):
+        # Имена копий проверяются одним запросом, файлы до перехода на адресацию по содержимому - на диске
+        existing = {path for path, blob_name in storage.get_blob_names(list(files)).items()
+                    if blob_name or os.path.lexists(storage.raw_path(path))}
+    else:
+        existing = {path for path in files if storage.exists(path)}
+
+    saved = {}
+    for path, content in files.items():
+        # Повторная генерация перезаписывает копии, а не создает файлы с суффиксами
+        if path in existing:
+            storage.delete(path)
+        saved[path] = storage.save(path, ContentFile(content))
+
+    for rendition in RENDITIONS:
+        entry = registry.get(rendition)
+        for format in FORMATS:
+            entry[format] = saved.get(entry[format], entry[format])
+
+    if hasattr(storage, 'get_blob_names'):
+        attach_blobs(registry, storage.get_blob_names(get_rendition_paths(registry)))
+
+    return registry
+
+
+def render_renditions(name, storage=None):
+    '''Создает все размеры и форматы изображения name рядом с ним.
+    Возвращает реестр для поля renditions модели'''
+
+    storage = storage or default_storage
+    return save_renditions(*render_rendition_files(name, storage), storage)
+
+
+def render_renditions_safe(name):
+    '''Вариант render_rendition_files для пула процессов: ошибки возвращаются, а не выбрасываются.
+    Файлы записывает родительский процесс, поэтому дочерние процессы не пишут в БД хранилища'''
+
+    try:
+        return name, render_rendition_files(name), None
+    except (OSError, UnidentifiedImageError, Image.DecompressionBombError) as error:
+        return name, None, str(error)
+
+
+def get_rendition_paths(renditions):
+    return list(dict.fromkeys(entry[format]
+                              for rendition, entry in renditions.items() if rendition in RENDITIONS
+                              for format in FORMATS if entry.get(format)))
+
+
+def attach_blobs(registry, blob_names):
+    '''Добавляет в записи реестра имена содержимого копий в ContentAddressedStorage
+    (blob_names: логическое имя -> имя содержимого). По ним шаблоны строят неизменяемые URL без запросов к БД'''
+
+    for rendition in RENDITIONS:
+        entry = registry.get(rendition)
+        if not entry:
+            continue
+        blobs = {format: blob_names[entry[format]] for format in FORMATS if blob_names.get(entry.get(format))}
+        if blobs:
+            entry['blobs'] = blobs
+        else:
+            entry.pop('blobs', None)
+
+    return registry
+
+
+def update_renditions(instance):
+    '''Создает копии изображения экземпляра, если реестр устарел.
+    Реестр записывается через update(), чтобы не вызывать сигналы сохранения повторно'''
+
+    image = instance.get_image()
+    if not image:
+        renditions = {}
+    elif is_current(instance.renditions, image.name):
+        return False
+    else:
+        try:
+            renditions = render_renditions(image.name, image.storage)
+        except (OSError, UnidentifiedImageError, Image.DecompressionBombError) as error:
+            logger.warning('Cannot render %s: %s', image.name, error)
+            renditions = {}
+
+    if renditions == instance.renditions:
+        return False
+
+    instance.renditions = renditions
+    type(instance).objects.filter(pk=instance.pk).update(renditions=renditions)
+    return True
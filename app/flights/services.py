@@ -1,8 +1,744 @@
+import logging
+from collections import Counter
+
 from django.contrib.auth.models import User
-from django.db.models import Count, F, Prefetch
-from django.db.models.functions import Concat
+from django.core.exceptions import ValidationError
+from django.db import connection, transaction
+from django.db.models import (Case, CharField, Count, Exists, F, FilteredRelation, JSONField, OuterRef, Prefetch, Q,
+                              Subquery, Value, When)
+from django.db.models.functions import Coalesce, Concat, Trim
+from django.utils.text import slugify
+
+from .cache import HomePageCache
+from .dto import FlightDetails, FlightInfoDetails
+from .identity_map import RequestIdentityMap
+from .signal_mute import SignalMute
+from .jobs import enqueue, enqueue_many
+from .renditions import get_rendition_paths, is_placeholder
+from .upsert import RoundTripCounter, increment, insert_from_select, insert_or_get, supports_insert_returning
+from .models import (AircraftType, Airline, Airframe, UserTrip, Flight, FlightInfo, TripCard, PassengerStats,
+                     SiteCounter, SiteTotal, TrackImage, Meal)
+
+logger = logging.getLogger('flights.services')
+
+
+class TripCardService:
+    '''Поддержка денормализованной таблицы TripCard в актуальном состоянии'''
+
+    CARD_FIELDS = ('photo_url', 'photo_renditions', 'flight_number', 'date', 'passenger', 'airline',
+                   'aircraft_type', 'departure', 'destination')
+
+    @staticmethod
+    def get_dependent_trips(instance):
+        '''Путешествия, карточки которых содержат данные из instance'''
+
+        if isinstance(instance, UserTrip):
+            return UserTrip.objects.filter(pk=instance.pk)
+        if isinstance(instance, Flight):
+            return UserTrip.objects.filter(flight_id=instance.pk)
+        if isinstance(instance, FlightInfo):
+            return UserTrip.objects.filter(flight_id=instance.flight_id)
+        if isinstance(instance, Airframe):
+            return UserTrip.objects.filter(flight__airframe_id=instance.pk)
+        if isinstance(instance, Airline):
+            return UserTrip.objects.filter(flight__airframe__airline_id=instance.pk)
+        if isinstance(instance, AircraftType):
+            return UserTrip.objects.filter(flight__airframe__aircraft_type_id=instance.pk)
+
+        return UserTrip.objects.none()
+
+    @staticmethod
+    def get_card_values(trips):
+        '''Значения полей карточек для queryset путешествий, вычисленные в SQL.
+        Колонки идут в порядке ('trip_id', 'slug', *CARD_FIELDS), как нужно insert_from_select'''
+
+        def airport_code(status):
+            return Coalesce(Subquery(FlightInfo.objects
+                                     .filter(flight=OuterRef('flight'), status=status)
+                                     .values('airport_code')[:1]),
+                            Value(''))
+
+        def text(field):
+            return Coalesce(field, Value(''), output_field=CharField())
+
+        aircraft_type = Trim(Concat(text('flight__airframe__aircraft_type__manufacturer'), Value(' '),
+                                    text('flight__airframe__aircraft_type__generic_type'),
+                                    output_field=CharField()))
+
+        # Аннотации идут в SELECT после полей модели в порядке объявления - это порядок CARD_FIELDS
+        return trips \
+            .annotate(card_photo_url=text('flight__airframe__photo'),
+                      card_photo_renditions=Coalesce('flight__airframe__renditions',
+                                                     Value({}, output_field=JSONField())),
+                      card_flight_number=F('flight__flight_number'),
+                      card_date=F('flight__date'),
+                      card_passenger=F('passenger__username'),
+                      card_airline=text('flight__airframe__airline__name'),
+                      card_aircraft_type=aircraft_type,
+                      card_departure=airport_code(FlightInfo.DEPARTURE),
+                      card_destination=airport_code(FlightInfo.ARRIVAL)) \
+            .values_list('pk', 'slug', *(f'card_{field}' for field in TripCardService.CARD_FIELDS))
+
+    @staticmethod
+    def build_cards(trips):
+        '''Собирает карточки для queryset путешествий одним запросом'''
+
+        return [TripCard(trip_id=pk, slug=slug, **dict(zip(TripCardService.CARD_FIELDS, values)))
+                for pk, slug, *values in TripCardService.get_card_values(trips)]
+
+    @staticmethod
+    def refresh(trips, create=True):
+        '''Пересчитывает карточки путешествий одним запросом INSERT ... SELECT ... ON CONFLICT DO UPDATE
+        (без него - чтение и bulk_create). Возвращает число пересчитанных карточек.
+        С create=False обновляются только существующие карточки: так безопасно вызывать
+        из post_delete, когда часть путешествий уже удалена каскадом'''
+
+        update_fields = TripCardService.CARD_FIELDS + ('slug',)
+        if not create:
+            trips = trips.filter(card__isnull=False)
+
+        if supports_insert_returning(connection):
+            return insert_from_select(TripCard, ('trip_id', 'slug', *TripCardService.CARD_FIELDS),
+                                      TripCardService.get_card_values(trips), ('trip_id',), update_fields)
+
+        cards = TripCardService.build_cards(trips)
+        if not create:
+            TripCard.objects.bulk_update(cards, update_fields)
+        else:
+            TripCard.objects.bulk_create(cards,
+                                         update_conflicts=True,
+                                         unique_fields=['trip'],
+                                         update_fields=update_fields)
+        return len(cards)
+
+    @staticmethod
+    def rename_passenger(user):
+        '''Имя пассажира хранится в карточках строкой (по нему ищет профиль), после переименования
+        пользователя оно обновляется одним UPDATE. Возвращает число обновленных карточек'''
+
+        return TripCard.objects \
+            .filter(trip__passenger=user) \
+            .exclude(passenger=user.username) \
+            .update(passenger=user.username)
+
+
+class PassengerStatsService:
+    '''Поддержка таблицы PassengerStats в актуальном состоянии.
+    При изменении данных пересчитывается статистика только затронутых пассажиров'''
+
+    STAT_FIELDS = ('total_flights', 'total_airlines', 'total_aircraft_types', 'total_airports')
+
+    @staticmethod
+    def get_aggregates():
+        return {
+            'total_flights': Count('usertrip', distinct=True),
+            'total_airlines': Count('usertrip__flight__airframe__airline', distinct=True),
+            'total_aircraft_types': Count('usertrip__flight__airframe__aircraft_type', distinct=True),
+            'total_airports': Count('usertrip__flight__flightinfo__airport_code', distinct=True),
+        }
+
+    @staticmethod
+    def get_affected_passengers(trips):
+        return trips.order_by().values_list('passenger_id', flat=True).distinct()
+
+    @staticmethod
+    def get_stats_values(users):
+        '''Статистика для queryset пользователей в порядке колонок ('passenger_id', *STAT_FIELDS)'''
+
+        return users.order_by().values_list('pk').annotate(**PassengerStatsService.get_aggregates())
+
+    @staticmethod
+    def compute(users):
+        '''Считает статистику для queryset пользователей одним запросом'''
+
+        return [PassengerStats(passenger_id=pk, **dict(zip(PassengerStatsService.STAT_FIELDS, values)))
+                for pk, *values in PassengerStatsService.get_stats_values(users)]
+
+    @staticmethod
+    def refresh(passenger_ids, create=True):
+        '''Пересчитывает статистику пассажиров одним запросом INSERT ... SELECT ... ON CONFLICT DO UPDATE
+        (без него - чтение и bulk_create). Возвращает число пересчитанных строк.
+        С create=False обновляются только существующие строки (безопасно для post_delete)'''
+
+        passenger_ids = list(passenger_ids)
+        if not passenger_ids:
+            return 0
+
+        users = User.objects.filter(pk__in=passenger_ids)
+        if not create:
+            users = users.filter(stats__isnull=False)
+
+        if supports_insert_returning(connection):
+            return insert_from_select(PassengerStats, ('passenger_id', *PassengerStatsService.STAT_FIELDS),
+                                      PassengerStatsService.get_stats_values(users), ('passenger_id',),
+                                      PassengerStatsService.STAT_FIELDS)
+
+        stats = PassengerStatsService.compute(users)
+        if not create:
+            PassengerStats.objects.bulk_update(stats, PassengerStatsService.STAT_FIELDS)
+        else:
+            PassengerStats.objects.bulk_create(stats,
+                                               update_conflicts=True,
+                                               unique_fields=['passenger'],
+                                               update_fields=PassengerStatsService.STAT_FIELDS)
+        return len(stats)
+
+    @staticmethod
+    def iterate_user_batches(batch_size=1000):
+        user_ids = User.objects.order_by('pk').values_list('pk', flat=True)
+
+        last_id = 0
+        while True:
+            batch = list(user_ids.filter(pk__gt=last_id)[:batch_size])
+            if not batch:
+                return
+
+            yield batch
+            last_id = batch[-1]
+
+    @staticmethod
+    def rebuild(batch_size=1000):
+        '''Полный пересчет статистики всех пользователей пачками'''
+
+        total = 0
+        for batch in PassengerStatsService.iterate_user_batches(batch_size):
+            total += PassengerStatsService.refresh(batch)
+
+        return total
+
+    @staticmethod
+    def find_inconsistencies(batch_size=1000):
+        '''Сравнивает сохраненную статистику с вычисленной заново.
+        Возвращает список (id пользователя, сохраненные значения, актуальные значения)'''
+
+        inconsistencies = []
+
+        for batch in PassengerStatsService.iterate_user_batches(batch_size):
+            stored = {stats.pk: stats for stats in PassengerStats.objects.filter(pk__in=batch)}
+
+            for actual in PassengerStatsService.compute(User.objects.filter(pk__in=batch)):
+                actual_values = {field: getattr(actual, field) for field in PassengerStatsService.STAT_FIELDS}
+                saved = stored.get(actual.pk)
+                saved_values = None if saved is None else \
+                    {field: getattr(saved, field) for field in PassengerStatsService.STAT_FIELDS}
+
+                if saved_values != actual_values:
+                    inconsistencies.append((actual.pk, saved_values, actual_values))
+
+        return inconsistencies
+
+
+class SiteCounterService:
+    '''Счетчики ссылок для статистики сайта. Каждая запись FlightInfo ссылается на свой аэропорт
+    и на авиакомпанию, тип ВС и борт своего полета. Уникальное значение считается, пока на него
+    есть хотя бы одна ссылка, а количество уникальных значений хранится в SiteTotal'''
+
+    @staticmethod
+    def get_airframe_references(airframe_id, airline_id, aircraft_type_id):
+        references = Counter()
+        if airframe_id is not None:
+            references[(SiteCounter.AIRFRAME, str(airframe_id))] += 1
+        if airline_id is not None:
+            references[(SiteCounter.AIRLINE, str(airline_id))] += 1
+        if aircraft_type_id is not None:
+            references[(SiteCounter.AIRCRAFT_TYPE, str(aircraft_type_id))] += 1
+        return references
+
+    @staticmethod
+    def get_flight_references(flight_id):
+        airframe = Flight.objects \
+            .filter(pk=flight_id) \
+            .values('airframe_id', 'airframe__airline_id', 'airframe__aircraft_type_id') \
+            .first()
+
+        if airframe is None:
+            return Counter()
+
+        return SiteCounterService.get_airframe_references(airframe['airframe_id'],
+                                                          airframe['airframe__airline_id'],
+                                                          airframe['airframe__aircraft_type_id'])
+
+    @staticmethod
+    def get_flight_info_references(airport_code, flight_id):
+        references = SiteCounterService.get_flight_references(flight_id)
+        references[(SiteCounter.AIRPORT, airport_code)] += 1
+        return references
+
+    @staticmethod
+    def scale(references, factor):
+        return Counter({key: value * factor for key, value in references.items()})
+
+    @staticmethod
+    def adjust(added=None, removed=None):
+        '''Применяет изменения счетчиков в одной транзакции: added увеличивает, removed уменьшает'''
+
+        deltas = Counter(added or {})
+        deltas.subtract(removed or {})
+        deltas = {key: delta for key, delta in deltas.items() if delta}
+
+        if not deltas:
+            return
+
+        if supports_insert_returning(connection) and min(deltas.values()) > 0:
+            SiteCounterService.increment(deltas)
+            return
+
+        keys_by_kind = {}
+        for kind, key in deltas:
+            keys_by_kind.setdefault(kind, []).append(key)
+        lookup = Q()
+        for kind, keys in keys_by_kind.items():
+            lookup |= Q(kind=kind, key__in=keys)
+
+        with transaction.atomic(savepoint=False):
+            # Недостающие счетчики создаются одним запросом, затем все нужные блокируются одним SELECT.
+            # Порядок блокировки по (kind, key) одинаков для всех транзакций и не дает взаимоблокировок
+            SiteCounter.objects.bulk_create(
+                [SiteCounter(kind=kind, key=key) for (kind, key), delta in deltas.items() if delta > 0],
+                ignore_conflicts=True
+            )
+            counters = {(counter.kind, counter.key): counter
+                        for counter in SiteCounter.objects.select_for_update().filter(lookup).order_by('kind', 'key')}
+
+            totals = Counter()
+            changed, emptied = [], []
+            for (kind, key), delta in deltas.items():
+                counter = counters.get((kind, key))
+                before = counter.refcount if counter is not None else 0
+                after = max(before + delta, 0)
+
+                if after:
+                    counter.refcount = after
+                    changed.append(counter)
+                elif counter is not None:
+                    emptied.append(counter.pk)
+
+                if not before and after:
+                    totals[kind] += 1
+                elif before and not after:
+                    totals[kind] -= 1
+
+            SiteCounter.objects.bulk_update(changed, ['refcount'])
+            if emptied:
+                SiteCounter.objects.filter(pk__in=emptied).delete()
+
+            # Итоги всех видов тоже двумя запросами: недостающие строки (нужны только для прибавлений),
+            # затем один UPDATE с CASE по виду
+            totals = {kind: delta for kind, delta in totals.items() if delta}
+            if totals:
+                missing = [SiteTotal(kind=kind) for kind, delta in totals.items() if delta > 0]
+                if missing:
+                    SiteTotal.objects.bulk_create(missing, ignore_conflicts=True)
+                SiteTotal.objects.filter(kind__in=totals).update(
+                    value=F('value') + Case(*(When(kind=kind, then=Value(delta)) for kind, delta in totals.items()),
+                                            default=Value(0))
+                )
+
+    @staticmethod
+    def increment(deltas):
+        '''Только прибавления: счетчики и итоги меняются двумя запросами INSERT ... ON CONFLICT DO UPDATE
+        без предварительного чтения и блокировки. Счетчик новый, если после прибавки в нем ровно прибавка'''
+
+        with transaction.atomic(savepoint=False):
+            refcounts = increment(SiteCounter, ('kind', 'key'), 'refcount', deltas)
+            totals = Counter(kind for (kind, key), refcount in refcounts.items() if refcount == deltas[(kind, key)])
+            increment(SiteTotal, ('kind',), 'value', {(kind,): delta for kind, delta in totals.items()})
+
+    @staticmethod
+    def compute_actual():
+        '''Считает правильные значения счетчиков по текущим данным'''
+
+        flight_infos = FlightInfo.objects.order_by()
+        sources = (
+            (SiteCounter.AIRPORT, 'airport_code'),
+            (SiteCounter.AIRLINE, 'flight__airframe__airline'),
+            (SiteCounter.AIRCRAFT_TYPE, 'flight__airframe__aircraft_type'),
+            (SiteCounter.AIRFRAME, 'flight__airframe'),
+        )
+
+        actual = {}
+        for kind, field in sources:
+            rows = flight_infos \
+                .filter(**{f'{field}__isnull': False}) \
+                .values_list(field) \
+                .annotate(refcount=Count('pk'))
+            actual.update({(kind, str(key)): refcount for key, refcount in rows})
+
+        return actual
+
+    @staticmethod
+    def reconcile(dry_run=False):
+        '''Исправляет расхождения счетчиков с данными. Возвращает список расхождений
+        в виде (вид, ключ, сохраненное значение, правильное значение)'''
+
+        with transaction.atomic():
+            actual = SiteCounterService.compute_actual()
+            stored = {(counter.kind, counter.key): counter
+                      for counter in SiteCounter.objects.select_for_update()}
+
+            drift = []
+            for key in stored.keys() | actual.keys():
+                stored_value = stored[key].refcount if key in stored else 0
+                actual_value = actual.get(key, 0)
+                if stored_value != actual_value:
+                    drift.append((*key, stored_value, actual_value))
+
+            actual_totals = Counter(kind for kind, _ in actual)
+            stored_totals = dict(SiteTotal.objects.values_list('kind', 'value'))
+            for kind, _ in SiteCounter.KIND_CHOICES:
+                if stored_totals.get(kind, 0) != actual_totals[kind]:
+                    drift.append((SiteTotal._meta.model_name, kind, stored_totals.get(kind, 0), actual_totals[kind]))
+
+            if dry_run or not drift:
+                return drift
+
+            stale = [counter.pk for key, counter in stored.items() if key not in actual]
+            SiteCounter.objects.filter(pk__in=stale).delete()
+            SiteCounter.objects.bulk_create(
+                [SiteCounter(kind=kind, key=key, refcount=refcount) for (kind, key), refcount in actual.items()],
+                update_conflicts=True,
+                unique_fields=['kind', 'key'],
+                update_fields=['refcount'],
+                batch_size=1000
+            )
+            SiteTotal.objects.bulk_create(
+                [SiteTotal(kind=kind, value=actual_totals[kind]) for kind, _ in SiteCounter.KIND_CHOICES],
+                update_conflicts=True,
+                unique_fields=['kind'],
+                update_fields=['value']
+            )
+
+        return drift
+
+
+class TripDeletionService:
+    '''Удаление путешествий вместе с полетами и бортами, на которые больше ничто не ссылается.
+    Сироты находятся запросами NOT EXISTS сразу для всего набора, строки удаляет QuerySet.delete() (Collector
+    учитывает все связи и on_delete) с отключенными обработчиками сигналов (SignalMute). Поэтому счетчики сайта,
+    статистика пассажиров и кеш главной страницы обновляются здесь, а файлы изображений удаляет воркер
+    пачками после коммита'''
+
+    FILE_BATCH_SIZE = 500
+
+    @staticmethod
+    def get_media_paths(queryset):
+        '''Изображения и их копии записей queryset, кроме общих заглушек'''
+
+        model = queryset.model
+        paths = []
+        for name, renditions in queryset.values_list(model.IMAGE_FIELD, 'renditions'):
+            if name and not is_placeholder(name):
+                paths += [name, *get_rendition_paths(renditions or {})]
+        return paths
+
+    @staticmethod
+    def delete_files(paths):
+        # Задачи создаются после коммита: при откате файлы остаются на месте
+        for start in range(0, len(paths), TripDeletionService.FILE_BATCH_SIZE):
+            enqueue('delete_files', paths=paths[start:start + TripDeletionService.FILE_BATCH_SIZE])
+
+    @staticmethod
+    def get_removed_references(flight_ids):
+        '''Ссылки счетчиков сайта, которые снимаются вместе с записями FlightInfo полетов'''
+
+        references = Counter()
+        rows = FlightInfo.objects \
+            .filter(flight_id__in=flight_ids) \
+            .values_list('airport_code', 'flight__airframe_id', 'flight__airframe__airline_id',
+                         'flight__airframe__aircraft_type_id')
+        for airport_code, *airframe in rows:
+            references.update(SiteCounterService.get_airframe_references(*airframe))
+            references[(SiteCounter.AIRPORT, airport_code)] += 1
+        return references
+
+    @staticmethod
+    def delete(trips=None, flights=None):
+        '''Удаляет путешествия trips и полеты flights (QuerySet) со всеми их путешествиями.
+        Полет удаляется, когда у него не остается путешествий, борт - когда не остается полетов.
+        Возвращает число удаленных строк по моделям'''
+
+        trips = UserTrip.objects.none() if trips is None else trips
+        flights = Flight.objects.none() if flights is None else flights
+
+        with transaction.atomic():
+            trip_rows = UserTrip.objects \
+                .filter(Q(pk__in=trips.values('pk')) | Q(flight__in=flights.values('pk'))) \
+                .values_list('pk', 'flight_id', 'passenger_id')
+            trip_ids, flight_ids, passenger_ids = [], set(flights.values_list('pk', flat=True)), set()
+            for trip_id, flight_id, passenger_id in trip_rows:
+                trip_ids.append(trip_id)
+                flight_ids.add(flight_id)
+                passenger_ids.add(passenger_id)
+
+            # Блокировка полетов и бортов не дает параллельному сохранению привязать к ним новое путешествие
+            # между поиском сирот и удалением
+            orphan_flights = dict(
+                Flight.objects
+                .select_for_update()
+                .filter(pk__in=flight_ids)
+                .filter(~Exists(UserTrip.objects.filter(flight=OuterRef('pk')).exclude(pk__in=trip_ids)))
+                .values_list('pk', 'airframe_id')
+            )
+            orphan_airframe_ids = list(
+                Airframe.objects
+                .select_for_update()
+                .filter(pk__in={airframe_id for airframe_id in orphan_flights.values() if airframe_id})
+                .filter(~Exists(Flight.objects.filter(airframe=OuterRef('pk')).exclude(pk__in=list(orphan_flights))))
+                .values_list('pk', flat=True)
+            )
+
+            paths = TripDeletionService.get_media_paths(TrackImage.objects.filter(trip_id__in=trip_ids)) \
+                + TripDeletionService.get_media_paths(Meal.objects.filter(trip_id__in=trip_ids)) \
+                + TripDeletionService.get_media_paths(Airframe.objects.filter(pk__in=orphan_airframe_ids))
+            removed_references = TripDeletionService.get_removed_references(list(orphan_flights))
+
+            # Каскады и on_delete выполняет Collector, обработчики сигналов отключены:
+            # счетчики, статистика, кеш и файлы обновляются ниже сразу для всего набора
+            deleted = Counter()
+            with SignalMute.muted():
+                for _, per_model in (
+                    UserTrip.objects.filter(pk__in=trip_ids).delete_rows(),
+                    Flight.objects.filter(pk__in=list(orphan_flights)).delete_rows(),
+                    Airframe.objects.filter(pk__in=orphan_airframe_ids).delete(),
+                ):
+                    deleted.update({label: count for label, count in per_model.items() if count})
+
+            SiteCounterService.adjust(removed=removed_references)
+            PassengerStatsService.refresh(passenger_ids, create=False)
+
+            TripDeletionService.delete_files(paths)
+            if deleted:
+                transaction.on_commit(HomePageCache.bump_generation)
+
+        RequestIdentityMap.clear()
+        return deleted
+
+
+class TrackImageService:
+    '''Изображения трэков путешествия. Любое число загрузок сохраняется одним bulk_create,
+    удаление - одним DELETE по списку ключей. Сигналы при этом не вызываются, поэтому задачи
+    создания копий и удаления файлов (пачками после коммита) ставятся здесь'''
+
+    @staticmethod
+    def add(trip, uploads):
+        '''Создает изображения трэков trip из загрузок, подготовленных UploadStager (см. flights/uploads.py)'''
+
+        track_images = [TrackImage(trip=trip) for _ in uploads]
+        for track_image, upload in zip(track_images, uploads):
+            track_image.track_img = upload.bind(track_image)
+
+        with transaction.atomic():
+            TrackImage.objects.bulk_create(track_images)
+            enqueue_many('render_renditions', ({'model': TrackImage._meta.label_lower, 'pk': track_image.pk,
+                                                'name': track_image.track_img.name} for track_image in track_images))
+
+        RequestIdentityMap.clear()
+        return track_images
+
+    @staticmethod
+    def delete(trip, ids):
+        '''Удаляет изображения трэков trip с ключами ids. Чужие ключи пропускаются. Возвращает число удаленных'''
+
+        if not ids:
+            return 0
+
+        with transaction.atomic():
+            track_images = TrackImage.objects.filter(trip=trip, pk__in=ids)
+            paths = TripDeletionService.get_media_paths(track_images.select_for_update())
+            with SignalMute.muted():
+                deleted, _ = track_images.delete()
+            TripDeletionService.delete_files(paths)
+
+        RequestIdentityMap.clear()
+        return deleted
+
+
+class FlightSaveService:
+    '''Сохранение нового путешествия из данных AddFlightForm.
+    Справочники, борт, полет и путешествие вставляются insert_or_get (INSERT ... ON CONFLICT DO NOTHING
+    RETURNING) по своим уникальным ключам: одновременные отправки одной авиакомпании, типа ВС или общего
+    полета не получают IntegrityError и не создают дублей.
+    Полет ищется первым вместе с бортом: если он уже есть, справочники и борт из формы не вставляются, его вылет
+    и прилет не меняются, а другой борт в форме - ошибка (ValidationError). Карточка, статистика пассажира
+    и счетчики сайта пересчитываются запросами INSERT ... ON CONFLICT DO UPDATE без чтения в Python.
+    Новое путешествие с новым полетом стоит 12 обращений к БД, к существующему полету - 5.
+    Если путешествие уже есть (повторная отправка формы),
+    питание не создается второй раз. Сигналы сохранения при этом не вызываются, поэтому карточка,
+    статистика пассажира и счетчики сайта обновляются здесь, как при импорте журнала'''
+
+    @staticmethod
+    def build_flight_infos(flight_id, data):
+        return [
+            FlightInfo(flight_id=flight_id,
+                       status=status,
+                       airport_code=data[f'{prefix}_airport_code'],
+                       metar=data[f'{prefix}_metar'],
+                       gate=data[f'{prefix}_gate'],
+                       is_boarding_bridge=data[f'{prefix}_is_boarding_bridge'],
+                       schedule_time=data[f'{prefix}_schedule_time'],
+                       actual_time=data[f'{prefix}_actual_time'],
+                       runway=data[f'{prefix}_runway'])
+            for status, prefix in ((FlightInfo.DEPARTURE, 'departure'), (FlightInfo.ARRIVAL, 'arrival'))
+        ]
+
+    @staticmethod
+    def save_airframe(data, airline, aircraft_type_id):
+        airframe = Airframe(serial_number=data['serial_number'],
+                            registration_number=data['registration_number'],
+                            airline=airline,
+                            aircraft_type_id=aircraft_type_id)
+        # Фото подготовлено вне транзакции (StagedUpload, см. flights/uploads.py), в строку пишется только имя.
+        # Файл публикуется после коммита, только если борт новый и на него сослался новый полет (см. save_flight)
+        photo = data['airframe_photo']
+        airframe.photo = str(photo) if photo else ''
+
+        airframe.pk, created = insert_or_get(
+            Airframe,
+            {'serial_number': airframe.serial_number, 'registration_number': airframe.registration_number},
+            {'airline_id': airline.pk, 'aircraft_type_id': aircraft_type_id, 'photo': airframe.photo.name},
+        )
+        return airframe, created
 
-from .models import UserTrip, Flight, FlightInfo
+    @staticmethod
+    def check_airframe(flight, data):
+        '''Полет выполняет один борт: другой борт в форме - ошибка ввода, а не новый борт полета'''
+
+        airframe = flight.airframe
+        if airframe is None:
+            return
+
+        if (airframe.serial_number, airframe.registration_number) != (data['serial_number'],
+                                                                      data['registration_number']):
+            raise ValidationError({'registration_number': ValidationError(
+                'Flight %(flight_number)s on %(date)s is already operated by %(registration_number)s '
+                '(serial number %(serial_number)s)',
+                code='airframe_conflict',
+                params={'flight_number': flight.flight_number,
+                        'date': flight.date,
+                        'registration_number': airframe.registration_number,
+                        'serial_number': airframe.serial_number},
+            )})
+
+    @staticmethod
+    def attach_airframe(flight, references):
+        '''Полету, борт которого был удален (SET_NULL), назначен борт из формы: записи FlightInfo полета
+        теперь ссылаются на борт, а карточки и статистика его пассажиров показывают его'''
+
+        flight_infos = FlightInfo.objects.filter(flight_id=flight.pk).count()
+        SiteCounterService.adjust(added=SiteCounterService.scale(
+            SiteCounterService.get_airframe_references(*references), flight_infos))
+
+        trips = UserTrip.objects.filter(flight_id=flight.pk)
+        TripCardService.refresh(trips)
+        PassengerStatsService.refresh(PassengerStatsService.get_affected_passengers(trips))
+
+    @staticmethod
+    def save_flight(data):
+        '''Возвращает (полет, создан ли он, ссылки счетчиков сайта его борта).
+        Существующий полет остается со своим временем, вылетом и прилетом, а его борт должен совпадать
+        с бортом из формы (иначе ValidationError). Поэтому справочники и борт из формы вставляются
+        только для нового полета и для полета, борт которого был удален'''
+
+        key = {'flight_number': data['flight_number'], 'date': data['date']}
+        flight = Flight.objects.select_related('airframe').filter(**key).first()
+        if flight is not None and flight.airframe is not None:
+            FlightSaveService.check_airframe(flight, data)
+            return flight, False, None
+
+        aircraft_type_id, _ = insert_or_get(
+            AircraftType, {'manufacturer': data['manufacturer'], 'generic_type': data['generic_type']}
+        )
+        airline = Airline(name=data['airline_name'])
+        airline.pk, _ = insert_or_get(Airline, {'name': airline.name})
+        airframe, airframe_created = FlightSaveService.save_airframe(data, airline, aircraft_type_id)
+        if airframe_created:
+            references = (airframe.pk, airline.pk, aircraft_type_id)
+        else:
+            references = (airframe.pk, *Airframe.objects.filter(pk=airframe.pk)
+                          .values_list('airline_id', 'aircraft_type_id').get())
+
+        if flight is None:
+            flight = Flight(**key, flight_time=data['flight_time'], airframe_id=airframe.pk)
+            flight.pk, flight_created = insert_or_get(Flight, key,
+                                                      {'flight_time': flight.flight_time, 'airframe_id': airframe.pk})
+            saved = flight_created
+        else:
+            flight_created = False
+            saved = Flight.objects.filter(pk=flight.pk, airframe__isnull=True).update(airframe_id=airframe.pk)
+            if saved:
+                flight.airframe = airframe
+                FlightSaveService.attach_airframe(flight, references)
+
+        if not saved:
+            # Полет или его борт между поиском и записью сохранил параллельный запрос
+            flight = Flight.objects.select_related('airframe').get(pk=flight.pk)
+            FlightSaveService.check_airframe(flight, data)
+            if airframe_created and flight.airframe_id != airframe.pk:
+                with SignalMute.muted():
+                    Airframe.objects.filter(pk=airframe.pk).delete()
+            return flight, False, None
+
+        flight._state.adding = False
+        if airframe_created and airframe.photo:
+            data['airframe_photo'].bind(airframe)
+            enqueue('render_renditions', model=Airframe._meta.label_lower, pk=airframe.pk, name=airframe.photo.name)
+        return flight, flight_created, references
+
+    @staticmethod
+    def create(user, data):
+        '''Сохраняет путешествие пользователя user по cleaned_data формы AddFlightForm
+        (файлы - StagedUpload из AddFlightForm.stage_files). Возвращает путешествие и число запросов к БД'''
+
+        # Точка сохранения не нужна: ошибка внутри откатывает всю транзакцию вызывающего кода
+        with RoundTripCounter() as counter, transaction.atomic(savepoint=False):
+            flight, flight_created, airframe_references = FlightSaveService.save_flight(data)
+
+            trip = UserTrip(flight=flight,
+                            passenger=user,
+                            seat=data['seat'],
+                            neighbors=data['neighbors'],
+                            comments=data['comments'],
+                            price=data['ticket_price'],
+                            slug=slugify(f"{flight.flight_number}-{flight.date}-{user.username}"))
+            trip.pk, trip_created = insert_or_get(
+                UserTrip,
+                {'flight_id': flight.pk, 'passenger_id': user.pk},
+                {field: getattr(trip, field) for field in ('seat', 'neighbors', 'comments', 'price', 'slug')},
+            )
+
+            flight_infos = []
+            if flight_created:
+                # Обе записи одним запросом; ключи (flight, status) нового полета ни с чем не пересекаются
+                flight_infos = FlightInfo.objects.bulk_create(FlightSaveService.build_flight_infos(flight.pk, data))
+
+                references = Counter()
+                for info in flight_infos:
+                    references[(SiteCounter.AIRPORT, info.airport_code)] += 1
+                    references.update(SiteCounterService.get_airframe_references(*airframe_references))
+                SiteCounterService.adjust(added=references)
+
+            if trip_created:
+                trip._state.adding = False
+                meal = Meal(trip=trip,
+                            drinks=data['drinks'],
+                            appertize=data['appertize'],
+                            main_course=data['main_course'],
+                            desert=data['desert'],
+                            meal_price=data['meal_price'])
+                if data['meal_photo']:
+                    meal.meal_photo = data['meal_photo'].bind(meal)
+                meal.save()
+                TripCardService.refresh(UserTrip.objects.filter(pk=trip.pk))
+                PassengerStatsService.refresh([user.pk])
+            else:
+                trip = UserTrip.objects.select_related('flight', 'passenger').get(pk=trip.pk)
+
+            if flight_infos or trip_created:
+                transaction.on_commit(HomePageCache.bump_generation)
+
+        RequestIdentityMap.clear()
+        logger.info('Trip %s saved in %s round trips', trip.pk, counter.count)
+        return trip, counter.count
 
 
 class FlightInformationService:
@@ -12,36 +748,15 @@ class FlightInformationService:
 
     @staticmethod
     def get_latest_cards(max_count=6):
+        # Карточки читаются из денормализованной таблицы TripCard по первичному ключу
         try:
-            latest_cards = UserTrip.objects \
-                               .select_related('passenger', 'flight__airframe__aircraft_type', 'flight__airframe__airline') \
-                               .prefetch_related('flight__flightinfo_set') \
-                               .order_by('-id')[:max_count]
+            cards = TripCard.objects \
+                        .order_by('-trip_id') \
+                        .values(*TripCardService.CARD_FIELDS, usertripslug=F('slug'))[:max_count]
+            return list(cards)
         except Exception:
             return []
 
-        if not latest_cards:
-            latest_cards = []
-
-        cards = []
-
-        for trip in latest_cards:
-            card = {
-                'photo_url': trip.flight.airframe.photo,
-                'flight_number': trip.flight.flight_number,
-                'date': trip.flight.date,
-                'passenger': trip.passenger.username,
-                'airline': trip.flight.airframe.airline.name,
-                'aircraft_type': ' '.join((trip.flight.airframe.aircraft_type.manufacturer,
-                                           trip.flight.airframe.aircraft_type.generic_type)),
-                'departure': trip.flight.flightinfo_set.get(status='Departure').airport_code,
-                'destination': trip.flight.flightinfo_set.get(status='Arrival').airport_code,
-                'usertripslug': trip.slug
-            }
-            cards.append(card)
-
-        return cards
-
     @staticmethod
     def get_top_users(top=5):
         return UserTrip.objects \
@@ -52,12 +767,14 @@ class FlightInformationService:
 
     @staticmethod
     def get_site_information():
-        queryset = FlightInfo.objects \
-            .select_related('flight__airframe__aircraft_type', 'flight__airframe__airline') \
-            .aggregate(unique_airlines=Count('flight__airframe__airline__name', distinct=True),
-                       unique_aircraft_types=Count('flight__airframe__aircraft_type__pk', distinct=True),
-                       unique_airframes=Count('flight__airframe__serial_number', distinct=True),
-                       unique_airports=Count('airport_code', distinct=True))
+        # Количество уникальных значений поддерживается SiteCounterService, здесь только чтение
+        totals = dict(SiteTotal.objects.values_list('kind', 'value'))
+        queryset = {
+            'unique_airlines': totals.get(SiteCounter.AIRLINE, 0),
+            'unique_aircraft_types': totals.get(SiteCounter.AIRCRAFT_TYPE, 0),
+            'unique_airframes': totals.get(SiteCounter.AIRFRAME, 0),
+            'unique_airports': totals.get(SiteCounter.AIRPORT, 0),
+        }
 
         res = [{'title': k.replace('_', ' ').capitalize(), 'value': v} for k, v in queryset.items()]
 
@@ -69,22 +786,46 @@ class PassengerService:
     def get_all_passengers_with_statistic():
         '''Что входит: количество уникальных полетов, уникальных авиакомпаний, уникальных типов ВС, уникальных АП'''
 
+        # Статистика читается из PassengerStats (см. PassengerStatsService), без агрегации по путешествиям
         passengers_data = User.objects \
             .values('username', 'first_name', 'last_name') \
             .annotate(
-                total_airlines=Count('usertrip__flight__airframe__airline', distinct=True),
-                total_aircraft_types=Count('usertrip__flight__airframe__aircraft_type', distinct=True),
-                total_airports=Count('usertrip__flight__flightinfo__airport_code', distinct=True),
-                total_flights=Count('usertrip', distinct=True)
+                total_airlines=Coalesce('stats__total_airlines', 0),
+                total_aircraft_types=Coalesce('stats__total_aircraft_types', 0),
+                total_airports=Coalesce('stats__total_airports', 0),
+                total_flights=Coalesce('stats__total_flights', 0)
             ).order_by('username')
 
         return passengers_data
 
+    @staticmethod
+    def get_passenger_statistic(passenger_id):
+        '''Статистика одного пассажира: сначала фильтруем его путешествия, потом агрегируем,
+        поэтому стоимость запроса не зависит от общего числа пользователей'''
+
+        return UserTrip.objects \
+            .filter(passenger_id=passenger_id) \
+            .aggregate(
+                total_airlines=Count('flight__airframe__airline', distinct=True),
+                total_aircraft_types=Count('flight__airframe__aircraft_type', distinct=True),
+                total_airports=Count('flight__flightinfo__airport_code', distinct=True),
+                total_flights=Count('pk', distinct=True)
+            )
+
 
 class PassengerProfileService:
     @staticmethod
     def get_profile_information(username):
-        return PassengerService.get_all_passengers_with_statistic().get(username=username)
+        profile = PassengerService.get_all_passengers_with_statistic() \
+            .annotate(passenger_id=F('pk'), stats_id=F('stats__passenger')) \
+            .get(username=username)
+
+        passenger_id = profile.pop('passenger_id')
+        if profile.pop('stats_id') is None:
+            # Статистика еще не посчитана (например, до rebuild_passenger_stats) - считаем только этого пассажира
+            profile.update(PassengerService.get_passenger_statistic(passenger_id))
+
+        return profile
 
     @staticmethod
     def get_passenger_flights(username):
@@ -96,93 +837,107 @@ class PassengerProfileService:
 
         return object_or_set
 
+    @staticmethod
+    def get_passenger_cards(username):
+        '''Полеты пассажира из таблицы TripCard (индекс passenger, -date, trip)'''
+
+        return TripCard.objects \
+            .filter(passenger=username) \
+            .values('trip_id', 'slug', 'airline', 'flight_number', 'date', 'departure', 'destination') \
+            .order_by('-date', 'trip_id')
+
 
 class FlightDetailService:
+    FLIGHT_INFO_FIELDS = ('id', 'airport_code', 'metar', 'gate', 'is_boarding_bridge',
+                          'schedule_time', 'actual_time', 'runway')
+
     @staticmethod
     def get_flight_details(usertripslug):
-        trip = UserTrip.objects \
-            .select_related('passenger',
-                            'flight__airframe__aircraft_type',
-                            'flight__airframe__airline',
-                            ) \
-            .prefetch_related('flight__flightinfo_set',
-                              'trackimage_set',
-                              'meal_set') \
-            .get(slug=usertripslug)
-
-        flight = trip.flight
-        meal = trip.meal_set.first()
-        departure_info = flight.flightinfo_set.get(status='Departure')
-        arrival_info = flight.flightinfo_set.get(status='Arrival')
-
-        id_dict = {
-            'usertrip_id': trip.id,
-            'flight_id': flight.id,
-            'meal_id': meal.id,
-            'departure_id': departure_info.id,
-            'arrival_id': arrival_info.id,
-            'airframe_id': trip.flight.airframe.id,
-            'aircraft_type_id': trip.flight.airframe.aircraft_type.id,
-            'airline_id': trip.flight.airframe.airline.id,
-            **{f'track_image_{i}': track.id for i, track in enumerate(trip.trackimage_set.all())}
-        }
-
-        flight_dict = {
-            'usertripslug': trip.slug,
-
-            'registration_number': flight.airframe.registration_number,
-            'serial_number': flight.airframe.serial_number,
-            'airline_name': flight.airframe.airline.name,
-
-            'flight_number': flight.flight_number,
-            'date': flight.date.strftime('%Y-%m-%d'),
-            'flight_time': flight.flight_time,
-
-            'manufacturer': flight.airframe.aircraft_type.manufacturer,
-            'generic_type': flight.airframe.aircraft_type.generic_type,
-            'aircraft_type': ' '.join((flight.airframe.aircraft_type.manufacturer,
-                                       flight.airframe.aircraft_type.generic_type)),
-
-            'user': trip.passenger,
-            'seat': trip.seat,
-            'neighbors': trip.neighbors,
-            'comments': trip.comments,
-            'ticket_price': trip.price,
-
-            'drinks': meal.drinks,
-            'appertize': meal.appertize,
-            'main_course': meal.main_course,
-            'desert': meal.desert,
-            'meal_price': meal.meal_price,
-
-            'route': ' — '.join((departure_info.airport_code, arrival_info.airport_code)),
-
-            'departure_info': departure_info,
-            'arrival_info': arrival_info,
-
-            'departure_airport_code': departure_info.airport_code,
-            'departure_gate': departure_info.gate,
-            'departure_is_boarding_bridge': departure_info.is_boarding_bridge,
-            'departure_schedule_time': departure_info.schedule_time,
-            'departure_actual_time': departure_info.actual_time,
-            'departure_runway': departure_info.runway,
-            'departure_metar': departure_info.metar,
-
-            'arrival_airport_code': arrival_info.airport_code,
-            'arrival_gate': arrival_info.gate,
-            'arrival_is_boarding_bridge': arrival_info.is_boarding_bridge,
-            'arrival_schedule_time': arrival_info.schedule_time,
-            'arrival_actual_time': arrival_info.actual_time,
-            'arrival_runway': arrival_info.runway,
-            'arrival_metar': arrival_info.metar,
-
-            'track_images': trip.trackimage_set.all(),
-        }
+        return FlightDetailService.get_details(usertripslug).as_dicts()
 
-        files = {
-            'airframe_photo': flight.airframe.photo,
-            'meal_photo': meal.meal_photo,
-            **{f'track_image_{i}': track.track_img for i, track in enumerate(trip.trackimage_set.all())}
-        }
+    @staticmethod
+    def get_details(usertripslug):
+        # В пределах запроса детали полета загружаются один раз (права доступа, get, post, get_files)
+        return RequestIdentityMap.get_or_load(
+            ('flight_details', usertripslug),
+            lambda: FlightDetailService.load_flight_details(usertripslug)
+        )
 
-        return flight_dict, files, id_dict
+    @staticmethod
+    def load_flight_details(usertripslug):
+        '''Путешествие, полет, борт, вылет, прилет и питание одной строкой, треки - вторым запросом'''
+
+        info_fields = FlightDetailService.FLIGHT_INFO_FIELDS
+
+        row = UserTrip.objects \
+            .annotate(departure=FilteredRelation('flight__flightinfo',
+                                                 condition=Q(flight__flightinfo__status=FlightInfo.DEPARTURE)),
+                      arrival=FilteredRelation('flight__flightinfo',
+                                               condition=Q(flight__flightinfo__status=FlightInfo.ARRIVAL))) \
+            .filter(slug=usertripslug) \
+            .order_by('meal__id') \
+            .values('id', 'slug', 'seat', 'neighbors', 'comments', 'price',
+                    'passenger_id', 'passenger__username', 'passenger__first_name', 'passenger__last_name',
+                    'flight_id', 'flight__flight_number', 'flight__date', 'flight__flight_time',
+                    'flight__airframe_id', 'flight__airframe__registration_number',
+                    'flight__airframe__serial_number', 'flight__airframe__photo', 'flight__airframe__renditions',
+                    'flight__airframe__airline_id', 'flight__airframe__airline__name',
+                    'flight__airframe__aircraft_type_id', 'flight__airframe__aircraft_type__manufacturer',
+                    'flight__airframe__aircraft_type__generic_type',
+                    'meal__id', 'meal__drinks', 'meal__appertize', 'meal__main_course', 'meal__desert',
+                    'meal__meal_price', 'meal__meal_photo', 'meal__renditions',
+                    *(f'departure__{field}' for field in info_fields),
+                    *(f'arrival__{field}' for field in info_fields)) \
+            .first()
+
+        if row is None:
+            raise UserTrip.DoesNotExist(f'UserTrip with slug {usertripslug!r} does not exist')
+
+        track_images = TrackImage.objects.filter(trip_id=row['id']).order_by('pk')
+        list(track_images)
+
+        airframe = Airframe(pk=row['flight__airframe_id'], photo=row['flight__airframe__photo'])
+        meal = Meal(pk=row['meal__id'], meal_photo=row['meal__meal_photo'])
+
+        return FlightDetails(
+            usertrip_id=row['id'],
+            usertripslug=row['slug'],
+            user=User(pk=row['passenger_id'],
+                      username=row['passenger__username'],
+                      first_name=row['passenger__first_name'],
+                      last_name=row['passenger__last_name']),
+            seat=row['seat'],
+            neighbors=row['neighbors'],
+            comments=row['comments'],
+            ticket_price=row['price'],
+
+            flight_id=row['flight_id'],
+            flight_number=row['flight__flight_number'],
+            date=row['flight__date'],
+            flight_time=row['flight__flight_time'],
+
+            airframe_id=row['flight__airframe_id'],
+            registration_number=row['flight__airframe__registration_number'],
+            serial_number=row['flight__airframe__serial_number'],
+            airframe_photo=airframe.photo if airframe.pk else None,
+            airframe_renditions=row['flight__airframe__renditions'] or {},
+            airline_id=row['flight__airframe__airline_id'],
+            airline_name=row['flight__airframe__airline__name'],
+            aircraft_type_id=row['flight__airframe__aircraft_type_id'],
+            manufacturer=row['flight__airframe__aircraft_type__manufacturer'],
+            generic_type=row['flight__airframe__aircraft_type__generic_type'],
+
+            meal_id=row['meal__id'],
+            drinks=row['meal__drinks'],
+            appertize=row['meal__appertize'],
+            main_course=row['meal__main_course'],
+            desert=row['meal__desert'],
+            meal_price=row['meal__meal_price'],
+            meal_photo=meal.meal_photo if meal.pk else None,
+            meal_renditions=row['meal__renditions'] or {},
+
+            departure_info=FlightInfoDetails(**{field: row[f'departure__{field}'] for field in info_fields}),
+            arrival_info=FlightInfoDetails(**{field: row[f'arrival__{field}'] for field in info_fields}),
+
+            track_images=track_images,
+        )
@@ -0,0 +1,35 @@
+from contextlib import contextmanager
+from contextvars import ContextVar
+from functools import wraps
+
+_muted = ContextVar('signals_muted', default=False)
+
+
+class SignalMute:
+    '''Отключение обработчиков из flights/signals.py на время массовых операций.
+    Сигналы по-прежнему отправляются, и QuerySet.delete() проходит через Collector со всеми связями и on_delete,
+    но обработчики, обернутые SignalMute.mutable, ничего не делают: счетчики, карточки, статистику
+    и удаление файлов для всего набора сразу выполняет вызывающий код (см. TripDeletionService)'''
+
+    @staticmethod
+    @contextmanager
+    def muted():
+        token = _muted.set(True)
+        try:
+            yield
+        finally:
+            _muted.reset(token)
+
+    @staticmethod
+    def is_muted():
+        return _muted.get()
+
+    @staticmethod
+    def mutable(receiver):
+        # Декоратор ставится ближе всех к функции, под @receiver
+        @wraps(receiver)
+        def wrapper(*args, **kwargs):
+            if not _muted.get():
+                return receiver(*args, **kwargs)
+
+        return wrapper
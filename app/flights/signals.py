@@ -1,35 +1,54 @@
-import os
 import shutil
 
+from django.contrib.auth.models import User
+from django.db import transaction
 from django.dispatch import receiver
-from django.db.models.signals import pre_save, post_delete, pre_delete
+from django.db.models.signals import pre_save, post_save, post_delete, pre_delete
 from .models import Airframe, TrackImage, Meal
 
-from .models import UserTrip, Flight
+from .models import UserTrip, Flight, FlightInfo, Airline, AircraftType
+from .cache import HomePageCache
+from .identity_map import RequestIdentityMap
+from .jobs import enqueue
+from .renditions import get_rendition_paths, is_current, is_placeholder
+from .services import TripCardService, PassengerStatsService, SiteCounterService, TripDeletionService
+from .signal_mute import SignalMute
 
 
 @receiver(pre_save, sender=Airframe)
 @receiver(pre_save, sender=TrackImage)
 @receiver(pre_save, sender=Meal)
-def delete_previous_photo(sender, instance, **kwargs):
-    if instance.pk:
-        try:
-            old_instance = sender.objects.get(pk=instance.pk)
-            if isinstance(old_instance, Airframe) and old_instance.photo != instance.photo:
-                old_instance.photo.delete(save=False)
-            elif isinstance(old_instance, TrackImage) and old_instance.track_img != instance.track_img:
-                old_instance.track_img.delete(save=False)
-            elif isinstance(old_instance, Meal) and old_instance.meal_photo != instance.meal_photo:
-                old_instance.meal_photo.delete(save=False)
-        except sender.DoesNotExist:
-            pass
+def delete_previous_photo(sender, instance, update_fields=None, **kwargs):
+    if not instance.pk or (update_fields is not None and sender.IMAGE_FIELD not in update_fields):
+        return
+
+    # Старые значения берутся из снимка загруженного экземпляра, запрос нужен только для собранного заново
+    old_values = instance.get_previous_values(sender.IMAGE_FIELD, 'renditions')
+    if old_values is None:
+        old_values = sender.objects.filter(pk=instance.pk).values_list(sender.IMAGE_FIELD, 'renditions').first()
+        if old_values is None:
+            return
+    old_name, old_renditions = old_values
+
+    if (old_name or '') == (instance.get_image().name or ''):
+        # Экземпляр, собранный заново из данных формы, не знает о готовых копиях
+        if not instance.renditions and is_current(old_renditions or {}, old_name):
+            instance.renditions = old_renditions
+        return
+
+    # Заглушки синтетических данных общие для многих записей.
+    # Файлы удаляет воркер после коммита: при откате старое изображение остается на месте
+    if old_name and not is_placeholder(old_name):
+        enqueue('delete_files', paths=[old_name, *get_rendition_paths(old_renditions or {})])
+    instance.renditions = {}
 
 
 @receiver(post_delete, sender=Airframe)
 @receiver(post_delete, sender=TrackImage)
 @receiver(post_delete, sender=Meal)
+@SignalMute.mutable
 def delete_image(sender, instance, **kwargs):
-    # Удаляем изображение из файловой системы после удаления записи
+    # Удаляем изображение, его копии и опустевшие каталоги после удаления записи (фоновой задачей)
 
     if isinstance(instance, Airframe):
         image_field = instance.photo
@@ -38,20 +57,248 @@ def delete_image(sender, instance, **kwargs):
     elif isinstance(instance, Meal):
         image_field = instance.meal_photo
 
-    if image_field:
-        image_path = image_field.path
-        if os.path.exists(image_path):
-            os.remove(image_path)
+    if image_field and not is_placeholder(image_field):
+        enqueue('delete_files', paths=[image_field.name, *get_rendition_paths(instance.renditions)])
+
+
+@receiver(post_save, sender=Airframe)
+@receiver(post_save, sender=TrackImage)
+@receiver(post_save, sender=Meal)
+def create_renditions(sender, instance, **kwargs):
+    # Копии создает воркер, карточки с фото борта он обновит сам
+    image = instance.get_image()
+    if image and not is_current(instance.renditions, image.name):
+        enqueue('render_renditions', model=sender._meta.label_lower, pk=instance.pk, name=image.name)
+
+
+def get_dependent_trips(instance):
+    trip_ids = getattr(instance, '_dependent_trip_ids', None)
+    if trip_ids is None:
+        return TripCardService.get_dependent_trips(instance)
+
+    return UserTrip.objects.filter(pk__in=trip_ids)
+
+
+@receiver(post_save, sender=UserTrip)
+@receiver(post_save, sender=Flight)
+@receiver(post_save, sender=FlightInfo)
+@receiver(post_save, sender=Airframe)
+@receiver(post_save, sender=Airline)
+@receiver(post_save, sender=AircraftType)
+def update_trip_cards(sender, instance, **kwargs):
+    TripCardService.refresh(TripCardService.get_dependent_trips(instance))
+
+
+@receiver(post_save, sender=User)
+def update_passenger_cards(sender, instance, created, update_fields=None, **kwargs):
+    # У нового пользователя карточек нет, а вход сохраняет только last_login
+    if created or (update_fields is not None and 'username' not in update_fields):
+        return
+
+    TripCardService.rename_passenger(instance)
+
 
-        # Удаление папок рекурсивно, если они стали пустыми
-        folder_path = os.path.dirname(image_path)
+@receiver(pre_delete, sender=Airframe)
+@receiver(pre_delete, sender=Airline)
+@receiver(pre_delete, sender=AircraftType)
+@SignalMute.mutable
+def remember_dependent_trips(sender, instance, **kwargs):
+    # После удаления связь обнулится (SET_NULL), поэтому запоминаем путешествия заранее
+    instance._dependent_trip_ids = list(
+        TripCardService.get_dependent_trips(instance).values_list('pk', flat=True)
+    )
 
 
-        while not os.listdir(folder_path):
-            parent_folder = os.path.dirname(folder_path)
+@receiver(pre_delete, sender=User)
+def delete_passenger_trips(sender, instance, **kwargs):
+    # UserTrip.passenger - DO_NOTHING, поэтому Collector пользователя путешествия не собирает и построчные
+    # обработчики их удаления не вызываются. Сервис удаляет их вместе с полетами и бортами без путешествий
+    # и обновляет счетчики, кеш и файлы сразу для всего набора
+    TripDeletionService.delete(trips=UserTrip.objects.filter(passenger=instance))
 
-            os.rmdir(folder_path)
 
-            folder_path = parent_folder
+@receiver(post_delete, sender=FlightInfo)
+@receiver(post_delete, sender=Airframe)
+@receiver(post_delete, sender=Airline)
+@receiver(post_delete, sender=AircraftType)
+@SignalMute.mutable
+def clear_trip_cards(sender, instance, **kwargs):
+    TripCardService.refresh(get_dependent_trips(instance), create=False)
+
+
+@receiver(post_save, sender=UserTrip)
+@receiver(post_save, sender=Flight)
+@receiver(post_save, sender=FlightInfo)
+@receiver(post_save, sender=Airframe)
+def update_passenger_stats(sender, instance, **kwargs):
+    trips = TripCardService.get_dependent_trips(instance)
+    PassengerStatsService.refresh(PassengerStatsService.get_affected_passengers(trips))
+
+
+@receiver(post_delete, sender=UserTrip)
+@SignalMute.mutable
+def update_passenger_stats_after_trip_delete(sender, instance, **kwargs):
+    PassengerStatsService.refresh([instance.passenger_id], create=False)
+
+
+@receiver(post_delete, sender=FlightInfo)
+@receiver(post_delete, sender=Airframe)
+@receiver(post_delete, sender=Airline)
+@receiver(post_delete, sender=AircraftType)
+@SignalMute.mutable
+def clear_passenger_stats(sender, instance, **kwargs):
+    trips = get_dependent_trips(instance)
+    PassengerStatsService.refresh(PassengerStatsService.get_affected_passengers(trips), create=False)
+
+
+@receiver(pre_save, sender=FlightInfo)
+@receiver(pre_save, sender=Flight)
+@receiver(pre_save, sender=Airframe)
+def remember_site_counter_references(sender, instance, **kwargs):
+    # Старые значения нужны, чтобы снять ссылки со старых авиакомпаний/аэропортов после сохранения
+    fields = {
+        FlightInfo: ('airport_code', 'flight_id'),
+        Flight: ('airframe_id',),
+        Airframe: ('airline_id', 'aircraft_type_id'),
+    }[sender]
+
+    old_values = None
+    if instance.pk:
+        old_values = instance.get_previous_values(*fields)
+        if old_values is None:
+            old_values = sender.objects.filter(pk=instance.pk).values_list(*fields).first()
+
+    instance._old_site_counter_values = old_values
 
-        return folder_path
+
+@receiver(post_save, sender=FlightInfo)
+def update_site_counters_for_flight_info(sender, instance, created, **kwargs):
+    old_values = getattr(instance, '_old_site_counter_values', None)
+    new_values = (instance.airport_code, instance.flight_id)
+
+    if old_values == new_values:
+        return
+
+    SiteCounterService.adjust(
+        added=SiteCounterService.get_flight_info_references(*new_values),
+        removed=SiteCounterService.get_flight_info_references(*old_values) if old_values else None
+    )
+
+
+@receiver(post_save, sender=Flight)
+def update_site_counters_for_flight(sender, instance, created, **kwargs):
+    old_values = getattr(instance, '_old_site_counter_values', None)
+    if old_values is None or old_values == (instance.airframe_id,):
+        return
+
+    flight_info_count = FlightInfo.objects.filter(flight=instance).count()
+    if not flight_info_count:
+        return
+
+    def references(airframe_id):
+        airframe = Airframe.objects.filter(pk=airframe_id).values('airline_id', 'aircraft_type_id').first() or {}
+        return SiteCounterService.scale(
+            SiteCounterService.get_airframe_references(airframe_id if airframe else None,
+                                                       airframe.get('airline_id'),
+                                                       airframe.get('aircraft_type_id')),
+            flight_info_count
+        )
+
+    SiteCounterService.adjust(added=references(instance.airframe_id), removed=references(old_values[0]))
+
+
+@receiver(post_save, sender=Airframe)
+def update_site_counters_for_airframe(sender, instance, created, **kwargs):
+    old_values = getattr(instance, '_old_site_counter_values', None)
+    new_values = (instance.airline_id, instance.aircraft_type_id)
+
+    if old_values is None or old_values == new_values:
+        return
+
+    flight_info_count = FlightInfo.objects.filter(flight__airframe=instance).count()
+    if not flight_info_count:
+        return
+
+    SiteCounterService.adjust(
+        added=SiteCounterService.scale(
+            SiteCounterService.get_airframe_references(None, *new_values), flight_info_count),
+        removed=SiteCounterService.scale(
+            SiteCounterService.get_airframe_references(None, *old_values), flight_info_count)
+    )
+
+
+@receiver(post_delete, sender=FlightInfo)
+@SignalMute.mutable
+def update_site_counters_after_flight_info_delete(sender, instance, **kwargs):
+    SiteCounterService.adjust(
+        removed=SiteCounterService.get_flight_info_references(instance.airport_code, instance.flight_id)
+    )
+
+
+@receiver(pre_delete, sender=Airframe)
+@receiver(pre_delete, sender=Airline)
+@receiver(pre_delete, sender=AircraftType)
+@SignalMute.mutable
+def update_site_counters_before_delete(sender, instance, **kwargs):
+    # Связи на удаляемый объект будут обнулены (SET_NULL) без сигналов, поэтому снимаем ссылки заранее
+    if isinstance(instance, Airframe):
+        flight_info_count = FlightInfo.objects.filter(flight__airframe=instance).count()
+        references = SiteCounterService.get_airframe_references(
+            instance.pk, instance.airline_id, instance.aircraft_type_id
+        )
+    elif isinstance(instance, Airline):
+        flight_info_count = FlightInfo.objects.filter(flight__airframe__airline=instance).count()
+        references = SiteCounterService.get_airframe_references(None, instance.pk, None)
+    else:
+        flight_info_count = FlightInfo.objects.filter(flight__airframe__aircraft_type=instance).count()
+        references = SiteCounterService.get_airframe_references(None, None, instance.pk)
+
+    if flight_info_count:
+        SiteCounterService.adjust(removed=SiteCounterService.scale(references, flight_info_count))
+
+
+@receiver(post_save, sender=UserTrip)
+@receiver(post_save, sender=Flight)
+@receiver(post_save, sender=FlightInfo)
+@receiver(post_save, sender=Airframe)
+@receiver(post_save, sender=Airline)
+@receiver(post_save, sender=AircraftType)
+@receiver(post_save, sender=User)
+@receiver(post_delete, sender=UserTrip)
+@receiver(post_delete, sender=Flight)
+@receiver(post_delete, sender=FlightInfo)
+@receiver(post_delete, sender=Airframe)
+@receiver(post_delete, sender=Airline)
+@receiver(post_delete, sender=AircraftType)
+@receiver(post_delete, sender=User)
+@SignalMute.mutable
+def invalidate_home_page_cache(sender, instance, update_fields=None, **kwargs):
+    # Вход пользователя сохраняет только last_login, главная страница от этого не меняется
+    if sender is User and update_fields is not None and set(update_fields) == {'last_login'}:
+        return
+
+    # Меняем поколение только после коммита, иначе параллельный запрос может
+    # закэшировать под новым поколением еще старые данные
+    transaction.on_commit(HomePageCache.bump_generation)
+
+
+@receiver(post_save, sender=UserTrip)
+@receiver(post_save, sender=Flight)
+@receiver(post_save, sender=FlightInfo)
+@receiver(post_save, sender=Airframe)
+@receiver(post_save, sender=Airline)
+@receiver(post_save, sender=AircraftType)
+@receiver(post_save, sender=TrackImage)
+@receiver(post_save, sender=Meal)
+@receiver(post_delete, sender=UserTrip)
+@receiver(post_delete, sender=Flight)
+@receiver(post_delete, sender=FlightInfo)
+@receiver(post_delete, sender=Airframe)
+@receiver(post_delete, sender=Airline)
+@receiver(post_delete, sender=AircraftType)
+@receiver(post_delete, sender=TrackImage)
+@receiver(post_delete, sender=Meal)
+@SignalMute.mutable
+def clear_request_identity_map(sender, instance, **kwargs):
+    # После записи объекты, загруженные в этом запросе, могут быть устаревшими
+    RequestIdentityMap.clear()
@@ -0,0 +1,249 @@
+import hashlib
+import os
+import tempfile
+from collections import Counter
+from urllib.parse import urljoin
+
+from django.core.files.move import file_move_safe
+from django.core.files.storage import FileSystemStorage
+from django.db import transaction
+from django.utils.deconstruct import deconstructible
+from django.utils.encoding import filepath_to_uri
+
+from .identity_map import RequestIdentityMap
+from .jobs import enqueue
+from .models import MediaBlob, MediaFile
+
+# Каталог с содержимым файлов внутри MEDIA_ROOT: blobs/ab/cd/abcd....jpg
+BLOB_DIR = 'blobs'
+# Содержимое по хешу не меняется никогда: его кешируют на год (так же настроен nginx для /media/blobs/)
+BLOB_MAX_AGE = 365 * 24 * 60 * 60
+# Временные файлы загрузки, пока не посчитан хеш. Тот же раздел диска, поэтому перенос - это rename
+BLOB_TMP_DIR = os.path.join(BLOB_DIR, 'tmp')
+
+
+def is_blob_name(name):
+    return name.replace('\\', '/').startswith(BLOB_DIR + '/')
+
+
+def make_blob_name(sha256, name):
+    '''Имя содержимого из хеша. Расширение исходного файла сохраняется, чтобы nginx отдавал верный Content-Type'''
+
+    _, ext = os.path.splitext(name)
+    return f'{BLOB_DIR}/{sha256[:2]}/{sha256[2:4]}/{sha256}{ext.lower()}'
+
+
+@deconstructible(path='flights.storage.ContentAddressedStorage')
+class ContentAddressedStorage(FileSystemStorage):
+    '''Хранилище с адресацией по содержимому.
+    Поля моделей по-прежнему хранят логические имена (airframes/s7/ra-123.jpg), а файл лежит один раз
+    под именем из SHA-256 содержимого. Связь имен и содержимого - в таблицах MediaFile и MediaBlob,
+    у содержимого есть счетчик ссылок: одинаковые загрузки занимают место один раз,
+    а файл удаляется фоновой задачей, когда на него не осталось ссылок.
+    URL содержимого не меняется никогда, поэтому nginx отдает /media/blobs/ с кешированием на год.
+    Файлы, загруженные до перехода (см. команду migrate_media_to_cas), читаются и удаляются по старым путям'''
+
+    @staticmethod
+    def get_cache_key(name):
+        return ('media_file', name)
+
+    def get_blob_names(self, names):
+        '''Имена содержимого для пачки логических имен одним запросом (None - файл хранится по старому пути).
+        В пределах HTTP-запроса результат запоминается (RequestIdentityMap), поэтому path(), exists()
+        и open() уже разрешенных имен к БД не обращаются, а страница с несколькими файлами может
+        разрешить их все заранее одним вызовом'''
+
+        def load(keys):
+            blob_names = dict(MediaFile.objects
+                              .filter(name__in=[name for _, name in keys])
+                              .values_list('name', 'blob__name'))
+            return {key: blob_names.get(key[1]) for key in keys}
+
+        logical = [name for name in names if not is_blob_name(name)]
+        resolved = RequestIdentityMap.get_or_load_many([self.get_cache_key(name) for name in logical], load)
+        return {name: name if is_blob_name(name) else resolved[self.get_cache_key(name)] for name in names}
+
+    def get_blob_name(self, name):
+        '''Имя содержимого для логического имени или None, если файл хранится по старому пути'''
+
+        return self.get_blob_names([name])[name]
+
+    def forget(self, names):
+        '''Имена перенаправлены или удалены: запомненное содержимое больше не действительно'''
+
+        RequestIdentityMap.discard([self.get_cache_key(name) for name in names])
+
+    def raw_path(self, name):
+        return super().path(name)
+
+    def path(self, name):
+        blob_name = self.get_blob_name(name) if name else None
+        return self.raw_path(blob_name or name)
+
+    def exists(self, name):
+        if not is_blob_name(name) and self.get_blob_name(name):
+            return True
+        return os.path.lexists(self.raw_path(name))
+
+    def get_available_names(self, names, max_length=None):
+        '''get_available_name для пачки имен: занятые имена ищутся одним запросом.
+        Одинаковые имена внутри пачки не различаются: второе переименует save() при публикации'''
+
+        taken = {name for name, blob_name in self.get_blob_names(names).items() if blob_name}
+        return [
+            self.get_available_name(name, max_length=max_length)
+            if name in taken or (max_length and len(name) > max_length) or os.path.lexists(self.raw_path(name))
+            else name
+            for name in names
+        ]
+
+    def blob_url(self, blob_name):
+        '''Неизменяемый URL содержимого'''
+
+        return urljoin(self.base_url, filepath_to_uri(blob_name))
+
+    @staticmethod
+    def hash_file(content):
+        digest = hashlib.sha256()
+        size = 0
+        if hasattr(content, 'seek'):
+            content.seek(0)
+        for chunk in content.chunks():
+            digest.update(chunk)
+            size += len(chunk)
+        return digest.hexdigest(), size
+
+    def _save(self, name, content):
+        if hasattr(content, 'temporary_file_path'):
+            # Файл уже на диске (временный файл загрузки или подготовленный flights/uploads.py):
+            # хеш считается чтением, а в blobs/ файл переносится без повторной записи
+            tmp_path = content.temporary_file_path()
+            sha256, size = self.hash_file(content)
+            owns_tmp = False
+        else:
+            os.makedirs(self.raw_path(BLOB_TMP_DIR), exist_ok=True)
+            fd, tmp_path = tempfile.mkstemp(dir=self.raw_path(BLOB_TMP_DIR))
+            owns_tmp = True
+
+        try:
+            if owns_tmp:
+                # Хеш считается при записи во временный файл: содержимое читается один раз, по частям
+                digest = hashlib.sha256()
+                size = 0
+                with os.fdopen(fd, 'wb') as tmp:
+                    if hasattr(content, 'seek'):
+                        content.seek(0)
+                    for chunk in content.chunks():
+                        digest.update(chunk)
+                        size += len(chunk)
+                        tmp.write(chunk)
+                sha256 = digest.hexdigest()
+
+            # Без точки сохранения: ошибка здесь все равно откатывает внешнюю транзакцию сохранения модели
+            with transaction.atomic(savepoint=False):
+                MediaBlob.objects.bulk_create(
+                    [MediaBlob(sha256=sha256, name=make_blob_name(sha256, name), size=size)],
+                    ignore_conflicts=True
+                )
+                # Блокировка строки не дает фоновому удалению убрать файл между проверкой и новой ссылкой
+                blob = MediaBlob.objects.select_for_update().get(pk=sha256)
+
+                blob_path = self.raw_path(blob.name)
+                if not os.path.exists(blob_path):
+                    os.makedirs(os.path.dirname(blob_path), exist_ok=True)
+                    file_move_safe(tmp_path, blob_path)
+                    if self.file_permissions_mode is not None:
+                        os.chmod(blob_path, self.file_permissions_mode)
+
+                self.link(name, blob)
+        finally:
+            if owns_tmp and os.path.exists(tmp_path):
+                os.remove(tmp_path)
+
+        return name
+
+    def link(self, name, blob):
+        '''Направляет логическое имя на содержимое blob (строка blob должна быть заблокирована)'''
+
+        self.forget([name])
+        file = MediaFile.objects.select_for_update().filter(name=name).first()
+        if file is not None and file.blob_id == blob.pk:
+            return
+        if file is not None:
+            # Имя перезаписано другим содержимым
+            previous = file.blob_id
+            file.blob = blob
+            file.save(update_fields=['blob'])
+            self.release(previous)
+        else:
+            MediaFile.objects.create(name=name, blob=blob)
+
+        blob.refcount += 1
+        blob.save(update_fields=['refcount'])
+
+    def release(self, sha256):
+        blob = MediaBlob.objects.select_for_update().get(pk=sha256)
+        blob.refcount -= 1
+        blob.save(update_fields=['refcount'])
+
+        if blob.refcount == 0:
+            enqueue('delete_blob', sha256=sha256)
+
+    def delete(self, name):
+        if not name:
+            raise ValueError('The name must be given to delete().')
+
+        self.forget([name])
+        with transaction.atomic(savepoint=False):
+            file = MediaFile.objects.select_for_update().filter(name=name).first()
+            if file is None:
+                # Файл, загруженный до перехода на адресацию по содержимому
+                if not is_blob_name(name):
+                    super().delete(name)
+                return
+
+            file.delete()
+            self.release(file.blob_id)
+
+    def delete_many(self, names):
+        '''Удаляет пачку логических имен в одной транзакции.
+        Возвращает хеши содержимого, на которое больше нет ссылок (его удаление уже поставлено в очередь)'''
+
+        released = []
+        self.forget(names)
+        with transaction.atomic(savepoint=False):
+            files = list(MediaFile.objects.select_for_update().filter(name__in=names))
+            MediaFile.objects.filter(pk__in=[file.pk for file in files]).delete()
+
+            counts = Counter(file.blob_id for file in files)
+            blobs = MediaBlob.objects.select_for_update().in_bulk(list(counts))
+            for sha256, count in counts.items():
+                blobs[sha256].refcount -= count
+                if blobs[sha256].refcount == 0:
+                    released.append(sha256)
+                    enqueue('delete_blob', sha256=sha256)
+            MediaBlob.objects.bulk_update(list(blobs.values()), ['refcount'])
+
+        linked = {file.name for file in files}
+        for name in names:
+            if name not in linked and not is_blob_name(name):
+                super().delete(name)
+
+        return released
+
+    def delete_blob(self, sha256):
+        '''Удаляет содержимое без ссылок. Возвращает освобожденный объем в байтах'''
+
+        blob = MediaBlob.objects.select_for_update().filter(pk=sha256, refcount=0).first()
+        if blob is None:
+            # Пока задача ждала в очереди, содержимое загрузили снова
+            return 0
+
+        # Файл удаляется под блокировкой: параллельная загрузка того же содержимого дождется коммита
+        # и запишет файл заново. При откате строка вернется без файла, и _save его восстановит
+        blob.delete()
+        try:
+            os.remove(self.raw_path(blob.name))
+        except FileNotFoundError:
+            pass
+        return blob.size
@@ -0,0 +1,63 @@
+import os
+
+from django.apps import apps
+from django.core.files.storage import default_storage
+from django.db import transaction
+
+from .cache import HomePageCache
+from .jobs import task
+from .models import Airframe, UserTrip
+from .renditions import update_renditions
+from .services import TripCardService
+
+
+@task('render_renditions')
+def render_image_renditions(model, pk, name):
+    '''Создает уменьшенные копии изображения записи, если она еще ссылается на файл name'''
+
+    instance = apps.get_model(model).objects.filter(pk=pk).first()
+    if instance is None or instance.get_image().name != name:
+        # Запись удалена или изображение уже заменено: копии сделает более новая задача
+        return
+
+    if update_renditions(instance) and isinstance(instance, Airframe):
+        # Реестр записан через update(), сигналы не вызывались: карточки с этим бортом обновляем здесь
+        TripCardService.refresh(UserTrip.objects.filter(flight__airframe=instance))
+        transaction.on_commit(HomePageCache.bump_generation)
+
+
+@task('delete_files')
+def delete_files(paths, prune=True):
+    '''Удаляет файлы из хранилища и, если prune, опустевшие после этого каталоги'''
+
+    for path in paths:
+        default_storage.delete(path)
+
+    if prune:
+        prune_directories(sorted({os.path.dirname(path) for path in paths if os.path.dirname(path)}))
+
+
+@task('delete_blob')
+def delete_blob(sha256):
+    '''Удаляет содержимое, на которое не осталось ссылок (только для ContentAddressedStorage)'''
+
+    default_storage.delete_blob(sha256)
+
+
+@task('prune_directories')
+def prune_directories(directories):
+    '''Удаляет пустые каталоги хранилища вверх до MEDIA_ROOT'''
+
+    root = os.path.normpath(default_storage.path(''))
+
+    for directory in directories:
+        folder_path = os.path.normpath(default_storage.path(directory))
+        while folder_path.startswith(root + os.sep):
+            try:
+                # rmdir удаляет только пустой каталог, поэтому параллельная загрузка файла в него безопасна
+                os.rmdir(folder_path)
+            except FileNotFoundError:
+                pass
+            except OSError:
+                break
+            folder_path = os.path.dirname(folder_path)
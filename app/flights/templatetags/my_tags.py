@@ -1,4 +1,9 @@
 from django import template
+from django.core.files.storage import default_storage
+from django.forms.utils import flatatt
+from django.utils.html import format_html
+
+from flights.renditions import CONTENT_TYPES, RENDITIONS
 
 register = template.Library()
 
@@ -10,4 +15,53 @@ def track_images_html(form):
             field_html = form[field_name]
             field_collection.append(field_html)
 
-    return field_collection
\ No newline at end of file
+    return field_collection
+
+
+def rendition_url(entry, format):
+    '''Неизменяемый URL содержимого копии, если оно известно, иначе URL по логическому имени'''
+
+    blob_name = entry.get('blobs', {}).get(format)
+    if blob_name and hasattr(default_storage, 'blob_url'):
+        return default_storage.blob_url(blob_name)
+    return default_storage.url(entry[format])
+
+
+@register.simple_tag()
+def srcset(renditions, format='jpeg'):
+    '''Значение атрибута srcset из реестра копий: "url 160w, url 480w, url 1024w"'''
+
+    candidates = {}
+    for rendition in RENDITIONS:
+        entry = (renditions or {}).get(rendition)
+        if entry and entry.get(format):
+            # Маленький оригинал дает копии одной ширины, браузеру достаточно одной
+            candidates.setdefault(entry['width'], rendition_url(entry, format))
+
+    return ', '.join(f'{url} {width}w' for width, url in sorted(candidates.items()))
+
+
+@register.simple_tag()
+def responsive_image(image, renditions, size='card', sizes=None, **attrs):
+    '''<picture> с WebP и JPEG копиями изображения. image - FieldFile или имя файла в хранилище.
+    size - копия для src (браузеры без srcset), sizes по умолчанию - ширина этой копии.
+    Пока копий нет (до backfill_renditions), выводится оригинал'''
+
+    name = getattr(image, 'name', image)
+    if not name:
+        return ''
+
+    entry = (renditions or {}).get(size)
+    if not entry or renditions.get('source') != name:
+        return format_html('<img src="{}"{}>', default_storage.url(name), flatatt(attrs))
+
+    sizes = sizes or f'{RENDITIONS[size][0]}px'
+    # По клику modal_screen.js открывает крупную копию вместо многомегабайтного оригинала
+    detail = renditions.get('detail') or entry
+    attrs = {'data-full': rendition_url(detail, 'jpeg'), **attrs}
+
+    return format_html(
+        '<picture><source type="{}" srcset="{}" sizes="{}"><img src="{}" srcset="{}" sizes="{}"{}></picture>',
+        CONTENT_TYPES['webp'], srcset(renditions, 'webp'), sizes,
+        rendition_url(entry, 'jpeg'), srcset(renditions, 'jpeg'), sizes, flatatt(attrs),
+    )
@@ -7,9 +7,11 @@ import django
 
 django.setup()
 
-from flights.models import AircraftType, Airline, Airframe, Flight, UserTrip, FlightInfo, TrackImage, Meal
+from flights.models import (AircraftType, Airline, Airframe, Flight, UserTrip, FlightInfo, TrackImage, Meal,
+                            SiteCounter)
 from django.test import TestCase, override_settings
-from django.db import IntegrityError
+from django.db import IntegrityError, connection
+from django.test.utils import CaptureQueriesContext
 from django.core.files.uploadedfile import SimpleUploadedFile, InMemoryUploadedFile
 from django.core.files.storage import default_storage
 from django.core.exceptions import ValidationError
@@ -20,11 +22,12 @@ from aviablog import settings
 import shutil
 import tempfile
 from datetime import time
-from test_mixins.test_data_upload import TemproaryMediaRootMixin
+from test_mixins.test_data_upload import TemproaryMediaRootMixin, filesystem_storage
 
 UserClass = get_user_model()
 
 
+@filesystem_storage
 class Settings(TemproaryMediaRootMixin):
 
     @classmethod
@@ -407,16 +410,31 @@ class FlightInfoTest(Settings):
 
         self.assertIsInstance(context.exception, ValidationError)
 
+    def test_unique_status_constraint(self):
+        with self.assertRaises(IntegrityError):
+            FlightInfo.objects.create(
+                flight=self.flight_info_dep.flight,
+                status='Departure',
+                airport_code='DME',
+                runway='32L'
+            )
+
     def test_choice_ok(self):
+        flight = Flight.objects.create(
+            flight_number='KJC543',
+            airframe=self.airframe,
+            date='2023-07-27'
+        )
+
         flight_info_departure = FlightInfo.objects.create(
-            flight=self.flight_info_dep.flight,
+            flight=flight,
             status='Departure',
             airport_code='DME',
             runway='32L'
         )
 
         flight_info_arrival = FlightInfo.objects.create(
-            flight=self.flight_info_dep.flight,
+            flight=flight,
             status='Arrival',
             airport_code='JFK',
             runway='22R'
@@ -542,3 +560,59 @@ class MealTest(Settings):
         usertrip.delete()
 
         self.assertQuerySetEqual(Meal.objects.filter(Q(pk=meal1.id) | Q(pk=meal2.id)), [])
+
+
+class DirtyFieldsMixinTest(Settings):
+
+    def setUp(self):
+        super().setUp()
+        self.meal = Meal.objects.create(
+            trip=self.usertrip,
+            drinks='Вода',
+            meal_photo=SimpleUploadedFile('meal.jpg', b'file_content')
+        )
+
+    def test_changed_fields(self):
+        meal = Meal.objects.get(pk=self.meal.pk)
+        self.assertTrue(meal.has_snapshot)
+        self.assertEqual(meal.changed_fields, [])
+
+        meal.drinks = 'Сок'
+        meal.renditions['source'] = 'other.jpg'
+        self.assertEqual(set(meal.changed_fields), {'drinks', 'renditions'})
+        self.assertEqual(meal.get_previous_values('drinks', 'trip'), ('Вода', self.usertrip.pk))
+
+        meal.save()
+        self.assertEqual(meal.changed_fields, [])
+
+    def test_fresh_instance_has_no_snapshot(self):
+        meal = Meal(pk=self.meal.pk, trip=self.usertrip, drinks='Сок')
+        self.assertIsNone(meal.changed_fields)
+        self.assertIsNone(meal.get_previous_values('drinks'))
+
+        meal = Meal.objects.only('drinks').get(pk=self.meal.pk)
+        self.assertIsNone(meal.get_previous_values('meal_photo'))
+
+    def test_photo_replaced_without_select(self):
+        meal = Meal.objects.get(pk=self.meal.pk)
+        meal.meal_photo = SimpleUploadedFile('new_meal.jpg', b'new_content')
+
+        # Старое имя файла обработчик pre_save берет из снимка, строка питания не перечитывается
+        # (остальные запросы - путь загрузки из рейса путешествия)
+        with CaptureQueriesContext(connection) as queries:
+            meal.save(update_fields=meal.changed_fields)
+        self.assertEqual([query['sql'].split()[0] for query in queries if 'flights_meal' in query['sql']],
+                         ['UPDATE'])
+
+        meal.refresh_from_db()
+        self.assertTrue(meal.meal_photo.name.endswith('new_meal.jpg'))
+        self.assertEqual(meal.renditions, {})
+
+    def test_flight_info_counters_from_snapshot(self):
+        flight_info = FlightInfo.objects.get(pk=self.flight_info_dep.pk)
+        flight_info.airport_code = 'OVB'
+        flight_info.save()
+
+        counters = dict(SiteCounter.objects.filter(kind=SiteCounter.AIRPORT).values_list('key', 'refcount'))
+        self.assertEqual(counters.get('OVB'), 1)
+        self.assertFalse(counters.get('KJA'))
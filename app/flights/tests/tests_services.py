@@ -1,7 +1,27 @@
+import json
 import os
+import shutil
+import tempfile
+import threading
+from dataclasses import FrozenInstanceError
+from datetime import timedelta
+from io import StringIO
+from unittest import skipUnless
 from unittest.mock import patch
 
+from django.conf import settings
+from django.core.exceptions import ValidationError
+from django.core.files.base import ContentFile
+from django.core.files.uploadedfile import SimpleUploadedFile
+from django.core.files.storage import default_storage
+from django.core.management import call_command
+from django.core.management.base import CommandError
+from django.db import IntegrityError, connection, connections, transaction
 from django.db.models import QuerySet
+from django.template import Context, Template
+from django.test import TransactionTestCase, override_settings
+from django.test.utils import CaptureQueriesContext
+from django.utils import timezone
 
 
 
@@ -10,9 +30,30 @@ import django
 
 django.setup()
 
-from test_mixins.test_data_upload import TemproaryMediaRootMixin, UploadDataMixin
-from flights.services import FlightInformationService, PassengerService, PassengerProfileService, FlightDetailService
-from flights.models import UserTrip
+from test_mixins import JobQueueMixin
+from test_mixins.test_data_upload import (TemproaryMediaRootMixin, UploadDataMixin, PostMethodMixin, filesystem_storage,
+                                         tmp_dir, get_image_buffer, FLIGHT_FORM_DATA)
+from flights.services import (FlightInformationService, PassengerService, PassengerProfileService,
+                              FlightDetailService, PassengerStatsService, SiteCounterService,
+                              TripDeletionService, TrackImageService, TripCardService)
+from flights.models import (UserTrip, FlightInfo, TripCard, PassengerStats, SiteCounter, SiteTotal, Airline, Flight,
+                            AppliedFixture, Airframe, AircraftType, Meal, TrackImage, MediaBlob, MediaFile,
+                            Job)
+from flights.dataset import DatasetGenerator
+from flights.forms import AddFlightForm
+from flights.upsert import increment, insert_new, insert_or_get
+from flights.uploads import STAGING_DIR, UploadStager
+from benchmarks import BenchmarkRunner, compare_reports
+from benchmarks.cases import get_sample, get_service_cases
+from flights.importers import FlightLogImporter
+from flights.exporters import FlightLogExporter
+from flights.bootstrap import file_sha256
+from flights.renditions import get_rendition_paths
+from flights.signal_mute import SignalMute
+from flights.identity_map import RequestIdentityMap
+from flights.factories import (AirframeFactory, FlightInfoFactory, MealFactory, TrackImageFactory,
+                               UserTripFactory)
+from users.factories import UserFactory
 
 
 class FlightInformationServiceTest(TemproaryMediaRootMixin, UploadDataMixin):
@@ -73,6 +114,142 @@ class FlightInformationServiceTest(TemproaryMediaRootMixin, UploadDataMixin):
             self.assertEqual(info['value'], value)
 
 
+class TripCardServiceTest(TemproaryMediaRootMixin, UploadDataMixin):
+
+    def test_get_latest_cards_single_query(self):
+        with self.assertNumQueries(1):
+            cards = FlightInformationService.get_latest_cards()
+
+        self.assertEqual(len(cards), 6)
+
+    def test_cards_ordered_by_latest_trip(self):
+        cards = FlightInformationService.get_latest_cards()
+        latest_slugs = list(UserTrip.objects.order_by('-id').values_list('slug', flat=True)[:6])
+
+        self.assertEqual([card['usertripslug'] for card in cards], latest_slugs)
+
+    def test_card_follows_flight_info_changes(self):
+        trip = UserTrip.objects.first()
+        departure = trip.flight.flightinfo_set.filter(status=FlightInfo.DEPARTURE).first()
+        departure.airport_code = 'KJA'
+        departure.save()
+
+        self.assertEqual(TripCard.objects.get(trip=trip).departure, 'KJA')
+
+    def test_card_follows_airline_rename(self):
+        trip = UserTrip.objects.first()
+        airline = trip.flight.airframe.airline
+        airline.name = 'KrasAir'
+        airline.save()
+
+        self.assertEqual(TripCard.objects.get(trip=trip).airline, 'KrasAir')
+
+    def test_card_follows_passenger_rename(self):
+        trip = UserTrip.objects.select_related('passenger').first()
+        passenger = trip.passenger
+        passenger.username = 'renamed'
+        passenger.save()
+
+        self.assertEqual(TripCard.objects.get(trip=trip).passenger, 'renamed')
+        self.assertEqual([card['trip_id'] for card in PassengerProfileService.get_passenger_cards('renamed')],
+                         [trip.pk])
+
+        # Вход пользователя карточки не трогает
+        with self.assertNumQueries(1):
+            passenger.save(update_fields=['last_login'])
+
+    def test_card_deleted_with_trip(self):
+        trip = UserTrip.objects.first()
+        trip.delete()
+
+        self.assertFalse(TripCard.objects.filter(trip_id=trip.pk).exists())
+
+    def test_backfill_command(self):
+        TripCard.objects.all().delete()
+
+        call_command('backfill_trip_cards', batch_size=3, stdout=StringIO())
+
+        self.assertEqual(TripCard.objects.count(), UserTrip.objects.count())
+
+    def test_refresh_single_statement(self):
+        trip = UserTrip.objects.first()
+        with SignalMute.muted():
+            Airframe.objects.filter(pk=trip.flight.airframe_id).delete()
+        TripCard.objects.all().delete()
+
+        expected = []
+        for other in UserTrip.objects.select_related('passenger', 'flight__airframe__airline',
+                                                     'flight__airframe__aircraft_type'):
+            airframe = other.flight.airframe
+            codes = dict(other.flight.flightinfo_set.values_list('status', 'airport_code'))
+            expected.append((other.pk, other.slug,
+                          airframe.photo.name if airframe else '',
+                          airframe.renditions if airframe else {},
+                          other.flight.flight_number, other.flight.date, other.passenger.username,
+                          airframe.airline.name if airframe else '',
+                          f'{airframe.aircraft_type.manufacturer} {airframe.aircraft_type.generic_type}'
+                          if airframe else '',
+                          codes.get(FlightInfo.DEPARTURE, ''), codes.get(FlightInfo.ARRIVAL, '')))
+
+        # Карточки считаются и сохраняются одним INSERT ... SELECT, без чтения строк в Python
+        with self.assertNumQueries(1):
+            refreshed = TripCardService.refresh(UserTrip.objects.all())
+
+        self.assertEqual(refreshed, UserTrip.objects.count())
+        stored = TripCard.objects.values_list('trip_id', 'slug', *TripCardService.CARD_FIELDS)
+        self.assertEqual({(*card[:3], json.dumps(card[3], sort_keys=True), *card[4:]) for card in stored},
+                         {(*card[:3], json.dumps(card[3], sort_keys=True), *card[4:]) for card in expected})
+        self.assertEqual(TripCardService.refresh(UserTrip.objects.none()), 0)
+
+
+class SiteCounterServiceTest(TemproaryMediaRootMixin, UploadDataMixin):
+
+    def test_counters_consistent_after_upload(self):
+        self.assertEqual(SiteCounterService.reconcile(dry_run=True), [])
+
+    def test_get_site_information_single_query(self):
+        with self.assertNumQueries(1):
+            FlightInformationService.get_site_information()
+
+    def test_airport_code_change(self):
+        flight_info = FlightInfo.objects.first()
+        flight_info.airport_code = 'KJA'
+        flight_info.save()
+
+        self.assertEqual(SiteCounter.objects.get(kind=SiteCounter.AIRPORT, key='KJA').refcount, 1)
+        self.assertEqual(SiteCounterService.reconcile(dry_run=True), [])
+
+    def test_airframe_airline_change(self):
+        trip, other_trip = UserTrip.objects.all()[:2]
+        airframe = trip.flight.airframe
+        airframe.airline = other_trip.flight.airframe.airline
+        airframe.save()
+
+        self.assertEqual(SiteTotal.objects.get(kind=SiteCounter.AIRLINE).value, 6)
+        self.assertEqual(SiteCounterService.reconcile(dry_run=True), [])
+
+    def test_trip_delete(self):
+        UserTrip.objects.first().delete()
+
+        self.assertEqual(SiteTotal.objects.get(kind=SiteCounter.AIRFRAME).value, 6)
+        self.assertEqual(SiteCounterService.reconcile(dry_run=True), [])
+
+    def test_airline_delete(self):
+        Airline.objects.first().delete()
+
+        self.assertEqual(SiteTotal.objects.get(kind=SiteCounter.AIRLINE).value, 6)
+        self.assertEqual(SiteCounterService.reconcile(dry_run=True), [])
+
+    def test_reconcile_command_repairs_drift(self):
+        SiteCounter.objects.filter(kind=SiteCounter.AIRPORT).delete()
+        SiteTotal.objects.filter(kind=SiteCounter.AIRPORT).update(value=0)
+
+        call_command('reconcile_site_counters', stdout=StringIO())
+
+        self.assertEqual(SiteCounterService.reconcile(dry_run=True), [])
+        self.assertEqual(FlightInformationService.get_site_information()[3]['value'], 14)
+
+
 class PassengerServiceTest(TemproaryMediaRootMixin, UploadDataMixin):
 
     def test_get_all_passengers_with_statistic(self):
@@ -91,6 +268,65 @@ class PassengerServiceTest(TemproaryMediaRootMixin, UploadDataMixin):
             self.assertIn('total_flights', passenger)
 
 
+class PassengerStatsServiceTest(TemproaryMediaRootMixin, UploadDataMixin):
+
+    def test_stats_consistent_after_upload(self):
+        self.assertEqual(PassengerStatsService.find_inconsistencies(), [])
+
+    def test_stats_values(self):
+        trip = UserTrip.objects.first()
+        stats = PassengerStats.objects.get(passenger=trip.passenger)
+
+        self.assertEqual(stats.total_flights, 1)
+        self.assertEqual(stats.total_airlines, 1)
+        self.assertEqual(stats.total_aircraft_types, 1)
+        self.assertEqual(stats.total_airports, trip.flight.flightinfo_set.values('airport_code').distinct().count())
+
+    def test_stats_follow_new_trip(self):
+        trip = UserTrip.objects.first()
+        other_flight = UserTrip.objects.exclude(pk=trip.pk).first().flight
+        UserTrip.objects.create(flight=other_flight, passenger=trip.passenger)
+
+        stats = PassengerStats.objects.get(passenger=trip.passenger)
+        self.assertEqual(stats.total_flights, 2)
+        self.assertEqual(PassengerStatsService.find_inconsistencies(), [])
+
+    def test_stats_follow_trip_delete(self):
+        trip = UserTrip.objects.first()
+        trip.delete()
+
+        self.assertEqual(PassengerStats.objects.get(passenger=trip.passenger).total_flights, 0)
+        self.assertEqual(PassengerStatsService.find_inconsistencies(), [])
+
+    def test_stats_follow_airport_change(self):
+        trip = UserTrip.objects.first()
+        trip_for_second_flight = UserTrip.objects.exclude(pk=trip.pk).first()
+        UserTrip.objects.create(flight=trip_for_second_flight.flight, passenger=trip.passenger)
+
+        for code, flight_info in zip(('KJA', 'OVB', 'KJA', 'OVB'), FlightInfo.objects.filter(
+                flight__usertrip__passenger=trip.passenger)):
+            flight_info.airport_code = code
+            flight_info.save()
+
+        self.assertEqual(PassengerStats.objects.get(passenger=trip.passenger).total_airports, 2)
+        self.assertEqual(PassengerStatsService.find_inconsistencies(), [])
+
+    def test_rebuild_command_check_and_repair(self):
+        PassengerStats.objects.update(total_flights=100)
+
+        with self.assertRaises(CommandError):
+            call_command('rebuild_passenger_stats', check=True, stdout=StringIO())
+
+        call_command('rebuild_passenger_stats', batch_size=2, stdout=StringIO())
+        call_command('rebuild_passenger_stats', check=True, stdout=StringIO())
+
+    def test_passenger_list_reads_stats_table(self):
+        with self.assertNumQueries(1):
+            passengers = list(PassengerService.get_all_passengers_with_statistic())
+
+        self.assertTrue(all(passenger['total_flights'] == 1 for passenger in passengers))
+
+
 class PassengerProfileServiceTest(TemproaryMediaRootMixin, UploadDataMixin):
 
     def test_get_profile_information(self):
@@ -99,12 +335,47 @@ class PassengerProfileServiceTest(TemproaryMediaRootMixin, UploadDataMixin):
         self.assertIsInstance(profile_info, dict)
         self.assertEqual(profile_info['username'], 'test_user_1')
 
+    def test_profile_information_from_stats_table(self):
+        username = UserTrip.objects.first().passenger.username
+
+        with self.assertNumQueries(1):
+            profile_info = PassengerProfileService.get_profile_information(username)
+
+        self.assertEqual(profile_info['total_flights'], 1)
+        self.assertNotIn('stats_id', profile_info)
+
+    def test_profile_information_without_stats_row(self):
+        username = UserTrip.objects.first().passenger.username
+        expected = PassengerProfileService.get_profile_information(username)
+        PassengerStats.objects.all().delete()
+
+        self.assertEqual(PassengerProfileService.get_profile_information(username), expected)
+
+    def test_get_passenger_statistic(self):
+        trip = UserTrip.objects.first()
+        statistic = PassengerService.get_passenger_statistic(trip.passenger_id)
+
+        self.assertEqual(statistic['total_flights'], 1)
+        self.assertEqual(statistic['total_airlines'], 1)
+        self.assertEqual(statistic['total_aircraft_types'], 1)
+
     def test_get_passenger_flights(self):
         passenger_flights = PassengerProfileService.get_passenger_flights('test_user_1')
 
         self.assertIsInstance(passenger_flights, QuerySet)
         self.assertTrue(all(hasattr(ut.flight, 'flight_number') for ut in passenger_flights))
 
+    def test_explain_hot_paths_command(self):
+        out = StringIO()
+        call_command('explain_hot_paths', stdout=out)
+
+        self.assertIn('PassengerProfileService.get_passenger_cards', out.getvalue())
+        self.assertIn('FlightDetailService.load_flight_details', out.getvalue())
+
+    def test_explain_hot_paths_unknown_slug(self):
+        with self.assertRaises(CommandError):
+            call_command('explain_hot_paths', slug='missing', stdout=StringIO())
+
 
 class FlightDetailServiceTest(TemproaryMediaRootMixin, UploadDataMixin):
 
@@ -185,3 +456,1032 @@ class FlightDetailServiceTest(TemproaryMediaRootMixin, UploadDataMixin):
         ]
         for key in required_keys_id_dict:
             self.assertIn(key, id_dict, f"Key '{key}' not found in id_dict")
+
+    def test_load_flight_details_two_queries(self):
+        trip = UserTrip.objects.first()
+
+        with self.assertNumQueries(2):
+            details = FlightDetailService.load_flight_details(trip.slug)
+            list(details.track_images)
+
+        departure = trip.flight.flightinfo_set.get(status=FlightInfo.DEPARTURE)
+        arrival = trip.flight.flightinfo_set.get(status=FlightInfo.ARRIVAL)
+
+        self.assertEqual(details.departure_info.airport_code, departure.airport_code)
+        self.assertEqual(details.arrival_info.id, arrival.id)
+        self.assertEqual(details.route, f'{departure.airport_code} — {arrival.airport_code}')
+        self.assertEqual(details.meal_id, trip.meal_set.first().id)
+        self.assertEqual(details.user, trip.passenger)
+
+    def test_flight_details_immutable(self):
+        details = FlightDetailService.load_flight_details(UserTrip.objects.first().slug)
+
+        with self.assertRaises(FrozenInstanceError):
+            details.seat = '1A'
+
+    def test_flight_details_not_found(self):
+        with self.assertRaises(UserTrip.DoesNotExist):
+            FlightDetailService.load_flight_details('no-such-trip')
+
+
+class DatasetGeneratorTest(TemproaryMediaRootMixin):
+
+    def generate(self, prefix, seed=7):
+        return DatasetGenerator(seed=seed, batch_size=8, prefix=prefix).generate(
+            users=12, trips_per_user=3, passengers_per_flight=5, airlines=3, aircraft_types=3,
+            airframes=5, airports=20, meal_ratio=0.5, tracks_per_trip=1
+        )
+
+    def test_generate(self):
+        counts = self.generate('a')
+
+        self.assertEqual(counts['trips'], 36)
+        self.assertEqual(counts['flights'], 8)
+        self.assertEqual(UserTrip.objects.count(), 36)
+        self.assertEqual(FlightInfo.objects.count(), 16)
+        self.assertEqual(UserTrip.objects.values('passenger').distinct().count(), 12)
+
+    def test_reproducible(self):
+        self.generate('a')
+        self.generate('b')
+
+        def dates(prefix):
+            return list(Flight.objects.filter(flight_number__startswith=prefix.upper())
+                        .order_by('pk').values_list('date', flat=True))
+
+        self.assertEqual(dates('a'), dates('b'))
+
+    def test_command_builds_read_models(self):
+        call_command('generate_dataset', users=10, airframes=4, airports=10, batch_size=7, stdout=StringIO())
+
+        self.assertEqual(TripCard.objects.count(), UserTrip.objects.count())
+        self.assertEqual(PassengerStats.objects.count(), 10)
+        self.assertEqual(SiteCounterService.reconcile(dry_run=True), [])
+
+        with self.assertRaises(CommandError):
+            call_command('generate_dataset', users=10, stdout=StringIO())
+
+    def test_placeholder_kept_on_delete(self):
+        self.generate('a')
+        trip = UserTrip.objects.first()
+        path = trip.trackimage_set.first().track_img.path
+
+        trip.trackimage_set.all().delete()
+
+        self.assertTrue(os.path.exists(path))
+
+
+class BenchmarkTest(TemproaryMediaRootMixin, UploadDataMixin):
+
+    def test_run_case(self):
+        result = BenchmarkRunner(repeat=3, warmup=1).run_case(
+            lambda rng: FlightInformationService.get_site_information()
+        )
+
+        self.assertEqual(result['queries'], 1)
+        self.assertEqual(result['duplicate_queries'], 0)
+        self.assertLessEqual(result['p50_ms'], result['p95_ms'])
+
+    def test_service_cases(self):
+        runner = BenchmarkRunner(repeat=1, warmup=0)
+        results = runner.run(get_service_cases(get_sample(5, runner.rng)))
+
+        # Статистика профиля: одна строка PassengerStats, агрегат по всем пользователям или агрегат пассажира
+        for name in ('service: PassengerProfileService.get_profile_information',
+                     'baseline: global profile aggregate',
+                     'service: PassengerService.get_passenger_statistic'):
+            self.assertEqual(results[name]['queries'], 1)
+
+    def test_compare_reports(self):
+        baseline = {'results': {'1000': {'home': {'p50_ms': 10, 'p95_ms': 20, 'queries': 3}}}}
+        current = {'results': {'1000': {'home': {'p50_ms': 11, 'p95_ms': 30, 'queries': 4}}}}
+
+        rows = compare_reports(baseline, current, threshold=0.2)
+
+        self.assertEqual([(metric, regression) for _, _, metric, _, _, regression in rows],
+                         [('p50_ms', False), ('p95_ms', True), ('queries', True)])
+
+
+class FlightLogImporterTest(TemproaryMediaRootMixin):
+
+    HEADER = ('flight_number,date,flight_time,airline_name,manufacturer,generic_type,serial_number,'
+              'registration_number,seat,departure_airport_code,departure_runway,'
+              'arrival_airport_code,arrival_runway')
+
+    def setUp(self) -> None:
+        super().setUp()
+        self.user = UserFactory()
+
+    @staticmethod
+    def make_row(number, airline='S7 Airlines', departure='SVO', arrival='LED'):
+        return (f'SU{number},2023-05-{number % 28 + 1:02},01:30,{airline},Airbus,A320,SN{number % 3},'
+                f'RA-{number % 3},1A,{departure},06,{arrival},10')
+
+    def import_csv(self, rows, user=None, batch_size=500):
+        importer = FlightLogImporter(user or self.user, batch_size=batch_size)
+        importer.run([self.HEADER, *rows], 'csv')
+        return importer
+
+    def test_import_csv(self):
+        importer = self.import_csv([self.make_row(1), self.make_row(2, airline=''), self.make_row(3)])
+
+        self.assertEqual(importer.stats['imported'], 2)
+        self.assertEqual(importer.stats['errors'], 1)
+        self.assertEqual(importer.errors[0][0], 3)
+        self.assertEqual(UserTrip.objects.filter(passenger=self.user).count(), 2)
+        self.assertEqual(FlightInfo.objects.count(), 4)
+        self.assertEqual(TripCard.objects.filter(passenger=self.user.username).count(), 2)
+        self.assertEqual(PassengerStats.objects.get(passenger=self.user).total_flights, 2)
+        self.assertEqual(SiteCounterService.reconcile(dry_run=True), [])
+
+    def test_reimport_skips_existing_trips(self):
+        rows = [self.make_row(1), self.make_row(2), self.make_row(1)]
+        first = self.import_csv(rows)
+        second = self.import_csv(rows)
+
+        self.assertEqual((first.stats['imported'], first.stats['skipped']), (2, 1))
+        self.assertEqual((second.stats['imported'], second.stats['skipped']), (0, 3))
+        self.assertEqual(UserTrip.objects.count(), 2)
+
+    def test_shared_flight(self):
+        self.import_csv([self.make_row(1)])
+        self.import_csv([self.make_row(1, departure='DME')], user=UserFactory())
+
+        self.assertEqual(Flight.objects.count(), 1)
+        self.assertEqual(UserTrip.objects.count(), 2)
+        self.assertEqual(list(FlightInfo.objects.values_list('airport_code', flat=True).order_by('status')),
+                         ['LED', 'SVO'])
+        self.assertEqual(SiteCounterService.reconcile(dry_run=True), [])
+
+    def test_counts_only_inserted_rows(self):
+        # Другой импорт успевает вставить вылет, прилет и путешествие между чтением кэшей и вставкой
+        def concurrent_import(model, objs, key):
+            if model is FlightInfo:
+                FlightInfo.objects.bulk_create([FlightInfo(flight_id=info.flight_id, status=info.status,
+                                                           airport_code=info.airport_code) for info in objs])
+            else:
+                UserTrip.objects.create(flight_id=objs[0].flight_id, passenger=self.user, slug='concurrent')
+            return insert_new(model, objs, key)
+
+        with patch('flights.importers.insert_new', side_effect=concurrent_import):
+            importer = self.import_csv([self.make_row(1)])
+
+        self.assertEqual((importer.stats['imported'], importer.stats['skipped']), (0, 1))
+        self.assertEqual(UserTrip.objects.get().slug, 'concurrent')
+        self.assertFalse(SiteCounter.objects.filter(kind=SiteCounter.AIRPORT).exists())
+
+    def test_queries_do_not_grow_with_rows(self):
+        def count_queries(numbers):
+            with CaptureQueriesContext(connection) as context:
+                self.import_csv([self.make_row(number) for number in numbers])
+            return len(context.captured_queries)
+
+        # Первый импорт создает справочники и счетчики, дальше число запросов зависит только от числа пачек
+        count_queries(range(0, 3))
+        self.assertEqual(count_queries(range(100, 103)), count_queries(range(200, 240)))
+
+    def test_import_jsonl(self):
+        line = json.dumps(dict(zip(self.HEADER.split(','), self.make_row(1).split(','))))
+        importer = FlightLogImporter(self.user)
+        importer.run([line, '{broken', '', '[1]'], 'jsonl')
+
+        self.assertEqual(importer.stats['imported'], 1)
+        self.assertEqual([line for line, _ in importer.errors], [2, 4])
+
+    def test_command(self):
+        with tempfile.NamedTemporaryFile('w', suffix='.csv', delete=False) as file:
+            file.write('\n'.join([self.HEADER, self.make_row(1), self.make_row(2)]))
+        path = file.name
+        self.addCleanup(os.remove, path)
+
+        call_command('import_flights', path, user=self.user.username, batch_size=1, stdout=StringIO())
+
+        self.assertEqual(UserTrip.objects.filter(passenger=self.user).count(), 2)
+
+        with self.assertRaises(CommandError):
+            call_command('import_flights', path, user='missing', stdout=StringIO())
+
+
+class FlightLogExporterTest(TemproaryMediaRootMixin, UploadDataMixin):
+
+    def test_csv_round_trip(self):
+        trip = UserTrip.objects.first()
+        exported = ''.join(FlightLogExporter(UserTrip.objects.filter(pk=trip.pk)).stream('csv'))
+
+        user = UserFactory()
+        importer = FlightLogImporter(user)
+        importer.run(exported.splitlines(), 'csv')
+
+        self.assertEqual(importer.errors, [])
+        self.assertEqual(UserTrip.objects.get(passenger=user).flight_id, trip.flight_id)
+
+    def test_jsonl_pivots_flight_info(self):
+        with self.assertNumQueries(1):
+            lines = list(FlightLogExporter(include_passenger=True, chunk_size=2).stream('jsonl'))
+
+        rows = [json.loads(line) for line in lines]
+        trip = UserTrip.objects.get(passenger__username=rows[0]['passenger'], flight__flight_number=rows[0]['flight_number'])
+        departure = FlightInfo.objects.get(flight=trip.flight, status=FlightInfo.DEPARTURE)
+
+        self.assertEqual(len(rows), UserTrip.objects.count())
+        self.assertEqual(rows[0]['departure_airport_code'], departure.airport_code)
+
+    def test_geojson(self):
+        collection = json.loads(''.join(FlightLogExporter().stream('geojson')))
+
+        self.assertEqual(collection['type'], 'FeatureCollection')
+        self.assertEqual(len(collection['features']), UserTrip.objects.count())
+
+    def test_command(self):
+        with tempfile.TemporaryDirectory() as directory:
+            path = os.path.join(directory, 'flights.jsonl')
+            call_command('export_flights', path, stdout=StringIO())
+
+            with open(path) as file:
+                self.assertEqual(len(file.readlines()), UserTrip.objects.count())
+
+        with self.assertRaises(CommandError):
+            call_command('export_flights', 'flights.txt', stdout=StringIO())
+
+
+class BootstrapTest(TemproaryMediaRootMixin):
+
+    def bootstrap(self, *args, **options):
+        output = StringIO()
+        call_command('bootstrap', *args, stdout=output, **options)
+        return output.getvalue()
+
+    def test_fixture_loaded_once(self):
+        output = self.bootstrap('fixture.json', skip_static=True)
+
+        self.assertIn('migrate: skipped', output)
+        self.assertIn('loaded 118 objects', output)
+        self.assertEqual(UserTrip.objects.count(), 8)
+        self.assertEqual(TripCard.objects.count(), 8)
+        self.assertEqual(PassengerStats.objects.count(), 2)
+        self.assertEqual(SiteCounterService.reconcile(dry_run=True), [])
+        self.assertEqual(AppliedFixture.objects.get(name='fixture.json').sha256, file_sha256('fixture.json'))
+
+        with CaptureQueriesContext(connection) as context:
+            output = self.bootstrap('fixture.json', skip_static=True)
+
+        self.assertIn('fixture fixture.json: skipped', output)
+        self.assertLessEqual(len(context.captured_queries), 3)
+
+    def test_changed_fixture_is_upserted(self):
+        self.bootstrap('fixture.json', skip_static=True)
+        with open('fixture.json', encoding='utf-8') as file:
+            objects = json.load(file)
+        airline = next(obj for obj in objects if obj['model'] == 'flights.airline')
+        airline['fields']['name'] = 'Renamed Airline'
+
+        with tempfile.TemporaryDirectory() as directory:
+            path = os.path.join(directory, 'fixture.json')
+            with open(path, 'w', encoding='utf-8') as file:
+                json.dump(objects, file)
+            output = self.bootstrap(path, skip_static=True)
+
+        self.assertIn('loaded 118 objects', output)
+        self.assertEqual(Airline.objects.get(pk=airline['pk']).name, 'Renamed Airline')
+        self.assertEqual(UserTrip.objects.count(), 8)
+        self.assertEqual(AppliedFixture.objects.count(), 1)
+
+    def test_static_collected_only_on_change(self):
+        with tempfile.TemporaryDirectory() as directory, override_settings(STATIC_ROOT=directory):
+            self.assertIn('collectstatic: collected', self.bootstrap(fixtures=[]))
+            self.assertTrue(os.path.exists(os.path.join(directory, 'css')))
+
+            self.assertIn('collectstatic: skipped', self.bootstrap(fixtures=[]))
+
+            with patch('flights.management.commands.bootstrap.get_static_manifest', return_value='changed'):
+                self.assertIn('collectstatic: collected', self.bootstrap(fixtures=[]))
+
+    def test_missing_fixture(self):
+        with self.assertRaises(CommandError):
+            self.bootstrap('missing.json', skip_static=True)
+
+
+class RenditionsBackfillTest(TemproaryMediaRootMixin, UploadDataMixin):
+
+    def test_backfill(self):
+        for model in (Airframe, Meal, TrackImage):
+            model.objects.update(renditions={})
+        TripCard.objects.update(photo_renditions={})
+
+        output = StringIO()
+        call_command('backfill_renditions', workers=2, stdout=output)
+
+        self.assertIn('Images to render: 21', output.getvalue())
+        for model in (Airframe, Meal, TrackImage):
+            for instance in model.objects.all():
+                self.assertEqual(instance.renditions['source'], instance.get_image().name)
+                for path in get_rendition_paths(instance.renditions):
+                    self.assertTrue(default_storage.exists(path))
+        card = TripCard.objects.select_related('trip__flight__airframe').first()
+        self.assertEqual(card.photo_renditions, card.trip.flight.airframe.renditions)
+
+        output = StringIO()
+        call_command('backfill_renditions', workers=1, stdout=output)
+        self.assertIn('Images to render: 0', output.getvalue())
+
+    def test_responsive_image_tag(self):
+        call_command('backfill_renditions', workers=1, stdout=StringIO())
+        airframe = Airframe.objects.first()
+        html = Template("{% load my_tags %}{% responsive_image photo renditions 'card' alt='Photo' %}").render(
+            Context({'photo': airframe.photo, 'renditions': airframe.renditions})
+        )
+
+        self.assertIn('<source type="image/webp"', html)
+        # Копии выводятся по неизменяемым URL содержимого
+        self.assertIn(default_storage.blob_url(airframe.renditions['card']['blobs']['jpeg']), html)
+        self.assertIn('alt="Photo"', html)
+
+        html = Template("{% load my_tags %}{% responsive_image photo renditions %}").render(
+            Context({'photo': airframe.photo.name, 'renditions': {}})
+        )
+        self.assertEqual(html, f'<img src="{airframe.photo.url}">')
+
+
+class ContentAddressedStorageTest(TemproaryMediaRootMixin, JobQueueMixin):
+
+    def save(self, name, content=b'same content'):
+        return default_storage.save(name, ContentFile(content))
+
+    def test_identical_files_stored_once(self):
+        first = self.save('meal/a/photo.jpg')
+        second = self.save('tracks/b/track.jpg')
+
+        blob = MediaBlob.objects.get()
+        self.assertEqual((blob.refcount, blob.size), (2, len(b'same content')))
+        self.assertEqual(default_storage.path(first), default_storage.path(second))
+        self.assertTrue(blob.name.startswith('blobs/'))
+        with default_storage.open(second) as file:
+            self.assertEqual(file.read(), b'same content')
+
+        with self.committed():
+            default_storage.delete(first)
+        self.run_jobs()
+        self.assertFalse(default_storage.exists(first))
+        self.assertTrue(os.path.exists(default_storage.path(second)))
+
+        blob_path = default_storage.path(second)
+        with self.committed():
+            default_storage.delete(second)
+        self.run_jobs()
+        self.assertFalse(MediaBlob.objects.exists())
+        self.assertFalse(os.path.exists(blob_path))
+
+    def test_reuploaded_before_cleanup(self):
+        name = self.save('meal/a/photo.jpg')
+        with self.committed():
+            default_storage.delete(name)
+        name = self.save('meal/a/photo.jpg')
+        self.run_jobs()
+
+        self.assertEqual(MediaBlob.objects.get().refcount, 1)
+        self.assertTrue(os.path.exists(default_storage.path(name)))
+
+    def test_names_resolved_once_per_request(self):
+        first = self.save('meal/a/photo.jpg')
+        second = self.save('tracks/b/track.jpg', b'other content')
+
+        with RequestIdentityMap.scope():
+            with self.assertNumQueries(1):
+                blob_names = default_storage.get_blob_names([first, second, 'meal/a/missing.jpg'])
+                # Разрешенные имена больше не читаются из БД
+                self.assertEqual(default_storage.path(first), default_storage.raw_path(blob_names[first]))
+                self.assertTrue(default_storage.exists(second))
+                self.assertFalse(default_storage.exists('meal/a/missing.jpg'))
+
+            default_storage.delete(first)
+            self.assertFalse(default_storage.exists(first))
+
+    def test_logical_url_redirects_to_blob(self):
+        name = self.save('meal/a/photo.jpg')
+        blob_name = MediaFile.objects.get(name=name).blob.name
+
+        response = self.client.get(default_storage.url(name))
+        self.assertRedirects(response, default_storage.blob_url(blob_name), fetch_redirect_response=False)
+        # Перенаправление кешируется: повторный показ не стоит лишнего запроса
+        self.assertIn(f'max-age={settings.MEDIA_REDIRECT_MAX_AGE}', response['Cache-Control'])
+        self.assertEqual(self.client.get('/media/meal/a/missing.jpg').status_code, 404)
+
+        response = self.client.get(default_storage.blob_url(blob_name))
+        self.assertEqual(b''.join(response.streaming_content), b'same content')
+        self.assertIn('immutable', response['Cache-Control'])
+
+    @override_settings(DEBUG=False)
+    def test_legacy_file_served_without_debug(self):
+        # Файл, загруженный до перехода на адресацию по содержимому: записи MediaFile нет
+        os.makedirs(os.path.join(self.media_root, 'meal/legacy'), exist_ok=True)
+        with open(os.path.join(self.media_root, 'meal/legacy/photo.jpg'), 'wb') as file:
+            file.write(b'legacy content')
+        self.addCleanup(shutil.rmtree, os.path.join(self.media_root, 'meal/legacy'))
+
+        response = self.client.get(default_storage.url('meal/legacy/photo.jpg'))
+
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(b''.join(response.streaming_content), b'legacy content')
+
+    def test_staged_files_not_served(self):
+        os.makedirs(os.path.join(self.media_root, STAGING_DIR), exist_ok=True)
+        with open(os.path.join(self.media_root, STAGING_DIR, 'upload.jpg'), 'wb') as file:
+            file.write(b'staged content')
+        self.addCleanup(os.remove, os.path.join(self.media_root, STAGING_DIR, 'upload.jpg'))
+
+        self.assertEqual(self.client.get(default_storage.url(f'{STAGING_DIR}/upload.jpg')).status_code, 404)
+
+    def test_migrate_legacy_files(self):
+        with filesystem_storage, self.committed():
+            trips = UserTripFactory.create_batch(2)
+            MealFactory(trip=trips[0])
+            call_command('backfill_renditions', workers=1, stdout=StringIO())
+
+        meal = Meal.objects.get()
+        legacy_path = os.path.join(self.media_root, meal.meal_photo.name)
+        self.assertTrue(os.path.exists(legacy_path))
+
+        output = StringIO()
+        with self.committed():
+            call_command('migrate_media_to_cas', stdout=output)
+
+        # Три оригинала 100x100 и по две копии (WebP и JPEG) каждого
+        self.assertIn('Migrated 9 files', output.getvalue())
+        self.assertFalse(os.path.exists(legacy_path))
+        with default_storage.open(meal.meal_photo.name) as file:
+            self.assertEqual(file.read()[:2], b'\xff\xd8')
+        # Фабрики загружают одинаковые изображения: оригиналы и их копии хранятся по одному разу
+        self.assertEqual(MediaFile.objects.count(), 9)
+        self.assertEqual(MediaBlob.objects.count(), 3)
+        self.assertEqual(sum(MediaBlob.objects.values_list('refcount', flat=True)), 9)
+
+        meal.refresh_from_db()
+        self.assertEqual(set(meal.renditions['card']['blobs']), {'webp', 'jpeg'})
+
+        output = StringIO()
+        call_command('migrate_media_to_cas', stdout=output)
+        self.assertIn('Migrated 0 files', output.getvalue())
+
+
+class TripDeletionServiceTest(TemproaryMediaRootMixin, UploadDataMixin, JobQueueMixin):
+
+    def test_shared_flight_kept(self):
+        trip = UserTrip.objects.first()
+        other_trip = UserTrip.objects.create(flight=trip.flight, passenger=UserFactory())
+
+        deleted = TripDeletionService.delete(trips=UserTrip.objects.filter(pk=trip.pk))
+
+        self.assertEqual(deleted['flights.UserTrip'], 1)
+        self.assertNotIn('flights.Flight', deleted)
+        self.assertTrue(Flight.objects.filter(pk=trip.flight_id).exists())
+        self.assertEqual(other_trip.flight.flightinfo_set.count(), 2)
+        self.assertEqual(SiteCounterService.reconcile(dry_run=True), [])
+
+    def test_last_trip_removes_flight_and_airframe(self):
+        trip = UserTrip.objects.select_related('flight__airframe').first()
+        paths = [trip.flight.airframe.photo.name, *trip.meal_set.values_list('meal_photo', flat=True),
+                 *trip.trackimage_set.values_list('track_img', flat=True)]
+
+        with self.committed():
+            deleted = TripDeletionService.delete(trips=UserTrip.objects.filter(pk=trip.pk))
+
+        self.assertEqual(deleted, {'flights.TrackImage': 1, 'flights.Meal': 1, 'flights.TripCard': 1,
+                                   'flights.UserTrip': 1, 'flights.FlightInfo': 2, 'flights.Flight': 1,
+                                   'flights.Airframe': 1})
+        self.assertFalse(Airframe.objects.filter(pk=trip.flight.airframe_id).exists())
+        self.assertEqual(SiteCounterService.reconcile(dry_run=True), [])
+        self.assertEqual(PassengerStats.objects.get(passenger=trip.passenger).total_flights, 0)
+        self.assertEqual(PassengerStatsService.find_inconsistencies(), [])
+
+        # Файлы удаляет воркер после коммита
+        self.assertTrue(all(default_storage.exists(path) for path in paths))
+        self.run_jobs()
+        self.assertFalse(any(default_storage.exists(path) for path in paths))
+
+    def test_rollback_keeps_files(self):
+        trip = UserTrip.objects.first()
+        path = trip.meal_set.get().meal_photo.name
+
+        with self.captureOnCommitCallbacks(execute=True) as callbacks:
+            try:
+                with transaction.atomic():
+                    TripDeletionService.delete(trips=UserTrip.objects.filter(pk=trip.pk))
+                    raise RuntimeError
+            except RuntimeError:
+                pass
+
+        self.assertEqual(callbacks, [])
+        self.assertTrue(UserTrip.objects.filter(pk=trip.pk).exists())
+        self.run_jobs()
+        self.assertTrue(default_storage.exists(path))
+
+    def test_user_delete_removes_orphans(self):
+        trip = UserTrip.objects.select_related('passenger', 'flight').first()
+        paths = [*trip.meal_set.values_list('meal_photo', flat=True),
+                 *trip.trackimage_set.values_list('track_img', flat=True)]
+
+        with self.committed():
+            trip.passenger.delete()
+
+        self.assertFalse(Flight.objects.filter(pk=trip.flight_id).exists())
+        self.assertFalse(Airframe.objects.filter(pk=trip.flight.airframe_id).exists())
+        self.assertEqual(SiteCounterService.reconcile(dry_run=True), [])
+        self.run_jobs()
+        self.assertFalse(any(default_storage.exists(path) for path in paths))
+
+    def test_user_delete_query_count(self):
+        def make_passenger(trips):
+            passenger = UserFactory()
+            for trip in UserTripFactory.create_batch(trips, passenger=passenger):
+                FlightInfoFactory(flight=trip.flight, status=FlightInfo.DEPARTURE)
+                FlightInfoFactory(flight=trip.flight, status=FlightInfo.ARRIVAL)
+                MealFactory(trip=trip)
+                TrackImageFactory(trip=trip)
+            return passenger
+
+        def delete(passenger):
+            with CaptureQueriesContext(connection) as context, self.captureOnCommitCallbacks() as callbacks:
+                passenger.delete()
+            return len(context.captured_queries), len(callbacks)
+
+        # Запросы и задачи после коммита не зависят от числа путешествий пользователя
+        self.assertEqual(delete(make_passenger(2)), delete(make_passenger(10)))
+        self.assertEqual(SiteCounterService.reconcile(dry_run=True), [])
+
+    def test_receivers_muted(self):
+        trip = UserTrip.objects.first()
+
+        # Файлы и карточки по одной строке обработчики не трогают: это делает сервис для всего набора
+        with patch('flights.signals.enqueue') as enqueue, patch('flights.signals.TripCardService.refresh') as refresh:
+            TripDeletionService.delete(trips=UserTrip.objects.filter(pk=trip.pk))
+
+        enqueue.assert_not_called()
+        refresh.assert_not_called()
+
+    def test_queryset_delete_query_count(self):
+        with CaptureQueriesContext(connection) as single:
+            UserTrip.objects.filter(pk=UserTrip.objects.first().pk).delete()
+        with CaptureQueriesContext(connection) as many:
+            count, per_model = UserTrip.objects.all().delete()
+
+        # Число запросов не зависит от числа удаляемых путешествий
+        self.assertLessEqual(len(many), len(single) + 1)
+        self.assertEqual(per_model['flights.UserTrip'], 6)
+        self.assertEqual(count, sum(per_model.values()))
+        self.assertFalse(Flight.objects.exists())
+        self.assertEqual(SiteCounterService.reconcile(dry_run=True), [])
+
+    def test_flight_delete(self):
+        flight = Flight.objects.first()
+        flight.delete()
+
+        self.assertFalse(UserTrip.objects.filter(flight=flight.pk).exists())
+        self.assertFalse(FlightInfo.objects.filter(flight=flight.pk).exists())
+
+
+class TrackImageServiceTest(TemproaryMediaRootMixin, UploadDataMixin, JobQueueMixin):
+
+    def setUp(self):
+        super().setUp()
+        self.trip = UserTrip.objects.select_related('flight', 'passenger').first()
+
+    def stage(self, stager, count):
+        return [stager.stage(SimpleUploadedFile(f'track-{i}.png', get_image_buffer().read()),
+                             TrackImage(trip=self.trip), 'track_img')
+                for i in range(count)]
+
+    def add(self, count):
+        with UploadStager() as stager:
+            uploads = self.stage(stager, count)
+            with CaptureQueriesContext(connection) as context:
+                with stager.atomic():
+                    track_images = TrackImageService.add(self.trip, uploads)
+        return track_images, context
+
+    def test_add_single_insert(self):
+        with self.committed():
+            track_images, context = self.add(5)
+
+        inserts = [query for query in context.captured_queries
+                   if query['sql'].startswith('INSERT INTO "flights_trackimage"')]
+        self.assertEqual(len(inserts), 1)
+        self.assertEqual(self.trip.trackimage_set.count(), 6)
+        self.assertEqual(Job.objects.filter(kind='render_renditions').count(), 5)
+        # Файлы опубликованы после коммита под именами из строк
+        for track_image in track_images:
+            self.assertTrue(track_image.track_img.name.startswith(f'tracks/{self.trip.passenger.username}/'.lower()))
+            self.assertTrue(default_storage.exists(track_image.track_img.name))
+
+    def test_add_query_count_independent_of_files(self):
+        _, one = self.add(1)
+        _, many = self.add(10)
+
+        self.assertEqual(len(one), len(many))
+
+    def test_delete(self):
+        with self.committed():
+            track_images, _ = self.add(3)
+        other_trip_image = TrackImage.objects.exclude(trip=self.trip).first()
+        paths = [track_image.track_img.name for track_image in track_images]
+
+        with self.committed():
+            with CaptureQueriesContext(connection) as context:
+                deleted = TrackImageService.delete(self.trip, [track_image.pk for track_image in track_images]
+                                                   + [other_trip_image.pk])
+
+        self.assertEqual(deleted, 3)
+        self.assertEqual(len([query for query in context.captured_queries
+                              if query['sql'].startswith('DELETE')]), 1)
+        self.assertTrue(TrackImage.objects.filter(pk=other_trip_image.pk).exists())
+        # Файлы удаляются одной задачей после коммита
+        self.assertEqual(Job.objects.filter(kind='delete_files').count(), 1)
+        self.run_jobs()
+        self.assertFalse(any(default_storage.exists(path) for path in paths))
+
+    def test_delete_nothing(self):
+        with self.assertNumQueries(0):
+            self.assertEqual(TrackImageService.delete(self.trip, []), 0)
+
+
+class InsertOrGetTest(TemproaryMediaRootMixin):
+
+    def setUp(self):
+        super().setUp()
+        self.trip = UserTripFactory()
+        self.departure = FlightInfo.objects.create(flight=self.trip.flight, status=FlightInfo.DEPARTURE,
+                                                   airport_code='SVO')
+
+    def test_existing_key(self):
+        key = {'flight_id': self.trip.flight_id, 'status': FlightInfo.DEPARTURE}
+        self.assertEqual(insert_or_get(FlightInfo, key, {'airport_code': 'LED'}), (self.departure.pk, False))
+
+    def test_other_unique_constraint_not_swallowed(self):
+        # Новый ключ (flight, status), но тот же (flight, airport_code): это не "строка уже есть"
+        key = {'flight_id': self.trip.flight_id, 'status': FlightInfo.ARRIVAL}
+
+        with CaptureQueriesContext(connection) as context:
+            with self.assertRaises(IntegrityError), transaction.atomic():
+                insert_or_get(FlightInfo, key, {'airport_code': 'SVO'})
+
+        self.assertEqual(len([query for query in context.captured_queries
+                              if query['sql'].startswith('INSERT')]), 1)
+
+
+class InsertNewTest(TemproaryMediaRootMixin):
+
+    def test_returns_inserted(self):
+        existing = Airline.objects.create(name='Aeroflot')
+
+        with self.assertNumQueries(1):
+            inserted = insert_new(Airline, [Airline(name='S7 Airlines'), Airline(name='Aeroflot')], ('name',))
+
+        self.assertEqual([airline.name for airline in inserted], ['S7 Airlines'])
+        self.assertEqual(inserted[0].pk, Airline.objects.get(name='S7 Airlines').pk)
+        self.assertEqual(Airline.objects.get(name='Aeroflot').pk, existing.pk)
+
+
+class IncrementTest(TemproaryMediaRootMixin):
+
+    def test_adds_and_inserts(self):
+        SiteCounter.objects.create(kind=SiteCounter.AIRLINE, key='1', refcount=2)
+
+        with self.assertNumQueries(1):
+            values = increment(SiteCounter, ('kind', 'key'), 'refcount',
+                               {(SiteCounter.AIRLINE, '1'): 1, (SiteCounter.AIRPORT, 'SVO'): 3})
+
+        self.assertEqual(values, {(SiteCounter.AIRLINE, '1'): 3, (SiteCounter.AIRPORT, 'SVO'): 3})
+        self.assertEqual(dict(SiteCounter.objects.values_list('key', 'refcount')), {'1': 3, 'SVO': 3})
+
+
+class FlightSaveServiceTest(TemproaryMediaRootMixin, PostMethodMixin):
+
+    def save(self, user, **data):
+        form = AddFlightForm(data={**self.data, **data}, files={
+            'airframe_photo': SimpleUploadedFile('airframe.jpg', self.get_image_buffer().read()),
+            'meal_photo': SimpleUploadedFile('meal.jpg', self.get_image_buffer().read()),
+        })
+        self.assertTrue(form.is_valid(), form.errors)
+        return form.save(user=user), form.round_trips
+
+    def test_new_trip(self):
+        user = UserFactory()
+        with CaptureQueriesContext(connection) as context:
+            trip, round_trips = self.save(user)
+
+        # Запросы подготовки файлов выполняются до транзакции и в round_trips не входят
+        self.assertLessEqual(round_trips, len(context.captured_queries))
+        self.assertLessEqual(round_trips, 12)
+        self.assertEqual(trip.passenger, user)
+        self.assertEqual(trip.slug, f'fl123-2023-01-01-{user.username}'.lower())
+        self.assertEqual(FlightInfo.objects.filter(flight=trip.flight).count(), 2)
+        self.assertEqual(trip.meal_set.get().drinks, 'Test drinks')
+        self.assertTrue(trip.flight.airframe.photo.name.startswith('airframes/s7 airlines/'))
+        self.assertTrue(TripCard.objects.filter(trip=trip).exists())
+        self.assertEqual(PassengerStats.objects.get(passenger=user).total_flights, 1)
+        self.assertEqual(SiteCounterService.reconcile(dry_run=True), [])
+
+        # Обе записи FlightInfo вставляются одним запросом
+        inserts = [query for query in context.captured_queries
+                   if query['sql'].startswith('INSERT INTO "flights_flightinfo"')]
+        self.assertEqual(len(inserts), 1)
+
+    def test_shared_flight(self):
+        first, _ = self.save(UserFactory())
+        second, round_trips = self.save(UserFactory(), flight_time='13:00', departure_gate='C')
+
+        self.assertEqual(second.flight_id, first.flight_id)
+        self.assertLessEqual(round_trips, 5)
+        for model in (AircraftType, Airline, Airframe, Flight):
+            self.assertEqual(model.objects.count(), 1)
+        self.assertEqual(FlightInfo.objects.get(status=FlightInfo.DEPARTURE).gate, 'A')
+        self.assertEqual(second.flight.flight_time.hour, 12)
+        # Фото существующего борта не сохраняется
+        self.assertFalse(MediaFile.objects.filter(name__startswith='airframes/').exclude(
+            name=first.flight.airframe.photo.name).exists())
+        self.assertEqual(SiteCounterService.reconcile(dry_run=True), [])
+        self.assertEqual(PassengerStatsService.find_inconsistencies(), [])
+
+    def test_shared_flight_other_airframe(self):
+        first, _ = self.save(UserFactory())
+        user = UserFactory()
+        with CaptureQueriesContext(connection) as context, self.captureOnCommitCallbacks(execute=True):
+            with self.assertRaises(ValidationError) as error:
+                self.save(user, serial_number='XYZ', registration_number='RA-00000',
+                          airline_name='Aeroflot', generic_type='A321')
+
+        # Другой борт существующего полета - ошибка ввода: ничего не вставляется
+        self.assertEqual(error.exception.error_dict['registration_number'][0].code, 'airframe_conflict')
+        self.assertFalse([query for query in context.captured_queries if query['sql'].startswith('INSERT')])
+        self.assertEqual(UserTrip.objects.get(), first)
+        for model in (AircraftType, Airline, Airframe):
+            self.assertEqual(model.objects.count(), 1)
+        self.assertFalse(MediaFile.objects.filter(name__startswith='airframes/').exclude(
+            name=first.flight.airframe.photo.name).exists())
+        self.assertEqual(SiteCounterService.reconcile(dry_run=True), [])
+
+    def test_shared_flight_deleted_airframe(self):
+        first, _ = self.save(UserFactory())
+        with SignalMute.muted():
+            Airframe.objects.all().delete()
+        SiteCounterService.reconcile()
+
+        second, _ = self.save(UserFactory(), serial_number='XYZ', registration_number='RA-00000')
+
+        # Полет без борта получает борт из формы, карточки и статистика обоих пассажиров его показывают
+        self.assertEqual(second.flight_id, first.flight_id)
+        airframe = Airframe.objects.get()
+        self.assertEqual(Flight.objects.get().airframe, airframe)
+        self.assertEqual(airframe.registration_number, 'RA-00000')
+        self.assertEqual(set(TripCard.objects.values_list('photo_url', flat=True)), {airframe.photo.name})
+        self.assertEqual(SiteCounterService.reconcile(dry_run=True), [])
+        self.assertEqual(PassengerStatsService.find_inconsistencies(), [])
+
+    def test_repeated_submission(self):
+        user = UserFactory()
+        first, _ = self.save(user)
+        second, round_trips = self.save(user)
+
+        self.assertEqual(second.pk, first.pk)
+        self.assertEqual(UserTrip.objects.count(), 1)
+        self.assertEqual(Meal.objects.count(), 1)
+        self.assertEqual(FlightInfo.objects.count(), 2)
+        self.assertIsNotNone(round_trips)
+
+    def lose_flight_race(self, airframe):
+        '''Между поиском полета и его вставкой тот же полет с бортом airframe сохраняет параллельный запрос'''
+
+        def insert_or_get_after_race(model, key, values=None):
+            if model is Flight:
+                Flight.objects.create(**key, flight_time=values['flight_time'], airframe=airframe)
+            return insert_or_get(model, key, values)
+
+        return patch('flights.services.insert_or_get', side_effect=insert_or_get_after_race)
+
+    def test_lost_flight_race(self):
+        airframe = AirframeFactory(serial_number=self.data['serial_number'],
+                                   registration_number=self.data['registration_number'])
+        user = UserFactory()
+
+        with self.lose_flight_race(airframe), CaptureQueriesContext(connection) as context:
+            trip, _ = self.save(user)
+
+        # INSERT ... ON CONFLICT DO NOTHING ничего не вставил: путешествие добавлено к полету параллельного запроса
+        flight = Flight.objects.get()
+        self.assertEqual(trip.flight, flight)
+        self.assertEqual(flight.airframe, airframe)
+        self.assertEqual(len([query for query in context.captured_queries
+                              if query['sql'].startswith('INSERT INTO "flights_flight"')]), 2)
+        self.assertEqual(Airframe.objects.count(), 1)
+        self.assertFalse(FlightInfo.objects.exists())
+        self.assertTrue(TripCard.objects.filter(trip=trip).exists())
+
+    def test_lost_flight_race_other_airframe(self):
+        airframe = AirframeFactory()
+        user = UserFactory()
+
+        with self.lose_flight_race(airframe), self.assertRaises(ValidationError) as error:
+            self.save(user)
+
+        # Борт формы, вставленный до проигранной вставки полета, откатывается вместе с транзакцией
+        self.assertEqual(error.exception.error_dict['registration_number'][0].code, 'airframe_conflict')
+        self.assertEqual(list(Airframe.objects.all()), [airframe])
+        self.assertFalse(UserTrip.objects.exists())
+
+
+@skipUnless(connection.vendor == 'postgresql',
+            'SQLite не допускает одновременных записей: потоки выполнялись бы по очереди и гонку не проверяли')
+@override_settings(MEDIA_ROOT=tmp_dir,
+                   CACHES={'default': {'BACKEND': 'django.core.cache.backends.locmem.LocMemCache'}})
+class ConcurrentFlightSaveTest(TransactionTestCase):
+    '''Одновременные отправки одного полета разными пассажирами из отдельных потоков и соединений.
+    Проигранные вставки без потоков проверяют FlightSaveServiceTest.test_lost_flight_race*'''
+
+    THREADS = 8
+
+    def tearDown(self):
+        super().tearDown()
+        shutil.rmtree(tmp_dir, ignore_errors=True)
+
+    def submit(self, user, barrier, errors):
+        data = {**FLIGHT_FORM_DATA, 'ticket_price': 100 + user.pk}
+        try:
+            form = AddFlightForm(data=data, files={
+                'airframe_photo': SimpleUploadedFile('airframe.jpg', get_image_buffer().read()),
+            })
+            form.is_valid()
+            barrier.wait()
+            form.save(user=user)
+        except Exception as error:
+            errors.append(error)
+        finally:
+            connections.close_all()
+
+    def test_concurrent_submissions(self):
+        users = UserFactory.create_batch(self.THREADS)
+        barrier = threading.Barrier(self.THREADS)
+        errors = []
+
+        threads = [threading.Thread(target=self.submit, args=(user, barrier, errors)) for user in users]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+        self.assertEqual(errors, [])
+        for model in (AircraftType, Airline, Airframe, Flight):
+            self.assertEqual(model.objects.count(), 1)
+        self.assertEqual(FlightInfo.objects.count(), 2)
+        self.assertEqual(UserTrip.objects.count(), self.THREADS)
+        self.assertEqual(TripCard.objects.count(), self.THREADS)
+        self.assertEqual(SiteCounterService.reconcile(dry_run=True), [])
+        self.assertEqual(PassengerStatsService.find_inconsistencies(), [])
+
+
+class UploadStagerTest(TemproaryMediaRootMixin, JobQueueMixin):
+
+    def setUp(self):
+        super().setUp()
+        self.meal = MealFactory()
+        self.staging_dir = os.path.join(self.media_root, STAGING_DIR)
+
+    def stage(self, stager, content=b'staged content'):
+        return stager.stage(SimpleUploadedFile('photo.jpg', content), self.meal, 'meal_photo')
+
+    def test_published_after_commit(self):
+        with self.committed():
+            with UploadStager() as stager:
+                upload = self.stage(stager)
+                self.assertTrue(upload.name.startswith(f'meal/{self.meal.trip.flight.flight_number}/'.lower()))
+
+                with stager.atomic():
+                    self.meal.meal_photo = upload.bind(self.meal)
+                    self.meal.save(update_fields=['meal_photo'])
+                    # В транзакции записано только имя, файла в хранилище еще нет
+                    self.assertFalse(default_storage.exists(upload.name))
+
+        self.assertIsNotNone(stager.lock_hold_ms)
+        with default_storage.open(upload.name) as file:
+            self.assertEqual(file.read(), b'staged content')
+        self.assertEqual(os.listdir(self.staging_dir), [])
+
+    def test_rollback_discards_files(self):
+        with self.assertRaises(RuntimeError):
+            with UploadStager() as stager:
+                upload = self.stage(stager)
+                with stager.atomic():
+                    self.meal.meal_photo = upload.bind(self.meal)
+                    self.meal.save(update_fields=['meal_photo'])
+                    raise RuntimeError
+
+        self.assertFalse(os.path.exists(upload.path))
+        self.assertFalse(default_storage.exists(upload.name))
+
+    def test_name_taken_during_transaction(self):
+        trip = UserTripFactory()
+        airframe = trip.flight.airframe
+
+        with self.committed():
+            with UploadStager() as stager:
+                upload = stager.stage(SimpleUploadedFile('photo.jpg', b'staged content'), airframe, 'photo')
+                with stager.atomic():
+                    airframe.photo = upload.bind(airframe)
+                    airframe.save(update_fields=['photo'])
+                    # Параллельный запрос успел опубликовать файл под тем же именем
+                    default_storage.save(upload.name, ContentFile(b'other content'))
+
+        airframe.refresh_from_db()
+        self.assertNotEqual(airframe.photo.name, upload.name)
+        self.assertEqual(TripCard.objects.get(trip=trip).photo_url, airframe.photo.name)
+        with default_storage.open(airframe.photo.name) as file:
+            self.assertEqual(file.read(), b'staged content')
+
+        # Файл под прежним именем принадлежит другому запросу и не удаляется
+        self.run_jobs()
+        with default_storage.open(upload.name) as file:
+            self.assertEqual(file.read(), b'other content')
+
+    def test_unbound_upload_not_published(self):
+        with self.committed():
+            with UploadStager() as stager:
+                upload = self.stage(stager)
+                with stager.atomic():
+                    pass
+
+        self.assertFalse(default_storage.exists(upload.name))
+        self.assertEqual(os.listdir(self.staging_dir), [])
+
+
+class MediaGarbageCollectorTest(TemproaryMediaRootMixin, JobQueueMixin):
+
+    def write_orphan(self, name, content=b'orphan', age=timedelta(days=1)):
+        path = os.path.join(self.media_root, name)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        with open(path, 'wb') as file:
+            file.write(content)
+        mtime = (timezone.now() - age).timestamp()
+        os.utime(path, (mtime, mtime))
+        return path
+
+    def setUp(self):
+        super().setUp()
+        self.meal = MealFactory()
+        self.legacy_orphan = self.write_orphan('meal/gc/left.jpg')
+        self.blob_orphan = self.write_orphan('blobs/00/00/0000.jpg')
+        self.recent = self.write_orphan('meal/gc/uploading.jpg', age=timedelta())
+
+        # Имя без ссылок из моделей, например после bulk-удаления
+        self.unused = default_storage.save('meal/gc/unused.jpg', ContentFile(b'unused content'))
+        MediaFile.objects.filter(name=self.unused).update(created_at=timezone.now() - timedelta(days=1))
+        self.unused_blob_path = default_storage.path(self.unused)
+
+    def gc_media(self, **options):
+        output = StringIO()
+        with self.committed():
+            call_command('gc_media', stdout=output, **options)
+        return output.getvalue()
+
+    def test_dry_run(self):
+        output = self.gc_media(dry_run=True)
+
+        reclaimable = len(b'orphan') * 2 + len(b'unused content')
+        self.assertIn(f'Would reclaim {reclaimable} bytes: 2 unreferenced files, 1 names, 1 blobs', output)
+        for path in (self.legacy_orphan, self.blob_orphan, self.unused_blob_path):
+            self.assertTrue(os.path.exists(path))
+        self.assertTrue(MediaFile.objects.filter(name=self.unused).exists())
+
+    def test_unreferenced_deleted(self):
+        output = self.gc_media()
+
+        self.assertIn('2 unreferenced files, 1 names, 1 blobs; skipped 1 recent files', output)
+        for path in (self.legacy_orphan, self.blob_orphan, self.unused_blob_path):
+            self.assertFalse(os.path.exists(path))
+        self.assertFalse(MediaFile.objects.filter(name=self.unused).exists())
+        self.assertTrue(os.path.exists(self.recent))
+        self.assertTrue(os.path.exists(self.meal.meal_photo.path))
+
+        self.run_jobs()
+        self.assertIn('Reclaimed 0 bytes', self.gc_media())
+
+    def test_placeholders_kept(self):
+        # Заглушку уже не использует ни одна строка, но следующая генерация данных возьмет ее снова
+        placeholder = DatasetGenerator.get_placeholder('airframe', 'gray')
+        MediaFile.objects.filter(name=placeholder).update(created_at=timezone.now() - timedelta(days=1))
+        legacy_placeholder = self.write_orphan('placeholders/meal.jpg')
+        # Каталог MEDIA_ROOT общий для тестов класса, а их подсчеты файлов заглушки не ожидают
+        self.addCleanup(os.remove, default_storage.path(placeholder))
+        self.addCleanup(os.remove, legacy_placeholder)
+
+        self.gc_media()
+
+        self.assertTrue(default_storage.exists(placeholder))
+        self.assertTrue(os.path.exists(default_storage.path(placeholder)))
+        self.assertTrue(os.path.exists(legacy_placeholder))
+
+    def test_quarantine(self):
+        quarantine = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, quarantine, ignore_errors=True)
+        self.gc_media(quarantine=quarantine)
+
+        self.assertFalse(os.path.exists(self.legacy_orphan))
+        self.assertTrue(os.path.exists(os.path.join(quarantine, 'meal', 'gc', 'left.jpg')))
+        self.assertTrue(os.path.exists(os.path.join(quarantine, 'blobs', '00', '00', '0000.jpg')))
@@ -1,5 +1,6 @@
 import os
 from datetime import time
+from io import BytesIO
 
 os.environ.setdefault("DJANGO_SETTINGS_MODULE", "aviablog.settings")
 import django
@@ -7,16 +8,28 @@ import django
 django.setup()
 
 from django.core.files.uploadedfile import SimpleUploadedFile
+from PIL import Image
 from django.db.models.signals import pre_save, post_delete
+from django.core.files.storage import default_storage
 
 from flights.models import Airframe, TrackImage, Meal, Airline, UserTrip, Flight, FlightInfo, AircraftType
 from flights.tests.tests_model import TemproaryMediaRootMixin
+from test_mixins import JobQueueMixin
+from test_mixins.test_data_upload import filesystem_storage
+from flights.factories import MealFactory, UserTripFactory
+from flights.renditions import get_rendition_paths
+from flights.jobs import TASKS, enqueue, task
+from flights.models import Job
+from django.core.management import call_command
+from django.db import transaction
+from django.utils import timezone
+from io import StringIO
 from django.contrib.auth import get_user_model
 
 UserClass = get_user_model()
 
 
-class SettingsMixin(TemproaryMediaRootMixin):
+class SettingsMixin(TemproaryMediaRootMixin, JobQueueMixin):
     @classmethod
     def setUpClass(cls):
         super().setUpClass()
@@ -96,7 +109,9 @@ class PreSavePhotoDeleteSignalHandlerTest(SettingsMixin):
             airline=self.airline
         )
 
-        pre_save.send(sender=Airframe, instance=new_airframe)
+        with self.committed():
+            pre_save.send(sender=Airframe, instance=new_airframe)
+        self.run_jobs()
 
         self.assertFalse(self.airframe.photo.storage.exists(self.airframe.photo.name))
 
@@ -111,7 +126,9 @@ class PreSavePhotoDeleteSignalHandlerTest(SettingsMixin):
             meal_price=340,
             meal_photo=SimpleUploadedFile('new_meal.jpg', b"file_content")
         )
-        pre_save.send(sender=Meal, instance=new_meal)
+        with self.committed():
+            pre_save.send(sender=Meal, instance=new_meal)
+        self.run_jobs()
 
         self.assertFalse(self.meal.meal_photo.storage.exists(self.meal.meal_photo.name))
 
@@ -121,11 +138,14 @@ class PreSavePhotoDeleteSignalHandlerTest(SettingsMixin):
             trip=self.usertrip,
             track_img=SimpleUploadedFile('new_track-xx.jpg', b"file_content")
         )
-        pre_save.send(sender=TrackImage, instance=new_track_image)
+        with self.committed():
+            pre_save.send(sender=TrackImage, instance=new_track_image)
+        self.run_jobs()
 
         self.assertFalse(self.track_image.track_img.storage.exists(self.track_image.track_img.name))
 
 
+@filesystem_storage
 class PostDeleteImageSignalHandlerTest(SettingsMixin):
 
     @staticmethod
@@ -157,7 +177,9 @@ class PostDeleteImageSignalHandlerTest(SettingsMixin):
         self.assertTrue(os.path.exists(expected_directory))
         self.assertEqual(sum([1 for path in os.scandir(expected_directory) if path.is_file()]), 2)
 
-        post_delete.send(sender=Airframe, instance=airframe2)
+        with self.committed():
+            post_delete.send(sender=Airframe, instance=airframe2)
+        self.run_jobs()
 
         self.assertTrue(os.path.exists(expected_directory))
         self.assertEqual(sum([1 for path in os.scandir(expected_directory) if path.is_file()]), 1)
@@ -181,9 +203,12 @@ class PostDeleteImageSignalHandlerTest(SettingsMixin):
 
         expected_directory_after_delete = self.get_common_directory(expected_directory, os.path.join(self.media_root))
 
-        _, folder_path = post_delete.send(sender=Airframe, instance=airframe2)[0]
+        with self.committed():
+            post_delete.send(sender=Airframe, instance=airframe2)
+        self.run_jobs()
 
-        self.assertEqual(expected_directory_after_delete, folder_path)
+        self.assertFalse(os.path.exists(expected_directory))
+        self.assertTrue(os.path.exists(expected_directory_after_delete))
 
     def test_delete_not_alone_meal(self):
         meal2 = Meal.objects.create(
@@ -205,7 +230,9 @@ class PostDeleteImageSignalHandlerTest(SettingsMixin):
         self.assertTrue(os.path.exists(expected_directory))
         self.assertEqual(sum([1 for path in os.scandir(expected_directory) if path.is_file()]), 2)
 
-        post_delete.send(sender=Meal, instance=meal2)
+        with self.committed():
+            post_delete.send(sender=Meal, instance=meal2)
+        self.run_jobs()
 
         self.assertTrue(os.path.exists(expected_directory))
         self.assertEqual(sum([1 for path in os.scandir(expected_directory) if path.is_file()]), 1)
@@ -245,9 +272,12 @@ class PostDeleteImageSignalHandlerTest(SettingsMixin):
 
         expected_directory_after_delete = self.get_common_directory(expected_directory, os.path.join(self.media_root))
 
-        _, folder_path = post_delete.send(sender=Meal, instance=meal2)[0]
+        with self.committed():
+            post_delete.send(sender=Meal, instance=meal2)
+        self.run_jobs()
 
-        self.assertEqual(expected_directory_after_delete, folder_path.lower())
+        self.assertFalse(os.path.exists(expected_directory))
+        self.assertTrue(os.path.exists(expected_directory_after_delete))
 
     def test_delete_not_alone_track_image(self):
         track_image2 = TrackImage.objects.create(
@@ -265,7 +295,9 @@ class PostDeleteImageSignalHandlerTest(SettingsMixin):
         self.assertTrue(os.path.exists(expected_directory))
         self.assertEqual(sum([1 for path in os.scandir(expected_directory) if path.is_file()]), 2)
 
-        post_delete.send(sender=TrackImage, instance=track_image2)
+        with self.committed():
+            post_delete.send(sender=TrackImage, instance=track_image2)
+        self.run_jobs()
 
         self.assertTrue(os.path.exists(expected_directory))
         self.assertEqual(sum([1 for path in os.scandir(expected_directory) if path.is_file()]), 1)
@@ -294,6 +326,168 @@ class PostDeleteImageSignalHandlerTest(SettingsMixin):
 
         expected_directory_after_delete = self.get_common_directory(expected_directory, os.path.join(self.media_root))
 
-        _, folder_path = post_delete.send(sender=TrackImage, instance=track_image2)[0]
+        with self.committed():
+            post_delete.send(sender=TrackImage, instance=track_image2)
+        self.run_jobs()
 
-        self.assertEqual(expected_directory_after_delete, folder_path.lower())
+        self.assertFalse(os.path.exists(expected_directory))
+        self.assertTrue(os.path.exists(expected_directory_after_delete))
+
+
+class RenditionsSignalHandlerTest(TemproaryMediaRootMixin, JobQueueMixin):
+
+    def assertRenditionsExist(self, renditions, exist=True):
+        paths = get_rendition_paths(renditions)
+        self.assertTrue(paths)
+        for path in paths:
+            self.assertEqual(default_storage.exists(path), exist)
+
+    def create(self, factory):
+        with self.committed():
+            instance = factory()
+        self.run_jobs()
+        return instance
+
+    def test_rendered_by_worker(self):
+        with self.committed():
+            trip = UserTripFactory()
+        airframe = trip.flight.airframe
+
+        # В запросе копии не создаются, только ставится задача
+        self.assertEqual(Airframe.objects.get(pk=airframe.pk).renditions, {})
+        self.assertTrue(Job.objects.filter(kind='render_renditions').exists())
+
+        self.run_jobs()
+        airframe.refresh_from_db()
+        trip.card.refresh_from_db()
+
+        self.assertEqual(airframe.renditions['source'], airframe.photo.name)
+        self.assertEqual(set(airframe.renditions), {'source', 'detail', 'card', 'thumb'})
+        self.assertRenditionsExist(airframe.renditions)
+        self.assertEqual(trip.card.photo_renditions, airframe.renditions)
+        self.assertFalse(Job.objects.exists())
+
+    def test_kept_when_photo_unchanged(self):
+        meal = self.create(MealFactory)
+        meal.refresh_from_db()
+        renditions = meal.renditions
+
+        # Формы сохраняют экземпляр, собранный заново без реестра копий
+        with self.committed():
+            Meal(pk=meal.pk, trip=meal.trip, meal_photo=meal.meal_photo.name).save()
+
+        self.assertFalse(Job.objects.exists())
+        self.assertEqual(Meal.objects.get(pk=meal.pk).renditions, renditions)
+        self.assertRenditionsExist(renditions)
+
+    def test_replaced_with_photo(self):
+        meal = self.create(MealFactory)
+        meal.refresh_from_db()
+        old_renditions = meal.renditions
+
+        buffer = BytesIO()
+        Image.new('RGB', (600, 400)).save(buffer, 'jpeg')
+        meal.meal_photo = SimpleUploadedFile('replaced.jpg', buffer.getvalue())
+        with self.committed():
+            meal.save()
+        self.run_jobs()
+        meal.refresh_from_db()
+
+        self.assertRenditionsExist(old_renditions, exist=False)
+        self.assertEqual(meal.renditions['source'], meal.meal_photo.name)
+        self.assertRenditionsExist(meal.renditions)
+        self.assertEqual(meal.renditions['card']['width'], 480)
+
+    def test_deleted_with_image(self):
+        meal = self.create(MealFactory)
+        meal.refresh_from_db()
+        renditions = meal.renditions
+
+        with self.committed():
+            meal.delete()
+        self.assertRenditionsExist(renditions)
+
+        self.run_jobs()
+        self.assertRenditionsExist(renditions, exist=False)
+
+    def test_not_deleted_on_rollback(self):
+        meal = self.create(MealFactory)
+
+        with self.assertRaises(ValueError), transaction.atomic():
+            meal.delete()
+            raise ValueError()
+
+        self.run_jobs()
+        self.assertTrue(os.path.exists(meal.meal_photo.path))
+
+    def test_invalid_image(self):
+        airframe = self.create(lambda: Airframe.objects.create(serial_number='SN1', registration_number='RA-1',
+                                                               airline=Airline.objects.create(name='Broken'),
+                                                               photo=SimpleUploadedFile('broken.jpg', b'not an image')))
+        airframe.refresh_from_db()
+
+        self.assertEqual(airframe.renditions, {})
+        self.assertFalse(Job.objects.exists())
+
+
+class JobWorkerTest(TemproaryMediaRootMixin, JobQueueMixin):
+
+    def test_retry_with_backoff(self):
+        calls = []
+
+        @task('test_flaky')
+        def flaky():
+            calls.append(1)
+            if len(calls) < 2:
+                raise OSError('disk busy')
+
+        self.addCleanup(TASKS.pop, 'test_flaky')
+
+        with self.committed():
+            enqueue('test_flaky')
+        with self.assertLogs('flights.jobs', 'WARNING'):
+            self.run_jobs()
+
+        job = Job.objects.get()
+        self.assertEqual((job.status, job.attempts), (Job.QUEUED, 1))
+        self.assertIn('disk busy', job.last_error)
+        self.assertGreater(job.run_after, timezone.now())
+
+        Job.objects.update(run_after=timezone.now())
+        self.run_jobs()
+        self.assertFalse(Job.objects.exists())
+        self.assertEqual(len(calls), 2)
+
+    def test_failed_after_max_attempts(self):
+        @task('test_broken')
+        def broken():
+            raise OSError('broken')
+
+        self.addCleanup(TASKS.pop, 'test_broken')
+
+        Job.objects.create(kind='test_broken', max_attempts=2)
+        with self.assertLogs('flights.jobs', 'WARNING'):
+            self.run_jobs()
+        Job.objects.update(run_after=timezone.now())
+        with self.assertLogs('flights.jobs', 'ERROR'):
+            self.run_jobs()
+
+        self.assertEqual(Job.objects.get().status, Job.FAILED)
+
+    def test_unknown_job(self):
+        Job.objects.create(kind='missing')
+        with self.assertLogs('flights.jobs', 'ERROR'):
+            self.run_jobs()
+
+        self.assertEqual(Job.objects.get().status, Job.FAILED)
+        with self.assertRaises(KeyError):
+            enqueue('missing')
+
+    def test_command(self):
+        Job.objects.create(kind='prune_directories', payload={'directories': ['a/b']})
+        os.makedirs(os.path.join(self.media_root, 'a', 'b'))
+
+        call_command('run_worker', once=True, stdout=StringIO())
+
+        self.assertFalse(os.path.exists(os.path.join(self.media_root, 'a')))
+        self.assertFalse(Job.objects.exists())
@@ -1,3 +1,5 @@
+import csv
+import io
 import os
 
 os.environ.setdefault("DJANGO_SETTINGS_MODULE", "aviablog.settings")
@@ -6,20 +8,29 @@ import django
 django.setup()
 
 from test_mixins import UploadDataMixin
+from flights.cache import HomePageCache
 from django.contrib.auth import get_user_model
+from django.core.management import call_command
 from django.urls import reverse
 from flights.services import PassengerProfileService, FlightDetailService
-from django.test import TestCase
+from django.db import connection
+from django.core.files.uploadedfile import SimpleUploadedFile
+from django.core.cache.backends.filebased import FileBasedCache
+from django.test import TestCase, override_settings
+from django.test.utils import CaptureQueriesContext
 from unittest.mock import patch
 from flights.factories import UserTripFactory, FlightInfoFactory, MealFactory, TrackImageFactory
 
-from test_mixins.test_data_upload import PostMethodMixin, TemproaryMediaRootMixin
+from test_mixins.test_data_upload import PostMethodMixin, TemproaryMediaRootMixin, get_image_buffer
+from test_mixins.query_budget import QueryBudgetMixin
 from users.factories import UserFactory
 
-from flights.models import UserTrip, TrackImage
-from django.forms import modelformset_factory
+from flights.models import Airframe, UserTrip, TrackImage, Meal
+from flights.tasks import render_image_renditions
 
-from flights.forms import AddFlightForm, TrackImageForm
+from flights.forms import AddFlightForm
+from flights import urls, views
+from flights.query_budget import QueryBudget, QueryBudgetExceeded, QueryRecorder
 
 UserClass = get_user_model()
 
@@ -48,6 +59,49 @@ class HomeViewTest(TemproaryMediaRootMixin):
         self.assertIsNotNone(site_information)
 
 
+class HomePageCacheTest(TemproaryMediaRootMixin, UploadDataMixin):
+
+    def test_second_request_served_from_cache(self):
+        self.client.get(reverse('home'))
+
+        with self.assertNumQueries(0):
+            response = self.client.get(reverse('home'))
+
+        self.assertEqual(len(response.context['latest_cards']), 6)
+
+        stats = HomePageCache.get_stats()
+        self.assertEqual(stats['misses'], 3)
+        self.assertEqual(stats['hits'], 3)
+
+    def test_worker_invalidates_web_cache(self):
+        # web и worker - разные процессы с разными объектами кэша, но общим каталогом CACHE_LOCATION
+        location = os.path.join(self.media_root, 'cache')
+        with override_settings(CACHES={'default': {'BACKEND': 'django.core.cache.backends.filebased.FileBasedCache',
+                                                   'LOCATION': location}}):
+            self.client.get(reverse('home'))
+            airframe = Airframe.objects.exclude(photo='').first()
+
+            with patch('flights.cache.cache', FileBasedCache(location, {})):
+                with self.captureOnCommitCallbacks(execute=True):
+                    render_image_renditions('flights.airframe', airframe.pk, airframe.photo.name)
+
+            with CaptureQueriesContext(connection) as context:
+                self.client.get(reverse('home'))
+
+        self.assertGreater(len(context), 0)
+
+    def test_cache_invalidated_after_commit(self):
+        response = self.client.get(reverse('home'))
+        latest_slug = response.context['latest_cards'][0]['usertripslug']
+
+        with self.captureOnCommitCallbacks(execute=True):
+            UserTrip.objects.get(slug=latest_slug).delete()
+
+        response = self.client.get(reverse('home'))
+        slugs = [card['usertripslug'] for card in response.context['latest_cards']]
+        self.assertNotIn(latest_slug, slugs)
+
+
 class PassengersViewTest(TemproaryMediaRootMixin):
     def test_passengers_displayed(self):
         response = self.client.get(reverse('passengers'))
@@ -57,6 +111,52 @@ class PassengersViewTest(TemproaryMediaRootMixin):
         self.assertIsNotNone(passengers)
 
 
+class KeysetPaginationViewTest(TemproaryMediaRootMixin, UploadDataMixin):
+
+    def collect_pages(self, url, key):
+        items, cursor = [], None
+        while True:
+            response = self.client.get(url, data={'format': 'json', **({'cursor': cursor} if cursor else {})})
+            self.assertEqual(response.status_code, 200)
+            payload = response.json()
+            items.extend(item[key] for item in payload['results'])
+            cursor = payload['next_cursor']
+            if cursor is None:
+                return items
+
+    @patch('flights.views.PassengersView.paginate_by', 3)
+    def test_passengers_pages(self):
+        usernames = self.collect_pages(reverse('passengers'), 'username')
+
+        self.assertEqual(usernames, sorted(UserClass.objects.values_list('username', flat=True)))
+
+    @patch('flights.views.PassengersView.paginate_by', 3)
+    def test_passengers_cursor_stable_after_insert(self):
+        first_page = self.client.get(reverse('passengers'), data={'format': 'json'}).json()
+        UserFactory(username='a_new_user')
+
+        second_page = self.client.get(reverse('passengers'),
+                                      data={'format': 'json', 'cursor': first_page['next_cursor']}).json()
+
+        self.assertGreater(second_page['results'][0]['username'], first_page['results'][-1]['username'])
+
+    @patch('flights.views.ProfileView.paginate_by', 2)
+    def test_profile_flight_pages(self):
+        passenger = UserTrip.objects.first().passenger
+        for _ in range(4):
+            UserTripFactory(passenger=passenger)
+
+        slugs = self.collect_pages(reverse('profile', kwargs={'username': passenger.username}), 'slug')
+
+        expected = UserTrip.objects.filter(passenger=passenger).order_by('-flight__date', 'id')
+        self.assertEqual(slugs, list(expected.values_list('slug', flat=True)))
+
+    def test_invalid_cursor(self):
+        response = self.client.get(reverse('passengers'), data={'cursor': 'not-a-cursor'})
+
+        self.assertEqual(response.status_code, 400)
+
+
 class ProfileViewTest(TemproaryMediaRootMixin, UploadDataMixin):
 
     def test_flights_displayed(self):
@@ -95,6 +195,14 @@ class FlightViewTest(TemproaryMediaRootMixin, UploadDataMixin):
         flight = response.context['flight']
         self.assertIsNotNone(flight)
 
+    def test_photos_served_as_renditions(self):
+        call_command('backfill_renditions', workers=1, stdout=io.StringIO())
+        usertrip = UserTrip.objects.first()
+        response = self.client.get(reverse('flight', kwargs={'usertripslug': usertrip.slug}))
+
+        self.assertContains(response, '<source type="image/webp"', count=3)
+        self.assertContains(response, usertrip.flight.airframe.renditions['card']['blobs']['jpeg'])
+
 
 class AddFlightViewTest(TemproaryMediaRootMixin, PostMethodMixin):
 
@@ -124,6 +232,8 @@ class AddFlightViewTest(TemproaryMediaRootMixin, PostMethodMixin):
         self.assertEqual(response.status_code, 302)
         self.assertIsNotNone(usertrip)
         self.assertEqual('/', response.url)
+        # Все файлы одного поля track_images
+        self.assertEqual(TrackImage.objects.filter(trip__passenger=test_user).count(), 2)
 
     def test_not_valid_data_logined_user(self):
         payload = {
@@ -140,6 +250,297 @@ class AddFlightViewTest(TemproaryMediaRootMixin, PostMethodMixin):
         self.assertEqual(response.status_code, 200)
         self.assertQuerySetEqual(usertrip, [])
 
+    def test_other_airframe_logined_user(self):
+        self.client.force_login(UserFactory())
+        self.client.post(reverse('add_flight'), data={**self.data, **self.files})
+
+        test_user = UserFactory()
+        self.client.force_login(test_user)
+        response = self.client.post(reverse('add_flight'), data={
+            **self.data,
+            'airframe_photo': SimpleUploadedFile('airframe.jpg', get_image_buffer().read()),
+            'meal_photo': SimpleUploadedFile('meal.jpg', get_image_buffer().read()),
+            'track_images': [SimpleUploadedFile('track.jpg', get_image_buffer().read())],
+            'serial_number': 'XYZ',
+            'registration_number': 'RA-00000',
+        })
+
+        # Рейс уже выполнял другой борт: форма возвращается с ошибкой, путешествие не сохраняется
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.context['form'].errors.as_data()['registration_number'][0].code,
+                         'airframe_conflict')
+        self.assertFalse(UserTrip.objects.filter(passenger=test_user).exists())
+        self.assertEqual(Airframe.objects.count(), 1)
+
+
+class TrackImagesViewTest(QueryBudgetMixin, TemproaryMediaRootMixin):
+
+    def setUp(self) -> None:
+        super().setUp()
+        self.usertrip = UserTripFactory()
+        FlightInfoFactory(flight=self.usertrip.flight, status='Departure')
+        FlightInfoFactory(flight=self.usertrip.flight, status='Arrival')
+        self.track_image = TrackImageFactory(trip=self.usertrip)
+
+        self.url = reverse('flight_tracks', kwargs={'usertripslug': self.usertrip.slug})
+        self.client.force_login(self.usertrip.passenger)
+
+    def get_files(self, count):
+        return [SimpleUploadedFile(f'track{i}.png', get_image_buffer().read()) for i in range(count)]
+
+    def test_upload_many(self):
+        response = self.client.post(self.url, data={'track_images': self.get_files(12)})
+
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(len(response.json()['created']), 12)
+        self.assertEqual(self.usertrip.trackimage_set.count(), 13)
+        self.assertWithinQueryBudget(response)
+
+    def test_upload_and_delete(self):
+        response = self.client.post(self.url, data={'track_images': self.get_files(2),
+                                                    'delete_track_images': [self.track_image.pk]})
+
+        self.assertEqual(response.json()['deleted'], 1)
+        self.assertEqual(set(self.usertrip.trackimage_set.values_list('pk', flat=True)),
+                         set(response.json()['created']))
+
+    def test_foreign_image_not_deleted(self):
+        other_image = TrackImageFactory()
+
+        response = self.client.post(self.url, data={'delete_track_images': [other_image.pk]})
+
+        self.assertEqual(response.status_code, 400)
+        self.assertIn('delete_track_images', response.json()['errors'])
+        self.assertTrue(TrackImage.objects.filter(pk=other_image.pk).exists())
+
+    def test_not_image(self):
+        response = self.client.post(self.url, data={'track_images': [SimpleUploadedFile('track.png', b'text')]})
+
+        self.assertEqual(response.status_code, 400)
+        self.assertEqual(self.usertrip.trackimage_set.count(), 1)
+
+    def test_not_owner(self):
+        self.client.force_login(UserFactory())
+
+        response = self.client.post(self.url, data={'delete_track_images': [self.track_image.pk]})
+
+        self.assertEqual(response.status_code, 404)
+        self.assertTrue(TrackImage.objects.filter(pk=self.track_image.pk).exists())
+
+
+class FlightDetailMemoizationTest(TemproaryMediaRootMixin, TestCase):
+
+    def setUp(self) -> None:
+        super().setUp()
+        self.usertrip = UserTripFactory()
+        FlightInfoFactory(flight=self.usertrip.flight, status='Departure')
+        FlightInfoFactory(flight=self.usertrip.flight, status='Arrival')
+        MealFactory(trip=self.usertrip)
+        TrackImageFactory(trip=self.usertrip)
+
+        self.client.force_login(self.usertrip.passenger)
+
+    def count_detail_loads(self, method, url_name, num_queries, data=None):
+        '''Проверяет общее число запросов представления и возвращает, сколько раз читались данные путешествия'''
+
+        url = reverse(url_name, kwargs={'usertripslug': self.usertrip.slug})
+
+        with self.assertNumQueries(num_queries) as context:
+            getattr(self.client, method)(url, data=data)
+
+        return sum(1 for query in context.captured_queries
+                   if '"flights_usertrip"."slug" =' in query['sql'])
+
+    def test_flight_view(self):
+        self.assertEqual(self.count_detail_loads('get', 'flight', 4), 1)
+
+    def test_update_view_get(self):
+        self.assertEqual(self.count_detail_loads('get', 'flight_update', 4), 1)
+
+    def test_update_view_post(self):
+        # Форма не проходит проверку и выводится снова
+        self.assertEqual(self.count_detail_loads('post', 'flight_update', 5, data={}), 1)
+
+    def test_delete_view_post(self):
+        self.assertEqual(self.count_detail_loads('post', 'flight_delete', 33), 1)
+        self.assertFalse(UserTrip.objects.filter(pk=self.usertrip.pk).exists())
+
+
+class QueryBudgetTest(QueryBudgetMixin, TemproaryMediaRootMixin, UploadDataMixin, PostMethodMixin):
+
+    def setUp(self) -> None:
+        super().setUp()
+        self.usertrip = UserTrip.objects.select_related('passenger').first()
+        self.client.force_login(self.usertrip.passenger)
+
+    def test_every_view_declares_budget(self):
+        for pattern in urls.urlpatterns:
+            with self.subTest(pattern.name):
+                self.assertIsNotNone(getattr(pattern.callback.view_class, 'query_budget', None))
+
+    def test_read_views_within_budget(self):
+        trip_kwargs = {'usertripslug': self.usertrip.slug}
+        urls_to_check = [
+            reverse('home'),
+            reverse('passengers'),
+            reverse('profile', kwargs={'username': self.usertrip.passenger.username}),
+            reverse('flight', kwargs=trip_kwargs),
+            reverse('flight_update', kwargs=trip_kwargs),
+            reverse('add_flight'),
+            reverse('import_flights'),
+        ]
+
+        for url in urls_to_check:
+            with self.subTest(url):
+                response = self.client.get(url)
+                self.assertEqual(response.status_code, 200)
+                self.assertWithinQueryBudget(response)
+
+    def test_add_flight_within_budget(self):
+        response = self.client.post(reverse('add_flight'), data={**self.data, **self.files})
+
+        self.assertEqual(response.status_code, 302)
+        self.assertWithinQueryBudget(response)
+
+    def test_update_within_budget(self):
+        data, _, _ = FlightDetailService.get_flight_details(self.usertrip.slug)
+        skip = ('user', 'track_images', 'departure_info', 'arrival_info')
+        payload = {name: value for name, value in data.items() if name not in skip and value is not None}
+
+        response = self.client.post(reverse('flight_update', kwargs={'usertripslug': self.usertrip.slug}),
+                                    data={**payload, 'seat': 'Z9'})
+
+        self.assertEqual(response.status_code, 302)
+        self.assertWithinQueryBudget(response)
+
+    def test_delete_within_budget(self):
+        response = self.client.post(reverse('flight_delete', kwargs={'usertripslug': self.usertrip.slug}))
+
+        self.assertEqual(response.status_code, 302)
+        self.assertWithinQueryBudget(response)
+
+    def test_exceeded_budget_fails(self):
+        with patch.object(views.PassengersView, 'query_budget', QueryBudget(queries=1)):
+            with self.assertRaises(QueryBudgetExceeded), self.assertLogs('flights.query_budget', 'WARNING'):
+                self.client.get(reverse('passengers'))
+
+    def test_duplicate_select_detected(self):
+        with QueryRecorder() as report:
+            for trip in UserTrip.objects.all()[:2]:
+                trip.passenger.username
+
+        self.assertEqual(list(report.get_duplicates().values()), [2])
+        self.assertEqual(len(report.get_violations(QueryBudget(queries=10))), 1)
+
+    def test_not_sampled(self):
+        with self.settings(QUERY_BUDGET_SAMPLE_RATE=0):
+            response = self.client.get(reverse('passengers'))
+
+        self.assertFalse(hasattr(response.wsgi_request, 'query_report'))
+
+
+class ImportFlightsViewTest(QueryBudgetMixin, TemproaryMediaRootMixin):
+
+    CSV = ('flight_number,date,airline_name,manufacturer,generic_type,serial_number,registration_number,'
+           'departure_airport_code,departure_runway,arrival_airport_code,arrival_runway\n'
+           'SU100,2023-05-01,Aeroflot,Airbus,A320,SN1,RA-1,SVO,06,LED,10\n'
+           'SU101,2023-05-02,,Airbus,A320,SN1,RA-1,SVO,06,LED,10\n')
+
+    def setUp(self) -> None:
+        super().setUp()
+        self.user = UserFactory()
+        self.client.force_login(self.user)
+
+    def upload(self, name='log.csv', url=None):
+        return self.client.post(url or reverse('import_flights'),
+                                data={'file': SimpleUploadedFile(name, self.CSV.encode())})
+
+    def test_anonymous(self):
+        self.client.logout()
+
+        response = self.upload()
+
+        self.assertEqual(response.status_code, 302)
+        self.assertFalse(UserTrip.objects.exists())
+
+    def test_upload_csv(self):
+        response = self.upload()
+
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.context['stats']['imported'], 1)
+        self.assertEqual([line for line, _ in response.context['import_errors']], [3])
+        self.assertTrue(UserTrip.objects.filter(passenger=self.user, flight__flight_number='SU100').exists())
+        self.assertWithinQueryBudget(response)
+
+    def test_upload_json_response(self):
+        response = self.upload(url=reverse('import_flights') + '?format=json')
+
+        self.assertEqual(response.json()['imported'], 1)
+        self.assertEqual(response.json()['errors_list'][0]['line'], 3)
+
+    def test_not_utf8(self):
+        response = self.client.post(reverse('import_flights'), data={
+            'file': SimpleUploadedFile('log.csv', self.CSV.replace('Aeroflot', 'Аэрофлот').encode('cp1251')),
+        })
+
+        self.assertEqual(response.status_code, 200)
+        self.assertIn('file', response.context['form'].errors)
+        self.assertFalse(UserTrip.objects.exists())
+
+    def test_unsupported_format(self):
+        response = self.upload(name='log.txt')
+
+        self.assertEqual(response.status_code, 200)
+        self.assertTrue(response.context['form'].errors)
+        self.assertFalse(UserTrip.objects.exists())
+
+
+class FlightLogExportViewTest(TemproaryMediaRootMixin, UploadDataMixin):
+
+    def setUp(self) -> None:
+        super().setUp()
+        self.usertrip = UserTrip.objects.select_related('passenger').first()
+        self.username = self.usertrip.passenger.username
+
+    def export(self, format='csv'):
+        return self.client.get(reverse('profile_export', kwargs={'username': self.username, 'format': format}))
+
+    def test_owner(self):
+        self.client.force_login(self.usertrip.passenger)
+
+        response = self.export()
+        rows = list(csv.DictReader(io.StringIO(b''.join(response.streaming_content).decode())))
+
+        self.assertEqual(response['Content-Type'], 'text/csv; charset=utf-8')
+        self.assertEqual(len(rows), 1)
+        self.assertEqual(rows[0]['flight_number'], self.usertrip.flight.flight_number)
+
+    def test_not_owner(self):
+        self.client.force_login(UserFactory())
+
+        self.assertEqual(self.export().status_code, 404)
+
+    def test_unknown_format(self):
+        self.client.force_login(self.usertrip.passenger)
+
+        self.assertEqual(self.export('xml').status_code, 404)
+
+    def test_admin_export(self):
+        self.client.force_login(UserClass.objects.create_superuser('admin', 'admin@mail.ru', 'password'))
+
+        response = self.client.get(reverse('admin:flights_usertrip_export', kwargs={'format': 'jsonl'}))
+        lines = b''.join(response.streaming_content).decode().splitlines()
+
+        self.assertEqual(len(lines), UserTrip.objects.count())
+        self.assertContains(self.client.get(reverse('admin:flights_usertrip_changelist')), 'Export GEOJSON')
+
+    def test_admin_export_requires_staff(self):
+        self.client.force_login(self.usertrip.passenger)
+
+        response = self.client.get(reverse('admin:flights_usertrip_export', kwargs={'format': 'csv'}))
+
+        self.assertEqual(response.status_code, 302)
+
 
 class FlightUpdateViewTest(TemproaryMediaRootMixin, TestCase):
 
@@ -267,3 +668,42 @@ class FlightUpdateViewTest(TemproaryMediaRootMixin, TestCase):
     #
     #     # Проверяем, что сообщение об ошибке отображается на странице
     #     self.assertContains(response, "This field is required.")
+
+
+class AddFlightFormUpdateTest(TemproaryMediaRootMixin, TestCase):
+
+    def setUp(self) -> None:
+        super().setUp()
+        self.usertrip = UserTripFactory()
+        FlightInfoFactory(flight=self.usertrip.flight, status='Departure')
+        FlightInfoFactory(flight=self.usertrip.flight, status='Arrival')
+        MealFactory(trip=self.usertrip)
+
+    def save(self, **changes):
+        data, files, id_dict = FlightDetailService.get_flight_details(self.usertrip.slug)
+        form = AddFlightForm(data={**data, **changes}, files=files)
+        self.assertTrue(form.is_valid(), form.errors)
+
+        with CaptureQueriesContext(connection) as context:
+            form.save(user=self.usertrip.passenger, **id_dict)
+        updates = [query['sql'] for query in context.captured_queries if query['sql'].startswith('UPDATE "flights_')]
+        return form, updates
+
+    def test_unchanged_data_not_written(self):
+        form, updates = self.save()
+
+        self.assertEqual(updates, [])
+        self.assertTrue(all(fields == [] for fields in form.changed_fields.values()))
+
+    def test_only_changed_columns_written(self):
+        meal_photo = self.usertrip.meal_set.get().meal_photo.name
+        form, updates = self.save(drinks='Сок')
+
+        self.assertEqual(form.changed_fields['flights.Meal'], ['drinks'])
+        meal_updates = [sql for sql in updates if sql.startswith('UPDATE "flights_meal"')]
+        self.assertEqual(len(meal_updates), 1)
+        self.assertIn('SET "drinks" =', meal_updates[0])
+        self.assertNotIn('meal_photo', meal_updates[0])
+
+        meal = Meal.objects.get(trip=self.usertrip)
+        self.assertEqual((meal.drinks, meal.meal_photo.name), ('Сок', meal_photo))
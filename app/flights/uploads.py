@@ -0,0 +1,184 @@
+import logging
+import os
+import tempfile
+import time
+from contextlib import contextmanager
+
+from django.conf import settings
+from django.core.files import File
+from django.core.files.storage import default_storage
+from django.db import DatabaseError, connection, transaction
+
+from .cache import HomePageCache
+from .jobs import enqueue
+from .models import Airframe, UserTrip
+from .services import TripCardService
+
+logger = logging.getLogger('flights.uploads')
+
+# Каталог подготовленных загрузок внутри MEDIA_ROOT: тот же раздел диска, поэтому публикация - это rename.
+# nginx его не отдает, а файлы, оставшиеся после сбоев, удаляет gc_media
+STAGING_DIR = 'staging'
+
+
+class StagedFile(File):
+    '''Подготовленный файл. temporary_file_path позволяет хранилищу перенести его, а не копировать'''
+
+    def temporary_file_path(self):
+        return self.file.name
+
+
+class StagedUpload:
+    '''Загруженный файл, записанный в STAGING_DIR до начала транзакции.
+    name - имя, под которым файл появится в хранилище; его и записывают в поле модели.
+    bind() связывает загрузку с экземпляром, который сохраняется с этим именем'''
+
+    def __init__(self, name, path, size, field_name):
+        self.name = name
+        self.path = path
+        self.size = size
+        self.field_name = field_name
+        self.instance = None
+
+    def __str__(self):
+        return self.name
+
+    def bind(self, instance):
+        self.instance = instance
+        return self.name
+
+
+class UploadStager:
+    '''Двухфазная загрузка файлов: диск - вне транзакции, в транзакции - только имена.
+    1. stage() потоково пишет загрузку в STAGING_DIR и выбирает свободное имя в хранилище;
+    2. в atomic() сохраняются строки с этими именами, блокировки не держатся на время записи на диск;
+    3. после коммита publish() переносит файлы в хранилище, при откате discard() их удаляет.
+    Время от начала до конца транзакции пишется в лог как lock_hold_ms.
+
+        with UploadStager() as stager:
+            upload = stager.stage(file, Meal(trip=trip), 'meal_photo')
+            with stager.atomic():
+                meal = Meal(trip=trip, meal_photo=upload.name)
+                upload.bind(meal)
+                meal.save()
+    '''
+
+    def __init__(self, storage=None):
+        self.storage = storage or default_storage
+        self.uploads = []
+        self.staged_sizes = []
+        self.started = None
+        self.lock_hold_ms = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        # Внутри внешней транзакции файлы опубликует on_commit; при ее откате их удалит gc_media
+        if exc_type is not None or not connection.in_atomic_block:
+            self.discard()
+
+    def stage(self, file, instance, field_name):
+        '''Записывает загрузку file поля field_name в STAGING_DIR. instance нужен только для upload_to'''
+
+        return self.stage_many([file], instance, field_name)[0]
+
+    def stage_many(self, files, instance, field_name):
+        '''stage() для нескольких файлов одного поля: свободные имена выбираются одной проверкой хранилища'''
+
+        field = instance._meta.get_field(field_name)
+        names = self.get_available_names([field.generate_filename(instance, file.name) for file in files],
+                                         max_length=field.max_length)
+
+        directory = os.path.join(settings.MEDIA_ROOT, STAGING_DIR)
+        os.makedirs(directory, exist_ok=True)
+
+        uploads = []
+        for file, name in zip(files, names):
+            fd, path = tempfile.mkstemp(dir=directory, suffix=os.path.splitext(name)[1])
+
+            size = 0
+            with os.fdopen(fd, 'wb') as staged:
+                if hasattr(file, 'seek'):
+                    file.seek(0)
+                for chunk in file.chunks():
+                    staged.write(chunk)
+                    size += len(chunk)
+
+            upload = StagedUpload(name, path, size, field_name)
+            self.uploads.append(upload)
+            self.staged_sizes.append(size)
+            uploads.append(upload)
+        return uploads
+
+    def get_available_names(self, names, max_length=None):
+        if hasattr(self.storage, 'get_available_names'):
+            return self.storage.get_available_names(names, max_length=max_length)
+        return [self.storage.get_available_name(name, max_length=max_length) for name in names]
+
+    @contextmanager
+    def atomic(self):
+        '''Транзакция, после коммита которой подготовленные файлы публикуются'''
+
+        self.started = time.perf_counter()
+        with transaction.atomic():
+            # Первым обработчиком on_commit: задачи создания копий увидят уже опубликованные файлы
+            transaction.on_commit(self.publish)
+            yield self
+        if self.lock_hold_ms is None:
+            # Внутри внешней транзакции коммита еще не было: это время только нашего блока
+            self.lock_hold_ms = (time.perf_counter() - self.started) * 1000
+
+        logger.info('Transaction held %.1f ms, %s files staged', self.lock_hold_ms, len(self.staged_sizes),
+                    extra={'upload_metrics': {'lock_hold_ms': round(self.lock_hold_ms, 2),
+                                              'files': len(self.staged_sizes),
+                                              'bytes': sum(self.staged_sizes)}})
+
+    def publish(self):
+        # Вызывается сразу после коммита, до переноса файлов
+        self.lock_hold_ms = (time.perf_counter() - self.started) * 1000
+
+        for upload in self.uploads:
+            instance = upload.instance
+            if instance is None or instance.pk is None:
+                # Файл не понадобился, например фото уже существующего борта
+                continue
+
+            try:
+                with open(upload.path, 'rb') as file:
+                    saved_name = self.storage.save(upload.name, StagedFile(file, upload.name))
+            except (OSError, DatabaseError):
+                # Строки уже закоммичены: запрос не должен падать из-за одного файла
+                logger.exception('Cannot publish %s', upload.name)
+                continue
+
+            if saved_name != upload.name:
+                self.rename(instance, upload.field_name, saved_name)
+
+        self.discard()
+
+    @staticmethod
+    def rename(instance, field_name, saved_name):
+        '''Пока шла транзакция, имя занял другой запрос: переименовываем ссылку в строке.
+        save() здесь не подходит: pre_save удалил бы файл под прежним именем, а он теперь чужой.
+        Поэтому update(), а то, что обычно делают сигналы post_save, выполняем явно'''
+
+        model = type(instance)
+        model.objects.filter(pk=instance.pk).update(**{field_name: saved_name, 'renditions': {}})
+        setattr(instance, field_name, saved_name)
+        instance.renditions = {}
+        instance.take_snapshot([field_name, 'renditions'])
+
+        if isinstance(instance, Airframe):
+            # Карточки поездок хранят имя фото борта
+            TripCardService.refresh(UserTrip.objects.filter(flight__airframe=instance))
+        transaction.on_commit(HomePageCache.bump_generation)
+        enqueue('render_renditions', model=model._meta.label_lower, pk=instance.pk, name=saved_name)
+
+    def discard(self):
+        for upload in self.uploads:
+            try:
+                os.remove(upload.path)
+            except FileNotFoundError:
+                pass
+        self.uploads = []
@@ -0,0 +1,210 @@
+from django.core.exceptions import EmptyResultSet
+from django.db import DEFAULT_DB_ALIAS, IntegrityError, connections
+from django.db.models import FileField, Q
+
+# Сколько раз повторять вставку, если конфликтующую строку удалили раньше, чем мы ее прочитали
+MAX_ATTEMPTS = 3
+
+
+def supports_insert_returning(connection):
+    '''INSERT ... ON CONFLICT DO NOTHING RETURNING есть в PostgreSQL и в SQLite начиная с 3.35'''
+
+    return connection.vendor in ('postgresql', 'sqlite') and connection.features.can_return_columns_from_insert
+
+
+def get_insert_fields(model):
+    return [field for field in model._meta.concrete_fields if not field.primary_key]
+
+
+def get_insert_params(instance, fields, connection):
+    params = []
+    for field in fields:
+        value = getattr(instance, field.attname) if isinstance(field, FileField) else field.pre_save(instance, True)
+        params.append(field.get_db_prep_save(value, connection))
+    return params
+
+
+def build_insert_sql(model, fields, key, connection, rows=1, returning=()):
+    quote_name = connection.ops.quote_name
+    placeholders = '({})'.format(', '.join(['%s'] * len(fields)))
+    # Цель конфликта - колонки ключа: нарушение другого ограничения уникальности - это ошибка, а не "строка есть"
+    return 'INSERT INTO {table} ({columns}) VALUES {values} ON CONFLICT ({target}) DO NOTHING ' \
+           'RETURNING {returning}'.format(
+               table=quote_name(model._meta.db_table),
+               columns=', '.join(quote_name(field.column) for field in fields),
+               values=', '.join([placeholders] * rows),
+               target=', '.join(quote_name(model._meta.get_field(name).column) for name in key),
+               returning=', '.join(quote_name(model._meta.get_field(name).column)
+                                   for name in (model._meta.pk.attname, *returning)),
+           )
+
+
+def insert_or_get(model, key, values=None, using=DEFAULT_DB_ALIAS):
+    '''Возвращает (pk, created) строки model с уникальным ключом key (словарь attname -> значение).
+    Новая строка вставляется с key и values одним запросом INSERT ... ON CONFLICT (key) DO NOTHING RETURNING,
+    поэтому у модели должно быть ограничение уникальности ровно по колонкам key:
+    при параллельной вставке того же ключа запрос не падает с IntegrityError, а ничего не возвращает,
+    и тогда существующая строка читается по ключу. Поэтому проверки "есть ли такая запись" перед вставкой нет,
+    а транзакция PostgreSQL не прерывается и не требует точки сохранения.
+    Сигналы не вызываются. Файлы в values не сохраняются: передавайте уже сохраненные имена'''
+
+    connection = connections[using]
+    if not supports_insert_returning(connection):
+        instance, created = model.objects.using(using).get_or_create(defaults=values, **key)
+        return instance.pk, created
+
+    instance = model(**key, **(values or {}))
+    fields = get_insert_fields(model)
+    params = get_insert_params(instance, fields, connection)
+    sql = build_insert_sql(model, fields, key, connection)
+
+    for _ in range(MAX_ATTEMPTS):
+        with connection.cursor() as cursor:
+            cursor.execute(sql, params)
+            row = cursor.fetchone()
+        if row is not None:
+            return row[0], True
+
+        pk = model.objects.using(using).filter(**key).values_list('pk', flat=True).first()
+        if pk is not None:
+            return pk, False
+
+    raise IntegrityError(f'Cannot insert or find {model._meta.label} with {key}')
+
+
+def insert_new(model, objs, key, using=DEFAULT_DB_ALIAS):
+    '''Вставляет objs запросами INSERT ... ON CONFLICT (key) DO NOTHING RETURNING и возвращает только
+    вставленные объекты (им проставляется pk); объекты, чей ключ key (кортеж attname) уже есть в таблице,
+    пропускаются. В отличие от bulk_create(ignore_conflicts=True) по результату можно считать, что
+    действительно добавлено. Требования к ограничению уникальности те же, что у insert_or_get.
+    Сигналы не вызываются'''
+
+    if not objs:
+        return []
+
+    connection = connections[using]
+    if not supports_insert_returning(connection):
+        lookup = Q()
+        for obj in objs:
+            lookup |= Q(**{name: getattr(obj, name) for name in key})
+        existing = set(model.objects.using(using).filter(lookup).values_list(*key))
+        new_objs = [obj for obj in objs if tuple(getattr(obj, name) for name in key) not in existing]
+        return model.objects.using(using).bulk_create(new_objs, ignore_conflicts=True)
+
+    fields = get_insert_fields(model)
+    key_fields = [model._meta.get_field(name) for name in key]
+    batch_size = connection.ops.bulk_batch_size(fields, objs) or len(objs)
+
+    inserted = []
+    for start in range(0, len(objs), batch_size):
+        batch = objs[start:start + batch_size]
+        params = [get_insert_params(obj, fields, connection) for obj in batch]
+        # Возвращенный ключ сравнивается с подготовленными для БД значениями, а не с атрибутами объекта
+        by_key = {
+            tuple(field.get_db_prep_save(getattr(obj, field.attname), connection) for field in key_fields): obj
+            for obj in batch
+        }
+        with connection.cursor() as cursor:
+            cursor.execute(build_insert_sql(model, fields, key, connection, rows=len(batch), returning=key),
+                           [param for row in params for param in row])
+            rows = cursor.fetchall()
+
+        for pk, *row_key in rows:
+            obj = by_key[tuple(row_key)]
+            obj.pk = pk
+            obj._state.adding = False
+            obj._state.db = using
+            inserted.append(obj)
+
+    return inserted
+
+
+def insert_from_select(model, columns, queryset, key, update_fields, using=DEFAULT_DB_ALIAS):
+    '''Вставляет в model строки, которые выбирает queryset, одним запросом
+    INSERT ... SELECT ... ON CONFLICT (key) DO UPDATE SET update_fields: строки не читаются в Python,
+    поэтому число запросов не зависит от их количества. Колонки SELECT должны идти в порядке columns (attname):
+    сначала поля модели queryset, затем аннотации в порядке annotate(). Возвращает число вставленных
+    и обновленных строк. Вызывающий код проверяет supports_insert_returning. Сигналы не вызываются'''
+
+    connection = connections[using]
+    quote_name = connection.ops.quote_name
+    try:
+        select, params = queryset.order_by().query.get_compiler(using).as_sql()
+    except EmptyResultSet:
+        return 0
+
+    columns = [quote_name(model._meta.get_field(name).column) for name in columns]
+    # Выборка обернута в подзапрос с WHERE: иначе SQLite принимает ON CONFLICT за условие последнего JOIN
+    sql = 'INSERT INTO {table} ({columns}) SELECT * FROM ({select}) AS source WHERE true ' \
+          'ON CONFLICT ({target}) DO UPDATE SET {updates}'.format(
+              table=quote_name(model._meta.db_table),
+              columns=', '.join(columns),
+              select=select,
+              target=', '.join(quote_name(model._meta.get_field(name).column) for name in key),
+              updates=', '.join('{0} = EXCLUDED.{0}'.format(quote_name(model._meta.get_field(name).column))
+                                for name in update_fields),
+          )
+    with connection.cursor() as cursor:
+        cursor.execute(sql, params)
+        return cursor.rowcount
+
+
+def increment(model, key, field, deltas, using=DEFAULT_DB_ALIAS):
+    '''Прибавляет к полю field строк model значения deltas (словарь: кортеж значений key -> прибавка),
+    недостающие строки вставляет со значением прибавки. Один запрос
+    INSERT ... ON CONFLICT (key) DO UPDATE SET field = field + EXCLUDED.field RETURNING: строки блокируются
+    самим UPDATE в порядке ключей, поэтому одновременные вызовы не теряют прибавки и не взаимоблокируются.
+    Возвращает словарь: кортеж значений key -> новое значение. Вызывающий код проверяет
+    supports_insert_returning. Сигналы не вызываются'''
+
+    if not deltas:
+        return {}
+
+    connection = connections[using]
+    quote_name = connection.ops.quote_name
+    table = quote_name(model._meta.db_table)
+    fields = [model._meta.get_field(name) for name in (*key, field)]
+    columns = [quote_name(model_field.column) for model_field in fields]
+    column = columns[-1]
+    rows = sorted(deltas.items())
+    batch_size = connection.ops.bulk_batch_size(fields, rows) or len(rows)
+
+    values = {}
+    for start in range(0, len(rows), batch_size):
+        batch = rows[start:start + batch_size]
+        sql = 'INSERT INTO {table} ({columns}) VALUES {values} ON CONFLICT ({target}) ' \
+              'DO UPDATE SET {column} = {table}.{column} + EXCLUDED.{column} RETURNING {columns}'.format(
+                  table=table,
+                  columns=', '.join(columns),
+                  values=', '.join(['({})'.format(', '.join(['%s'] * len(fields)))] * len(batch)),
+                  target=', '.join(columns[:-1]),
+                  column=column,
+              )
+        params = [model_field.get_db_prep_save(value, connection)
+                  for row_key, delta in batch for model_field, value in zip(fields, (*row_key, delta))]
+        with connection.cursor() as cursor:
+            cursor.execute(sql, params)
+            values.update({tuple(row[:-1]): row[-1] for row in cursor.fetchall()})
+
+    return values
+
+
+class RoundTripCounter:
+    '''Считает запросы к БД внутри блока with, включая запросы обработчиков сигналов и хранилища файлов'''
+
+    def __init__(self, using=DEFAULT_DB_ALIAS):
+        self.connection = connections[using]
+        self.count = 0
+        self.wrapper = None
+
+    def __call__(self, execute, sql, params, many, context):
+        self.count += 1
+        return execute(sql, params, many, context)
+
+    def __enter__(self):
+        self.wrapper = self.connection.execute_wrapper(self)
+        self.wrapper.__enter__()
+        return self
+
+    def __exit__(self, *exc_info):
+        return self.wrapper.__exit__(*exc_info)
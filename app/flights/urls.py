@@ -8,10 +8,14 @@ urlpatterns = [
     path("", views.HomeView.as_view(), name="home"),
     path("passengers/", views.PassengersView.as_view(), name="passengers"),
     path("profile/<slug:username>/", views.ProfileView.as_view(), name="profile"),
+    path("profile/<slug:username>/export.<str:format>", views.PassengerExportView.as_view(), name="profile_export"),
     path("flight/<slug:usertripslug>/", views.FlightView.as_view(), name="flight"),
     path("flight/<slug:usertripslug>/update", views.FlightUpdateView.as_view(), name="flight_update"),
+    path("flight/<slug:usertripslug>/tracks", views.TrackImagesView.as_view(), name="flight_tracks"),
     path("flight/<slug:usertripslug>/delete", views.FlightDeleteView.as_view(), name="flight_delete"),
-    path("add_flight/", views.AddFlightView.as_view(), name="add_flight")
+    path("add_flight/", views.AddFlightView.as_view(), name="add_flight"),
+    path("import_flights/", views.ImportFlightsView.as_view(), name="import_flights"),
+    path(f"{settings.MEDIA_URL.strip('/')}/<path:name>", views.MediaFileView.as_view(), name="media_file"),
 ]
 
 # views.AddFlightView.as_view()
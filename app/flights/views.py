@@ -1,15 +1,29 @@
+import codecs
+
+from django.conf import settings
 from django.contrib.auth.mixins import LoginRequiredMixin
+from django.core.exceptions import ValidationError
+from django.core.files.storage import default_storage
 from django.db.models import Count, Prefetch
-from django.forms import modelformset_factory
 from django.db import transaction
 from django.shortcuts import render, redirect, get_object_or_404
-from django.http import HttpResponse, HttpResponseRedirect
+from django.http import Http404, HttpResponse, HttpResponseRedirect, JsonResponse
 from django.urls import reverse_lazy
+from django.utils.cache import patch_cache_control
 from django.views import View
+from django.views.static import serve
 from django.views.generic import ListView, TemplateView, DetailView, CreateView, FormView, UpdateView, DeleteView
-from .forms import AddFlightForm, MealForm, TrackImageForm, UserTripForm
+from .cache import HomePageCache
+from .forms import AddFlightForm, FlightImportForm, MealForm, TrackImagesForm, UserTripForm
+from .exporters import EXPORT_FORMATS, FlightLogExporter, stream_flight_log
+from .importers import FlightLogImporter, get_format
+from .pagination import KeysetPaginationMixin
+from .query_budget import QueryBudget
 from .permissions import IsOwnerPermissionMixin
-from .services import FlightInformationService, PassengerService, PassengerProfileService, FlightDetailService
+from .storage import BLOB_MAX_AGE, BLOB_TMP_DIR, is_blob_name
+from .uploads import STAGING_DIR, UploadStager
+from .services import (FlightInformationService, PassengerService, PassengerProfileService, FlightDetailService,
+                       TrackImageService, TripDeletionService)
 
 from .models import *
 from pprint import pprint
@@ -17,47 +31,74 @@ from pprint import pprint
 
 class HomeView(ListView):
     template_name = 'flights/index.html'
-    queryset = FlightInformationService.get_latest_cards()
     context_object_name = 'latest_cards'
+    query_budget = QueryBudget(queries=5)
+
+    def get_queryset(self):
+        return HomePageCache.get_or_set('latest_cards', FlightInformationService.get_latest_cards)
 
     def get_context_data(self, **kwargs):
         context = super().get_context_data(**kwargs)
-        context['top_users'] = FlightInformationService.get_top_users()
-        context['site_information'] = FlightInformationService.get_site_information()
+        context['top_users'] = HomePageCache.get_or_set(
+            'top_users', lambda: list(FlightInformationService.get_top_users())
+        )
+        context['site_information'] = HomePageCache.get_or_set(
+            'site_information', FlightInformationService.get_site_information
+        )
 
         return context
 
 
-class PassengersView(ListView):
+class PassengersView(KeysetPaginationMixin, ListView):
     template_name = 'flights/passengers.html'
     context_object_name = 'passengers'
-    queryset = PassengerService.get_all_passengers_with_statistic()
+    keyset_ordering = ('username',)
+    query_budget = QueryBudget(queries=3)
+
+    def get_queryset(self):
+        return PassengerService.get_all_passengers_with_statistic()
+
+    def render_to_response(self, context, **response_kwargs):
+        if self.wants_json():
+            return self.render_json_page(context['page_obj'])
 
+        return super().render_to_response(context, **response_kwargs)
 
-class ProfileView(DetailView):
+
+class ProfileView(KeysetPaginationMixin, DetailView):
     template_name = 'flights/profile.html'
     slug_field = 'passenger__username'
     slug_url_kwarg = 'username'
     context_object_name = 'profile'
+    keyset_ordering = ('-date', 'trip_id')
+    query_budget = QueryBudget(queries=4)
 
     def get_context_data(self, **kwargs):
         context = super().get_context_data(**kwargs)
-        context['flights'] = PassengerProfileService.get_passenger_flights(self.kwargs['username'])
+        _, page = self.paginate_keyset(PassengerProfileService.get_passenger_cards(self.kwargs['username']))
+        context['flights'] = page.object_list
+        context['page_obj'] = page
 
         return context
 
     def get_object(self):
         return PassengerProfileService.get_profile_information(self.kwargs['username'])
 
+    def render_to_response(self, context, **response_kwargs):
+        if self.wants_json():
+            return self.render_json_page(context['page_obj'], profile=context['profile'])
+
+        return super().render_to_response(context, **response_kwargs)
+
 
 class FlightView(DetailView):
     template_name = 'flights/flight.html'
     slug_url_kwarg = 'usertripslug'
     context_object_name = 'flight'
+    query_budget = QueryBudget(queries=4)
 
     def get_object(self):
-        data, files, _ = FlightDetailService.get_flight_details(self.kwargs['usertripslug'])
-        return {**data, **files}
+        return FlightDetailService.get_details(self.kwargs['usertripslug'])
 
 
 class FlightDeleteView(IsOwnerPermissionMixin, DeleteView):
@@ -67,11 +108,26 @@ class FlightDeleteView(IsOwnerPermissionMixin, DeleteView):
     success_url = reverse_lazy('home')
     slug_url_kwarg = 'usertripslug'
     queryset = UserTrip.objects.all()
+    # Удаление выполняется запросами на весь набор, без сигналов для каждой строки
+    query_budget = {
+        'GET': QueryBudget(queries=5),
+        'POST': QueryBudget(queries=33),
+    }
 
     def get_passenger(self):
         data, _, _ = FlightDetailService.get_flight_details(self.kwargs['usertripslug'])
         return data.get('user')
 
+    def get_object(self, queryset=None):
+        # Детали полета уже загружены проверкой прав, берем путешествие по первичному ключу
+        _, __, id_dict = FlightDetailService.get_flight_details(self.kwargs['usertripslug'])
+        return get_object_or_404(queryset or self.get_queryset(), pk=id_dict['usertrip_id'])
+
+    def form_valid(self, form):
+        # Полет и борт удаляются вместе с последним путешествием, файлы - воркером после коммита
+        TripDeletionService.delete(trips=UserTrip.objects.filter(pk=self.object.pk))
+        return HttpResponseRedirect(self.get_success_url())
+
     # def post(self, request, usertripslug):
     #     data, files, id_dict = FlightDetailService.get_flight_details(usertripslug)
     #     track_images = data.get('track_images')
@@ -91,7 +147,14 @@ class FlightDeleteView(IsOwnerPermissionMixin, DeleteView):
 class FlightUpdateView(IsOwnerPermissionMixin, View):
     template_name = 'flights/add_flight.html'
     form_class = AddFlightForm
-    formset_class = modelformset_factory(TrackImage, form=TrackImageForm, fields=('track_img',), extra=10)
+    track_images_form_class = TrackImagesForm
+    query_budget = {
+        'GET': QueryBudget(queries=5),
+        # Свободные имена проверяются одним SELECT на поле с файлами (фото борта, фото питания, треки),
+        # а занятое имя файла, который заменяется, еще раз проверяет get_available_name.
+        # Сохраненные файлы формы разрешаются одним запросом (get_files)
+        'POST': QueryBudget(queries=23, max_repeats=3),
+    }
 
     def get_passenger(self):
         data, _, _ = FlightDetailService.get_flight_details(self.kwargs['usertripslug'])
@@ -100,12 +163,12 @@ class FlightUpdateView(IsOwnerPermissionMixin, View):
     def get(self, request, usertripslug):
         data, files, _ = FlightDetailService.get_flight_details(usertripslug)
 
-        formset = self.formset_class(queryset=data.get('track_images'))
+        track_images_form = self.track_images_form_class(track_images=data.get('track_images'))
         form = self.form_class(initial={**data, **files})
 
         context = {
             'form': form,
-            'formset': formset,
+            'track_images_form': track_images_form,
             'title': 'Edit Flight',
             'view_name': 'flight_update',
             'url_args': usertripslug
@@ -125,72 +188,110 @@ class FlightUpdateView(IsOwnerPermissionMixin, View):
             if (field_name + '-clear') in request.POST:
                 files.pop(field_name)
 
+        # Форма открывает сохраненные файлы для проверки: их содержимое разрешается одним запросом на все
+        if hasattr(default_storage, 'get_blob_names'):
+            default_storage.get_blob_names([file.name for file in files.values() if file])
+
         files.update(request.FILES.dict())
         return files
 
     def post(self, request, usertripslug):
-        _, __, id_dict = FlightDetailService.get_flight_details(usertripslug)
+        data, __, id_dict = FlightDetailService.get_flight_details(usertripslug)
 
         form = self.form_class(data=request.POST, files=self.get_files(request, usertripslug))
-        formset = self.formset_class(request.POST or None, request.FILES or None)
-
-        if form.is_valid() and formset.is_valid():
-
-            with transaction.atomic():
-                # Обновляется вся информация, которая есть по всем id-шникам
-                trip = form.save(user=request.user, **id_dict)
+        track_images_form = self.track_images_form_class(request.POST, request.FILES,
+                                                         track_images=data.get('track_images'))
 
-                for index, f in enumerate(formset):
-                    if f.cleaned_data:
+        if form.is_valid() and track_images_form.is_valid():
 
-                        if f.cleaned_data.get('id') is None:
-                            # Мы загрузили новое изображение в форму
+            # Файлы пишутся на диск до транзакции, в транзакции сохраняются только имена (см. flights/uploads.py)
+            with UploadStager() as stager:
+                upload_trip = form.stage_files(stager, request.user)
+                uploads = track_images_form.stage_files(stager, upload_trip)
 
-                            track_image_instance = TrackImage(trip=trip, track_img=f.cleaned_data.get('track_img'))
-                            track_image_instance.save()
-                        elif f.cleaned_data.get('track_img') is False:
-                            # Мы поставили галочку напротив очистить
-                            id = f.cleaned_data.get('id').id
+                with stager.atomic():
+                    # Обновляется вся информация, которая есть по всем id-шникам
+                    trip = form.save(user=request.user, **id_dict)
 
-                            track_image_instance = TrackImage.objects.get(pk=id)
-                            track_image_instance.delete()
-                        else:
-                            # Если изображение было загружено ранее (то есть у него уже есть id в бд)
-                            id = f.cleaned_data.get('id').id
-
-                            track_image_instance_in_db = TrackImage.objects.get(pk=id)
-                            track_image_instance_in_db.track_img = \
-                                TrackImage(trip=trip, track_img=f.cleaned_data.get('track_img')).track_img
-                            track_image_instance_in_db.save()
+                    TrackImageService.delete(trip, track_images_form.cleaned_data['delete_track_images'])
+                    TrackImageService.add(trip, uploads)
 
             return redirect('flight', usertripslug=usertripslug)
 
         context = {
             'title': 'Edit Flight',
             'form': form,
-            'formset': formset,
+            'track_images_form': track_images_form,
             'view_name': 'flight_update',
             'url_args': usertripslug
         }
         return render(request, self.template_name, context=context)
 
 
+class TrackImagesView(IsOwnerPermissionMixin, View):
+    '''Загрузка и удаление изображений трэков без отправки всей формы путешествия.
+    Принимает поля TrackImagesForm, отвечает JSON с ключами созданных изображений и числом удаленных'''
+
+    form_class = TrackImagesForm
+    # Не зависит от числа файлов: имена проверяются одним запросом, вставка - одним bulk_create,
+    # удаление - одним DELETE. Файлы переносятся в хранилище уже после коммита
+    query_budget = QueryBudget(queries=15)
+
+    def get_passenger(self):
+        data, _, _ = FlightDetailService.get_flight_details(self.kwargs['usertripslug'])
+        return data.get('user')
+
+    def post(self, request, usertripslug):
+        details = FlightDetailService.get_details(usertripslug)
+
+        form = self.form_class(request.POST, request.FILES, track_images=details.track_images)
+        if not form.is_valid():
+            return JsonResponse({'errors': form.errors}, status=400)
+
+        # Путешествие не перечитывается: для ключа и upload_to хватает загруженных деталей
+        trip = UserTrip(pk=details.usertrip_id,
+                        flight=Flight(pk=details.flight_id, flight_number=details.flight_number, date=details.date),
+                        passenger=details.user)
+
+        with UploadStager() as stager:
+            uploads = form.stage_files(stager, trip)
+            with stager.atomic():
+                deleted = TrackImageService.delete(trip, form.cleaned_data['delete_track_images'])
+                track_images = TrackImageService.add(trip, uploads)
+
+        return JsonResponse({'created': [track_image.pk for track_image in track_images], 'deleted': deleted})
+
+
 class AddFlightView(LoginRequiredMixin, FormView):
     form_class = AddFlightForm
-    formset_class = modelformset_factory(TrackImage, form=TrackImageForm, fields=('track_img',), extra=10)
+    track_images_form_class = TrackImagesForm
     template_name = 'flights/add_flight.html'
     success_url = reverse_lazy('home')
-
-    def form_invalid(self, form, formset):
-        return self.render_to_response(self.get_context_data(form=form, formset=formset))
-
-    def form_valid(self, form, formset):
-        with transaction.atomic():
-            trip = form.save(user=self.request.user)
-            for f in formset:
-                if f.cleaned_data:
-                    track_image_instance = f.save(trip=trip)
-                    track_image_instance.save()
+    # Новое путешествие на новый полет - 12 обращений FlightSaveService, остальное - сессия, пользователь
+    # и публикация файлов. Число файлов на число запросов не влияет, но свободные имена проверяются
+    # одним SELECT на поле с файлами (фото борта, фото питания, треки), поэтому он повторяется
+    query_budget = {
+        'GET': QueryBudget(queries=3),
+        'POST': QueryBudget(queries=24, max_repeats=3),
+    }
+
+    def form_invalid(self, form, track_images_form):
+        return self.render_to_response(self.get_context_data(form=form, track_images_form=track_images_form))
+
+    def form_valid(self, form, track_images_form):
+        # Файлы пишутся на диск до транзакции, в транзакции сохраняются только имена (см. flights/uploads.py)
+        try:
+            with UploadStager() as stager:
+                upload_trip = form.stage_files(stager, self.request.user)
+                uploads = track_images_form.stage_files(stager, upload_trip)
+
+                with stager.atomic():
+                    trip = form.save(user=self.request.user)
+                    TrackImageService.add(trip, uploads)
+        except ValidationError as error:
+            # Полет уже есть с другим бортом: транзакция откачена, подготовленные файлы удалены
+            form.add_error(None, error)
+            return self.form_invalid(form, track_images_form)
 
         return super().form_valid(form)
 
@@ -200,17 +301,90 @@ class AddFlightView(LoginRequiredMixin, FormView):
         POST variables and then check if it's valid.
         """
         form = self.get_form()
-        formset = self.formset_class(request.POST or None, request.FILES or None)
+        track_images_form = self.track_images_form_class(request.POST, request.FILES)
 
-        if form.is_valid() and formset.is_valid():
-            return self.form_valid(form, formset)
+        if form.is_valid() and track_images_form.is_valid():
+            return self.form_valid(form, track_images_form)
         else:
-            return self.form_invalid(form, formset)
+            return self.form_invalid(form, track_images_form)
 
     def get_context_data(self, **kwargs):
         context = super().get_context_data(**kwargs)
         context['view_name'] = 'add_flight'
         context['url_args'] = ''
         context['title'] = 'Add New Flight'
-        context['formset'] = self.formset_class(queryset=TrackImage.objects.none())
+        context.setdefault('track_images_form', self.track_images_form_class())
         return context
+
+
+class ImportFlightsView(LoginRequiredMixin, FormView):
+    form_class = FlightImportForm
+    template_name = 'flights/import_flights.html'
+    # Бюджет рассчитан на одну пачку из FlightLogImporter.batch_size строк: файл из нескольких пачек
+    # попадает в лог как превышение. FlightLogImporter.resolve перечитывает справочники
+    # после bulk_create(ignore_conflicts=True), поэтому их SELECT выполняется дважды
+    query_budget = {
+        'GET': QueryBudget(queries=3),
+        'POST': QueryBudget(queries=32, max_repeats=2),
+    }
+    max_errors_shown = 100
+
+    def form_valid(self, form):
+        upload = form.cleaned_data['file']
+        importer = FlightLogImporter(self.request.user)
+        stats = importer.run(codecs.iterdecode(upload, 'utf-8-sig'), get_format(upload.name))
+
+        if self.request.GET.get('format') == 'json':
+            return JsonResponse({
+                **stats,
+                'errors_list': [{'line': line, 'message': message} for line, message in importer.errors],
+            })
+
+        return self.render_to_response(self.get_context_data(
+            form=self.form_class(),
+            stats=stats,
+            import_errors=importer.errors[:self.max_errors_shown],
+        ))
+
+
+class PassengerExportView(IsOwnerPermissionMixin, View):
+    # Строки выгрузки читаются уже после выхода из middleware, в бюджет входят только запросы до начала потока
+    query_budget = QueryBudget(queries=3)
+
+    def get_passenger(self):
+        return User.objects.filter(username=self.kwargs['username']).first()
+
+    def get(self, request, username, format):
+        if format not in EXPORT_FORMATS:
+            raise Http404()
+
+        exporter = FlightLogExporter(UserTrip.objects.filter(passenger=request.user))
+        return stream_flight_log(exporter, format, f'{username}-flights')
+
+
+class MediaFileView(View):
+    '''Файлы по логическим именам из полей моделей.
+    nginx отдает существующие файлы сам, а запросы, для которых файла по такому пути нет, передает сюда:
+    логическое имя в ContentAddressedStorage перенаправляется на неизменяемый URL содержимого.
+    Перенаправление кешируется на MEDIA_REDIRECT_MAX_AGE секунд, поэтому повторный показ изображения
+    не стоит лишнего запроса. Остальное (файлы, загруженные до перехода и еще не перенесенные
+    migrate_media_to_cas, и само содержимое) отдается с диска: так файлы доступны и без nginx'''
+
+    query_budget = QueryBudget(queries=1)
+
+    def get(self, request, name):
+        # Подготовленные загрузки и временные файлы хранилища не публикуются, как и в nginx
+        if name.replace('\\', '/').startswith((f'{STAGING_DIR}/', f'{BLOB_TMP_DIR}/')):
+            raise Http404()
+
+        if hasattr(default_storage, 'blob_url') and not is_blob_name(name):
+            blob_name = default_storage.get_blob_name(name)
+            if blob_name:
+                response = redirect(default_storage.blob_url(blob_name))
+                patch_cache_control(response, public=True, max_age=settings.MEDIA_REDIRECT_MAX_AGE)
+                return response
+
+        response = serve(request, name, document_root=settings.MEDIA_ROOT)
+        if is_blob_name(name):
+            patch_cache_control(response, public=True, max_age=BLOB_MAX_AGE, immutable=True)
+        return response
@@ -13,7 +13,8 @@ for (var i = 0; i < images.length; i++) {
 
 
     var modalImage = document.createElement('img');
-    modalImage.src = this.src;
+    // Копия из srcset может быть маленькой, поэтому показываем крупную (data-full), если она есть
+    modalImage.src = this.dataset.full || this.currentSrc || this.src;
 
     modal.appendChild(modalImage);
 
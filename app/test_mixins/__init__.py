@@ -1 +1,3 @@
-from .test_data_upload import UploadDataMixin
\ No newline at end of file
+from .test_data_upload import UploadDataMixin
+from .query_budget import QueryBudgetMixin
+from .jobs import JobQueueMixin
@@ -0,0 +1,26 @@
+from contextlib import contextmanager
+
+from django.test import TestCase
+
+from flights.jobs import JobWorker
+
+
+class JobQueueMixin(TestCase):
+    '''Выполнение фоновых задач в тестах. TestCase не коммитит транзакцию, поэтому задачи,
+    поставленные через on_commit, создаются только внутри committed()'''
+
+    @contextmanager
+    def committed(self):
+        with self.captureOnCommitCallbacks(execute=True):
+            yield
+
+    def run_jobs(self):
+        '''Выполняет задачи, включая поставленные самими задачами (например, удаление содержимого файла)'''
+
+        total = 0
+        while True:
+            with self.captureOnCommitCallbacks(execute=True) as callbacks:
+                count = JobWorker().run_pending()
+            total += count
+            if not count and not callbacks:
+                return total
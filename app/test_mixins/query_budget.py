@@ -0,0 +1,30 @@
+import logging
+
+from django.test import TestCase
+
+
+class QueryBudgetMixin(TestCase):
+    '''Каждый запрос тестового клиента проверяется QueryBudgetMiddleware:
+    превышение query_budget представления или повторный SELECT роняет тест'''
+
+    def setUp(self):
+        super().setUp()
+
+        # Не декоратор override_settings: при множественном наследовании миксинов он бы потерялся
+        budget_settings = self.settings(QUERY_BUDGET_SAMPLE_RATE=1, QUERY_BUDGET_RAISE=True)
+        budget_settings.enable()
+        self.addCleanup(budget_settings.disable)
+
+        # Отчеты укладывающихся в бюджет запросов в выводе тестов не нужны
+        query_logger = logging.getLogger('flights.query_budget')
+        self.addCleanup(query_logger.setLevel, query_logger.level)
+        query_logger.setLevel(logging.WARNING)
+
+    def assertWithinQueryBudget(self, response):
+        report = response.wsgi_request.query_report
+        budget = response.wsgi_request.query_budget
+
+        self.assertIsNotNone(budget, f'{report.view} does not declare query_budget')
+        self.assertEqual(report.get_violations(budget), [])
+
+        return report
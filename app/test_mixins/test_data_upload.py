@@ -5,6 +5,7 @@ import tempfile
 from django.core.files.uploadedfile import SimpleUploadedFile
 
 from aviablog import settings
+from django.core.cache import cache
 from django.test import TestCase, override_settings
 from django.core.management import call_command
 
@@ -15,8 +16,15 @@ from PIL import Image
 
 tmp_dir = tempfile.mkdtemp(dir=settings.BASE_DIR)
 
+# Файлы по путям из полей моделей, без адресации по содержимому: для тестов раскладки файлов по каталогам
+filesystem_storage = override_settings(STORAGES={
+    **settings.STORAGES,
+    'default': {'BACKEND': 'django.core.files.storage.FileSystemStorage'},
+})
 
-@override_settings(MEDIA_ROOT=tmp_dir)
+
+@override_settings(MEDIA_ROOT=tmp_dir,
+                   CACHES={'default': {'BACKEND': 'django.core.cache.backends.locmem.LocMemCache'}})
 class TemproaryMediaRootMixin(TestCase):
 
     @classmethod
@@ -27,11 +35,16 @@ class TemproaryMediaRootMixin(TestCase):
         # Вызываем команду flush для очистки базы данных
         call_command('flush', interactive=False)
 
+    def setUp(self):
+        super().setUp()
+        cache.clear()
+
     @classmethod
     def tearDownClass(cls) -> None:
         super().tearDownClass()
         # call_command('flush', interactive=False)
-        shutil.rmtree(cls.media_root)
+        # Каталог общий для всех классов тестов и мог быть удален раньше
+        shutil.rmtree(cls.media_root, ignore_errors=True)
 
 
 class UploadDataMixin(TestCase):
@@ -48,64 +61,68 @@ class UploadDataMixin(TestCase):
             TrackImageFactory(trip=usertrip)
 
 
+def get_image_buffer():
+    f = BytesIO()
+    image = Image.new(mode='RGB', size=(100, 100))
+    image.save(f, 'png')
+    f.seek(0)
+    return f
+
+
+# Данные формы AddFlightForm без файлов
+FLIGHT_FORM_DATA = {
+    'registration_number': 'ABC123',
+    'serial_number': 'XYZ789',
+    'airline_name': 'S7 Airlines',
+
+    'flight_number': 'FL123',
+    'date': '2023-01-01',
+    'flight_time': '12:00',
+
+    'manufacturer': 'Airbus',
+    'generic_type': 'A320',
+
+    'seat': 'A1',
+    'neighbors': 'B1, C1',
+    'comments': 'Test comments',
+    'ticket_price': 10000,
+
+    'drinks': 'Test drinks',
+    'appertize': 'Test appertize',
+    'main_course': 'Test main course',
+    'desert': 'Test desert',
+    'meal_price': 500,
+
+    'departure_airport_code': 'ABC',
+    'departure_gate': 'A',
+    'departure_is_boarding_bridge': True,
+    'departure_schedule_time': '10:00',
+    'departure_actual_time': '10:30',
+    'departure_runway': '1',
+    'departure_metar': 'METAR data for departure',
+
+    'arrival_airport_code': 'XYZ',
+    'arrival_gate': 'B',
+    'arrival_is_boarding_bridge': False,
+    'arrival_schedule_time': '14:00',
+    'arrival_actual_time': '14:15',
+    'arrival_runway': '2',
+    'arrival_metar': 'METAR data for arrival',
+}
+
+
 class PostMethodMixin(TestCase):
 
     def get_image_buffer(self):
-        f = BytesIO()
-        image = Image.new(mode='RGB', size=(100, 100))
-        image.save(f, 'png')
-        f.seek(0)
-        return f
+        return get_image_buffer()
 
     def setUp(self):
 
-        self.data = {
-            'registration_number': 'ABC123',
-            'serial_number': 'XYZ789',
-            'airline_name': 'S7 Airlines',
-
-            'flight_number': 'FL123',
-            'date': '2023-01-01',
-            'flight_time': '12:00',
-
-            'manufacturer': 'Airbus',
-            'generic_type': 'A320',
-
-            'seat': 'A1',
-            'neighbors': 'B1, C1',
-            'comments': 'Test comments',
-            'ticket_price': 10000,
-
-            'drinks': 'Test drinks',
-            'appertize': 'Test appertize',
-            'main_course': 'Test main course',
-            'desert': 'Test desert',
-            'meal_price': 500,
-
-            'departure_airport_code': 'ABC',
-            'departure_gate': 'A',
-            'departure_is_boarding_bridge': True,
-            'departure_schedule_time': '10:00',
-            'departure_actual_time': '10:30',
-            'departure_runway': '1',
-            'departure_metar': 'METAR data for departure',
-
-            'arrival_airport_code': 'XYZ',
-            'arrival_gate': 'B',
-            'arrival_is_boarding_bridge': False,
-            'arrival_schedule_time': '14:00',
-            'arrival_actual_time': '14:15',
-            'arrival_runway': '2',
-            'arrival_metar': 'METAR data for arrival',
-        }
+        self.data = dict(FLIGHT_FORM_DATA)
 
         self.files = {
             'airframe_photo': SimpleUploadedFile("airframe.jpg", self.get_image_buffer().read()),
             'meal_photo': SimpleUploadedFile("meal.jpg", self.get_image_buffer().read()),
-            'form-TOTAL_FORMS': '10',
-            'form-INITIAL_FORMS': '0',
-            'form-MIN_NUM_FORMS': '0',
-            'form-MAX_NUM_FORMS': '1000',
-            'form-0-track_img': SimpleUploadedFile("track1.jpg", self.get_image_buffer().read()),
-            'form-1-track_img': SimpleUploadedFile("track2.jpg", self.get_image_buffer().read())
+            'track_images': [SimpleUploadedFile("track1.jpg", self.get_image_buffer().read()),
+                             SimpleUploadedFile("track2.jpg", self.get_image_buffer().read())]
         }